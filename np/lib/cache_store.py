@@ -0,0 +1,182 @@
+"""
+Save and reuse the results of identical runs in a content-addressed cache
+
+A key is a digest of everything that determines a result, such as the node
+inputs, the source code of each model and the normalized job configuration.
+Each entry is a folder of artifacts plus pickled state; the cache evicts the
+least recently used entries when it grows beyond its maximum size.
+"""
+# Import system modules
+import os
+import json
+import shutil
+import hashlib
+import cPickle as pickle
+# Import custom modules
+import store
+
+
+# Set constants
+indexName = 'entry.json'
+stateName = 'state.pickle'
+
+
+# Core
+
+def hashValues(*values):
+    'Return a digest of JSON-compatible values such as job configurations'
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str)).hexdigest()
+
+def hashModel(model):
+    'Return a digest of the source code in the folder of a model, computing it once per process'
+    modelName = model.__name__
+    if modelName not in sourceHashByModelName:
+        sourceHash = hashlib.sha1()
+        modelFolderPath = os.path.dirname(os.path.abspath(model.__file__))
+        for folderPath, folderNames, fileNames in sorted(os.walk(modelFolderPath)):
+            folderNames.sort()
+            for fileName in sorted(fileNames):
+                if not fileName.endswith('.py'):
+                    continue
+                filePath = os.path.join(folderPath, fileName)
+                sourceHash.update(os.path.relpath(filePath, modelFolderPath))
+                sourceHash.update(open(filePath, 'rb').read())
+        sourceHashByModelName[modelName] = sourceHash.hexdigest()
+    return sourceHashByModelName[modelName]
+
+sourceHashByModelName = {}
+
+def normalizeValueByOptionBySection(valueByOptionBySection):
+    'Drop empty sections and compare values as strings so that equivalent configurations give the same key'
+    return dict((section, dict((option, str(value)) for option, value in valueByOption.iteritems())) for section, valueByOption in (valueByOptionBySection or {}).iteritems() if valueByOption)
+
+
+class Cache(object):
+    'Artifacts and state by key in folderPath, keeping at most maximumSize bytes'
+
+    maximumSize = 10 * 1024 ** 3
+
+    def __init__(self, folderPath, maximumSize=None):
+        self.folderPath = store.makeFolderSafely(folderPath)
+        if maximumSize is not None:
+            self.maximumSize = maximumSize
+
+    def getEntryPath(self, key):
+        return os.path.join(self.folderPath, key)
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self.getEntryPath(key), indexName))
+
+    def load(self, key, targetPathByName, linkNames=()):
+        """
+        Copy the artifacts of the entry to targetPathByName and return its state, or return None if we do not have it;
+        remove targets that the entry does not have so that they do not mix with the cached artifacts.
+        Hard-link the files of artifacts in linkNames instead of copying them;
+        only use linkNames for artifacts that their owners replace rather than modify in place.
+        """
+        entryPath = self.getEntryPath(key)
+        if not self.has(key):
+            return None
+        entry = json.load(open(os.path.join(entryPath, indexName), 'rt'))
+        if not set(entry['names']).issubset(targetPathByName):
+            raise CacheError('Entry %s has artifacts %s' % (key, ' '.join(entry['names'])))
+        # Copy
+        for name, targetPath in targetPathByName.iteritems():
+            if name in entry['names']:
+                copyArtifact(os.path.join(entryPath, name), targetPath, name in linkNames)
+            else:
+                removeArtifact(targetPath)
+        # Mark the entry as recently used
+        os.utime(os.path.join(entryPath, indexName), None)
+        return pickle.load(open(os.path.join(entryPath, stateName), 'rb'))
+
+    def save(self, key, sourcePathByName, state, linkNames=()):
+        'Save copies of the artifacts with the state under key, then evict old entries; return False if the entry is too big'
+        entryPath = self.getEntryPath(key)
+        temporaryPath = '%s.%s.tmp' % (entryPath, os.getpid())
+        removeArtifact(temporaryPath)
+        store.makeFolderSafely(temporaryPath)
+        try:
+            for name, sourcePath in sourcePathByName.iteritems():
+                copyArtifact(sourcePath, os.path.join(temporaryPath, name), name in linkNames)
+            pickle.dump(state, open(os.path.join(temporaryPath, stateName), 'wb'), pickle.HIGHEST_PROTOCOL)
+            entrySize = getSize(temporaryPath)
+            if entrySize > self.maximumSize:
+                return False
+            json.dump(dict(names=sorted(sourcePathByName), size=entrySize), open(os.path.join(temporaryPath, indexName), 'wt'))
+            # Replace the entry in one step
+            removeArtifact(entryPath)
+            try:
+                os.rename(temporaryPath, entryPath)
+            except OSError:
+                # Another process saved the same key first
+                pass
+        finally:
+            removeArtifact(temporaryPath)
+        self.evict()
+        return True
+
+    def remove(self, key):
+        removeArtifact(self.getEntryPath(key))
+
+    def evict(self):
+        'Remove the least recently used entries until the cache fits in maximumSize'
+        entryPacks = []
+        for key in os.listdir(self.folderPath):
+            # Skip entries that save is still writing
+            if key.endswith('.tmp'):
+                continue
+            indexPath = os.path.join(self.getEntryPath(key), indexName)
+            if not os.path.exists(indexPath):
+                continue
+            entryPacks.append((os.path.getmtime(indexPath), json.load(open(indexPath, 'rt'))['size'], key))
+        totalSize = sum(x[1] for x in entryPacks)
+        for usedTime, entrySize, key in sorted(entryPacks):
+            if totalSize <= self.maximumSize:
+                break
+            self.remove(key)
+            totalSize -= entrySize
+
+    def getSize(self):
+        return getSize(self.folderPath)
+
+
+# Helpers
+
+def copyArtifact(sourcePath, targetPath, isLinked):
+    'Replace targetPath with a copy of the file or folder at sourcePath, hard-linking files if isLinked'
+    removeArtifact(targetPath)
+    if not os.path.isdir(sourcePath):
+        return copyFile(sourcePath, targetPath, isLinked)
+    for folderPath, folderNames, fileNames in os.walk(sourcePath):
+        targetFolderPath = store.makeFolderSafely(os.path.join(targetPath, os.path.relpath(folderPath, sourcePath)))
+        for fileName in fileNames:
+            copyFile(os.path.join(folderPath, fileName), os.path.join(targetFolderPath, fileName), isLinked)
+
+def copyFile(sourcePath, targetPath, isLinked):
+    if isLinked:
+        try:
+            return os.link(sourcePath, targetPath)
+        except OSError:
+            # Fall back to a copy, such as across devices
+            pass
+    shutil.copy2(sourcePath, targetPath)
+
+def removeArtifact(path):
+    'Remove the file or folder at path'
+    if os.path.isdir(path):
+        store.removeFolderSafely(path)
+    else:
+        store.removeSafely(path)
+
+def getSize(path):
+    'Return the total size in bytes of the file or folder'
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folderPath, x)) for folderPath, folderNames, fileNames in os.walk(path) for x in fileNames)
+
+
+# Error
+
+class CacheError(Exception):
+    pass
@@ -0,0 +1,119 @@
+"""
+Save and load level-of-detail clusters for zoomed-out map views
+
+For each zoom level, nodes are grouped into square grid cells on longitude
+and latitude and each subnet is simplified to the size of a pixel, so that
+the client downloads a small payload no matter how many nodes we have.
+"""
+# Import system modules
+import os
+import json
+import numpy
+import shapely.geometry
+# Import custom modules
+import store
+
+
+# Set constants
+tilePixelCount = 256
+clusterPixelCount = 64
+
+
+# Core
+
+def build(longitudes, latitudes, populations, systems, subnetPacks, maximumZoom):
+    'Return a GeoJSON FeatureCollection for each zoom level from 0 to maximumZoom; subnetPacks are (subnetID, segment coordinates) pairs'
+    # Initialize
+    longitudes = numpy.asarray(longitudes, dtype=float)
+    latitudes = numpy.asarray(latitudes, dtype=float)
+    populations = numpy.asarray(populations, dtype=float)
+    systemNames, systemCodes = numpy.unique(numpy.asarray(systems, dtype=str), return_inverse=True)
+    subnetGeometryPacks = [(subnetID, shapely.geometry.MultiLineString(coordinates)) for subnetID, coordinates in subnetPacks if coordinates]
+    # For each zoom,
+    featureCollectionByZoom = {}
+    for zoom in xrange(maximumZoom + 1):
+        features = []
+        features.extend(yieldClusterFeatures(longitudes, latitudes, populations, systemNames, systemCodes, getClusterSize(zoom)))
+        features.extend(yieldSubnetFeatures(subnetGeometryPacks, getPixelSize(zoom)))
+        featureCollectionByZoom[zoom] = {'type': 'FeatureCollection', 'features': features}
+    # Return
+    return featureCollectionByZoom
+
+def save(folderPath, featureCollectionByZoom):
+    'Replace the levels in folderPath'
+    store.removeFolderSafely(folderPath)
+    store.makeFolderSafely(folderPath)
+    for zoom, featureCollection in featureCollectionByZoom.iteritems():
+        json.dump(featureCollection, open(getLevelPath(folderPath, zoom), 'wt'))
+
+def load(folderPath, zoom):
+    'Return the GeoJSON string for the zoom level'
+    levelPath = getLevelPath(folderPath, zoom)
+    if not os.path.exists(levelPath):
+        raise ClusterError('Level not found: %s' % zoom)
+    return open(levelPath, 'rt').read()
+
+def has(folderPath, zoom):
+    return os.path.exists(getLevelPath(folderPath, zoom))
+
+
+# Helpers
+
+def yieldClusterFeatures(longitudes, latitudes, populations, systemNames, systemCodes, clusterSize):
+    'Generate a feature for each grid cell that has nodes'
+    if not len(longitudes):
+        return
+    # Assign nodes to cells
+    columns = numpy.floor((longitudes + 180) / clusterSize).astype(numpy.int64)
+    rows = numpy.floor((latitudes + 90) / clusterSize).astype(numpy.int64)
+    cellKeys, cellIndices = numpy.unique(columns * (int(360 / clusterSize) + 2) + rows, return_inverse=True)
+    cellCount = len(cellKeys)
+    # Aggregate
+    nodeCounts = numpy.bincount(cellIndices, minlength=cellCount)
+    populationSums = numpy.bincount(cellIndices, weights=populations, minlength=cellCount)
+    meanLongitudes = numpy.bincount(cellIndices, weights=longitudes, minlength=cellCount) / nodeCounts
+    meanLatitudes = numpy.bincount(cellIndices, weights=latitudes, minlength=cellCount) / nodeCounts
+    systemCounts = numpy.bincount(cellIndices * len(systemNames) + systemCodes, minlength=cellCount * len(systemNames)).reshape(cellCount, len(systemNames))
+    dominantSystems = systemNames[systemCounts.argmax(axis=1)]
+    # For each cell,
+    for cellIndex in xrange(cellCount):
+        yield {
+            'type': 'Feature',
+            'id': 'c%s' % cellKeys[cellIndex],
+            'geometry': {'type': 'Point', 'coordinates': [float(meanLongitudes[cellIndex]), float(meanLatitudes[cellIndex])]},
+            'properties': {
+                'count': int(nodeCounts[cellIndex]),
+                'population': float(populationSums[cellIndex]),
+                'system': str(dominantSystems[cellIndex]),
+            },
+        }
+
+def yieldSubnetFeatures(subnetGeometryPacks, tolerance):
+    'Generate a simplified feature for each subnet'
+    for subnetID, subnetGeometry in subnetGeometryPacks:
+        simplifiedGeometry = subnetGeometry.simplify(tolerance, preserve_topology=False)
+        if simplifiedGeometry.is_empty:
+            continue
+        yield {
+            'type': 'Feature',
+            'id': 'u%s' % subnetID,
+            'geometry': shapely.geometry.mapping(simplifiedGeometry),
+            'properties': {},
+        }
+
+def getPixelSize(zoom):
+    'Return the width of a pixel in degrees of longitude'
+    return 360. / (tilePixelCount * 2 ** zoom)
+
+def getClusterSize(zoom):
+    'Return the width of a cluster cell in degrees of longitude'
+    return getPixelSize(zoom) * clusterPixelCount
+
+def getLevelPath(folderPath, zoom):
+    return os.path.join(folderPath, '%s.json' % int(zoom))
+
+
+# Error
+
+class ClusterError(Exception):
+    pass
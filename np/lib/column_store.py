@@ -0,0 +1,183 @@
+"""
+Columnar storage of node outputs
+
+Each model variable is saved as one typed NumPy column in a folder beside
+the dataset so that readers can memory-map only the columns they need.
+"""
+# Import system modules
+import os
+import csv
+import numpy
+import itertools
+import collections
+# Import custom modules
+import store
+
+
+# Set constants
+indexName = 'columns.csv'
+idsName = 'ids.npy'
+
+
+# Core
+
+class Writer(object):
+    'Gather node outputs one node at a time and save them as columns'
+
+    def __init__(self):
+        self.nodeIDs = []
+        self.valuesBySectionOption = collections.OrderedDict()
+
+    def add(self, nodeID, valueByOptionBySection):
+        'Append the outputs of a node'
+        nodeIndex = len(self.nodeIDs)
+        self.nodeIDs.append(nodeID)
+        # For each section,
+        for section, valueByOption in valueByOptionBySection.iteritems():
+            # For each option,
+            for option, value in valueByOption.iteritems():
+                # Mark nodes that did not have the variable with None
+                values = self.valuesBySectionOption.setdefault((section, option), [])
+                values.extend([None] * (nodeIndex - len(values)))
+                values.append(value)
+
+    def save(self, folderPath):
+        'Replace the columns in folderPath'
+        # Prepare folder
+        store.removeFolderSafely(folderPath)
+        store.makeFolderSafely(folderPath)
+        # Sort nodes by id so that readers can search
+        nodeIDs = numpy.array(self.nodeIDs, dtype=numpy.int64)
+        nodeOrder = numpy.argsort(nodeIDs, kind='mergesort')
+        numpy.save(os.path.join(folderPath, idsName), nodeIDs[nodeOrder])
+        # Save columns
+        csvWriter = csv.writer(open(os.path.join(folderPath, indexName), 'wb'))
+        csvWriter.writerow(['section', 'option', 'file name', 'type', 'missing file name'])
+        for columnIndex, ((section, option), values) in enumerate(self.valuesBySectionOption.iteritems()):
+            values.extend([None] * (len(nodeIDs) - len(values)))
+            column = makeTypedColumn(values)[nodeOrder]
+            fileName = 'column%d.npy' % columnIndex
+            numpy.save(os.path.join(folderPath, fileName), column)
+            # Save which nodes did not have the variable, if any
+            missingFileName = ''
+            if None in values:
+                missingFileName = 'missing%d.npy' % columnIndex
+                numpy.save(os.path.join(folderPath, missingFileName), numpy.array([x is None for x in values])[nodeOrder])
+            csvWriter.writerow([section, option, fileName, column.dtype.str, missingFileName])
+
+
+class Reader(object):
+    'Memory-map node output columns on demand'
+
+    def __init__(self, folderPath):
+        self.folderPath = folderPath
+        self.fileNameBySectionOption = {}
+        self.missingFileNameBySectionOption = {}
+        self.columnBySectionOption = {}
+        self.missingColumnBySectionOption = {}
+        # Load index
+        csvReader = csv.reader(open(os.path.join(folderPath, indexName), 'rb'))
+        csvReader.next()
+        for row in csvReader:
+            section, option, fileName = row[:3]
+            self.fileNameBySectionOption[(section, option)] = fileName
+            if len(row) > 4 and row[4]:
+                self.missingFileNameBySectionOption[(section, option)] = row[4]
+        self.nodeIDs = numpy.load(os.path.join(folderPath, idsName), mmap_mode='r')
+
+    def getSectionOptions(self):
+        return sorted(self.fileNameBySectionOption)
+
+    def has(self, section, option):
+        return (section, option) in self.fileNameBySectionOption
+
+    def getColumn(self, section, option):
+        'Return the memory-mapped column for the variable in node id order'
+        if (section, option) not in self.columnBySectionOption:
+            if (section, option) not in self.fileNameBySectionOption:
+                raise ColumnError('Column not found: %s > %s' % (section, option))
+            self.columnBySectionOption[(section, option)] = numpy.load(os.path.join(self.folderPath, self.fileNameBySectionOption[(section, option)]), mmap_mode='r')
+        return self.columnBySectionOption[(section, option)]
+
+    def getMissingColumn(self, section, option):
+        'Return a boolean column marking nodes that did not have the variable or None if every node had it'
+        if (section, option) not in self.missingFileNameBySectionOption:
+            return None
+        if (section, option) not in self.missingColumnBySectionOption:
+            self.missingColumnBySectionOption[(section, option)] = numpy.load(os.path.join(self.folderPath, self.missingFileNameBySectionOption[(section, option)]), mmap_mode='r')
+        return self.missingColumnBySectionOption[(section, option)]
+
+    def getNodeIndex(self, nodeID):
+        'Return the row of the node in each column'
+        nodeIndex = numpy.searchsorted(self.nodeIDs, nodeID)
+        if nodeIndex >= len(self.nodeIDs) or self.nodeIDs[nodeIndex] != nodeID:
+            raise ColumnError('Node not found: %s' % nodeID)
+        return nodeIndex
+
+    def getNodeIndices(self, nodeIDs):
+        'Return the row of each node in each column or -1 if the columns do not have the node'
+        nodeIDs = numpy.asarray(nodeIDs, dtype=numpy.int64)
+        nodeIndices = numpy.searchsorted(self.nodeIDs, nodeIDs)
+        isFound = nodeIndices < len(self.nodeIDs)
+        isFound[isFound] = self.nodeIDs[nodeIndices[isFound]] == nodeIDs[isFound]
+        nodeIndices[~isFound] = -1
+        return nodeIndices
+
+    def getValueByOptionBySection(self, nodeID):
+        'Rebuild the output of a node in the same form as the pickled view'
+        nodeIndex = self.getNodeIndex(nodeID)
+        valueByOptionBySection = {}
+        for section, option in self.fileNameBySectionOption:
+            # Leave out variables that the node did not have
+            missingColumn = self.getMissingColumn(section, option)
+            if missingColumn is not None and missingColumn[nodeIndex]:
+                continue
+            value = self.getColumn(section, option)[nodeIndex]
+            valueByOptionBySection.setdefault(section, {})[option] = formatValue(value)
+        return valueByOptionBySection
+
+
+# Helpers
+
+def summarizeOutputs(systems, populations):
+    'Count nodes by system and split sorted populations in half as store.splitList does'
+    # Count systems
+    countBySystem = collections.defaultdict(int)
+    if len(systems):
+        systemNames, systemCodes = numpy.unique(numpy.asarray(systems), return_inverse=True)
+        for system, systemCount in itertools.izip(systemNames, numpy.bincount(systemCodes)):
+            countBySystem[str(system)] = int(systemCount)
+    # Compute quartiles
+    populations = numpy.asarray(populations)
+    populations = numpy.sort(populations.astype(numpy.int64) if populations.dtype.kind in 'if' else numpy.array([int(x) for x in populations], dtype=numpy.int64))
+    halfLength = len(populations) / 2
+    return {
+        'count by system': countBySystem,
+        'population quartiles': [float(numpy.median(x)) for x in (populations[:halfLength], populations, populations[halfLength:2 * halfLength])],
+    }
+
+def makeTypedColumn(values):
+    'Return an integer, float or string column whose values format back to the same strings; fill None with zero or an empty string'
+    presentValues = [x for x in values if x is not None]
+    for parse, dtype, fill in (int, numpy.int64, 0), (float, numpy.float64, 0.):
+        try:
+            # Type the column only if no value changes, such as 05 or 1.50
+            if all(formatValue(parse(x)) == x for x in presentValues):
+                return numpy.array([fill if x is None else parse(x) for x in values], dtype=dtype)
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return numpy.array(['' if x is None else str(x) for x in values])
+
+def formatValue(value):
+    'Format a column value the way VariableStore.getValueByOptionBySection does'
+    if isinstance(value, numpy.floating):
+        return str(float(value))
+    if isinstance(value, numpy.integer):
+        return str(int(value))
+    return str(value)
+
+
+# Error
+
+class ColumnError(Exception):
+    pass
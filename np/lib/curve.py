@@ -1,11 +1,16 @@
 'Fit a linear or logistic curve to a series of points'
 # Import system modules
-import scipy.stats
 import itertools
 import warnings
 import numpy
 import math
 import copy
+# Import custom modules
+from np.lib import store
+
+
+# Import scipy only when a curve is actually fitted
+stats = store.LazyModule('scipy.stats')
 
 
 def fit(curveType, curvePoints):
@@ -79,7 +84,7 @@ class ZeroLinearCurve(Curve):
     def fit(self, xs, ys):
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            self.gradient, self.intercept, self.rValue = scipy.stats.linregress(xs, ys)[:3]
+            self.gradient, self.intercept, self.rValue = stats.linregress(xs, ys)[:3]
 
     def interpolate(self, x):
         if x > 0:
@@ -124,7 +129,7 @@ class ZeroLogisticCurve(Curve):
         # Fit a line to the transformed points
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            gradient, intercept, self.rValue, pValue, standardError = scipy.stats.linregress(xs, transformedYs)
+            gradient, intercept, self.rValue, pValue, standardError = stats.linregress(xs, transformedYs)
         # Find the logistic function
         self.baseFactor = math.exp(intercept)
         self.exponentFactor = gradient
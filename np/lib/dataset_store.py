@@ -5,21 +5,22 @@ from sqlalchemy import orm
 import re
 import os
 import csv
+import json
 import math
 import numpy
-import osgeo.ogr
-import osgeo.osr
+import shutil
+import hashlib
 import geojson
 import itertools
 import collections
-import shapely.geometry
+from decorator import decorator
 # Import custom modules
-from np.lib import store, geometry_store
+from np.lib import store, geometry_store, column_store, cluster_store, snapshot_store, tile_store, cache_store, geojson_store, metric
 from np.lib import variable_store as VS
 
 
-def create(targetPath, sourcePath):
-    'Import the sourcePath to create the dataset'
+def create(targetPath, sourcePath, progressCallback=None):
+    'Import the sourcePath to create the dataset; progressCallback(nodeCount, totalCount) reports progress'
     # Initialize
     digestByExtension = {
         '.csv': digestNodesFromCSV,
@@ -34,39 +35,175 @@ def create(targetPath, sourcePath):
     # Save
     store.removeSafely(store.replaceFileExtension(targetPath, 'db'))
     dataset = Store(targetPath, proj4)
-    dataset.addNodes(nodePacks)
+    dataset.addNodes(nodePacks, progressCallback)
     # Return
     return dataset
 
 
-def load(datasetPath):
+def load(datasetPath, profile=None):
     'Load the given dataset'
-    return Store(datasetPath)
+    return Store(datasetPath, profile=profile)
+
+
+def loadSnapshot(datasetPath):
+    'Load the snapshot of a computed dataset without opening the database'
+    return snapshot_store.load(store.replaceFileExtension(datasetPath, 'snapshot'))
+
+
+def migrate(datasetPath):
+    'Bring an existing dataset up to the current schema'
+    dataset = Store(datasetPath)
+    dataset.ensureIndexes()
+    return dataset
+
+
+def processCached(datasetPath, resultCache, metricModel, metricValueByOptionBySection, networkModel, networkValueByOptionBySection, jobLogger=None):
+    """
+    Run Store.process unless resultCache, a cache_store.Cache, has the result for the same nodes, models and configuration,
+    in which case replace the dataset with the cached one; return the dataset with the outputs of each phase
+    """
+    dataset = load(datasetPath)
+    resultKey = dataset.getResultKey(metricModel, metricValueByOptionBySection, networkModel, networkValueByOptionBySection)
+    # Copy the database file because SQLite changes it in place;
+    # link the rest because we replace those folders instead of changing them
+    resultPathByName = dict((x, store.replaceFileExtension(dataset.getDatasetPath(), x)) for x in resultExtensions)
+    resultLinkNames = resultExtensions[1:]
+    # If we have a cached result,
+    if resultCache.has(resultKey):
+        dataset.checkpointLog()
+        dataset.close()
+        invalidate(datasetPath)
+        outputs = resultCache.load(resultKey, resultPathByName, resultLinkNames)
+        dataset = load(datasetPath)
+        # Remove caches derived from the previous contents
+        store.removeFolderSafely(dataset.getLevelOfDetailPath())
+        store.removeSafely(dataset.getMetricStatisticsPath())
+        return dataset, outputs
+    # Otherwise, compute and cache the result
+    outputs = dataset.process(metricModel, metricValueByOptionBySection, networkModel, networkValueByOptionBySection, jobLogger)
+    dataset.checkpointLog()
+    resultCache.save(resultKey, dict((name, path) for name, path in resultPathByName.iteritems() if os.path.exists(path)), outputs, resultLinkNames)
+    return dataset, outputs
+
+
+def invalidate(datasetPath):
+    'Drop the cached engine and metadata of a dataset, such as after replacing its file'
+    engineCache.invalidate(store.replaceFileExtension(datasetPath, 'db'))
+
+
+def closeAll():
+    'Drop every cached engine'
+    engineCache.clear()
+
+
+@decorator
+def usingWriteProfile(method, self, *args, **kwargs):
+    'Run a heavy write phase of a Store under its write profile'
+    previousProfile = self.setProfile(self.writeProfile)
+    try:
+        return method(self, *args, **kwargs)
+    finally:
+        self.setProfile(previousProfile)
 
 
 class Store(object):
     'Dataset wrapper'
 
     debug = False
-
-    def __init__(self, datasetPath, proj4=None):
-        # Connect
+    chunkSize = 10000
+    # Keep pickled node outputs alongside the columns for older readers
+    savePickledOutputs = True
+    # Use connection profiles from pragmasByProfile
+    profile = 'serve'
+    writeProfile = 'bulk-write'
+    # Set by summarizeConnections during a pass over nodes
+    connectionSummaryByNodeID = None
+    # Serve clusters up to this zoom level; beyond it, use yieldGeoJSON with a bbox
+    maximumDetailZoom = 10
+    # Save getMetricStatistics until outputs change
+    cacheStatistics = True
+    # Resolve relative paths such as existing networks from here instead of the dataset folder, as tiles do
+    basePath = None
+    # Start getNearestNodes with a box this many degrees from the point
+    nearestNodeRadius = 0.01
+    # Save a memory-mapped snapshot after computing outputs and serve reads from it;
+    # snapshotPropertyNames=None includes every property in nodePropertyByName
+    useSnapshot = True
+    snapshotPropertyNames = None
+
+    def __init__(self, datasetPath, proj4=None, profile=None):
+        # Connect using the engine cache
         datasetPath = store.replaceFileExtension(datasetPath, 'db')
-        engine = sa.create_engine('sqlite:///' + datasetPath, echo=self.debug)
-        metadata.create_all(engine)
+        if profile:
+            self.profile = profile
+        engineEntry = engineCache.get(datasetPath, self.debug)
+        makeSession = orm.sessionmaker(bind=engineEntry.engine)
+        sa.event.listen(makeSession, 'after_begin', self.applyProfile)
         # Set
-        self.session = orm.sessionmaker(bind=engine)()
+        self.session = makeSession()
         self.datasetPath = datasetPath
         # Set proj4
         if proj4:
             self.session.execute(spatial_references_table.delete())
             self.session.add(SpatialReference(proj4))
             self.session.commit()
-        self.proj4 = str(self.session.query(SpatialReference).first().proj4)
-        self.transform_point = geometry_store.get_transform_point(self.proj4)
+            engineEntry.setProj4(proj4)
+        self.proj4 = engineEntry.proj4
+        self.transform_point = engineEntry.transform_point
+        self.transform_points = engineEntry.transform_points
+
+    def applyProfile(self, session, transaction, connection):
+        'Apply our profile when a transaction begins because connections start with the default profile'
+        if self.profile != Store.profile:
+            applyPragmas(connection.connection, pragmasByProfile[self.profile])
+
+    def close(self):
+        'Close the session; the engine stays in the engine cache until invalidate or closeAll'
+        self.session.close()
 
     def getBasePath(self):
-        return os.path.dirname(self.getDatasetPath())
+        return self.basePath or os.path.dirname(self.getDatasetPath())
+
+    def ensureIndexes(self):
+        'Create secondary indexes that are missing; we create them after bulk loads because maintaining them during inserts is slower'
+        connection = self.session.connection()
+        for indexName, tableName, columnNames in indexPacks:
+            connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (indexName, tableName, ', '.join(columnNames)))
+        self.ensureSpatialIndexes()
+        self.session.commit()
+
+    def ensureSpatialIndexes(self):
+        'Create R*Tree tables if SQLite has the module and add the nodes and segments saved since the last call'
+        connection = self.session.connection()
+        try:
+            for tableName, selectSQL in spatialIndexPacks:
+                connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING rtree(id, minimum_longitude, maximum_longitude, minimum_latitude, maximum_latitude)' % tableName)
+        except sa.exc.OperationalError:
+            # SQLite was built without the R*Tree module, so bbox queries use ix_nodes_longitude_latitude
+            return
+        # Nodes and segments only get appended, so add rows past the last id
+        for tableName, selectSQL in spatialIndexPacks:
+            connection.execute('INSERT INTO %s %s > (SELECT coalesce(max(id), 0) FROM %s)' % (tableName, selectSQL, tableName))
+
+    def hasSpatialIndex(self):
+        'Return True if ensureSpatialIndexes created the R*Tree tables'
+        return self.session.execute(sa.text("SELECT count(*) FROM sqlite_master WHERE name IN ('node_rtree', 'segment_rtree')")).scalar() == len(spatialIndexPacks)
+
+    def getQueryPlan(self, query):
+        'Return the steps that SQLite would take to run the query'
+        statement = getattr(query, 'statement', query)
+        compiledStatement = statement.compile(bind=self.session.bind)
+        parameters = [compiledStatement.params[x] for x in compiledStatement.positiontup]
+        return [str(x[-1]) for x in self.session.connection().execute('EXPLAIN QUERY PLAN ' + str(compiledStatement), *parameters)]
+
+    def setProfile(self, profile):
+        'Apply the pragmas of a connection profile and return the previous profile'
+        if profile not in pragmasByProfile:
+            raise DatasetError('Connection profile must be one of: ' + ' '.join(sorted(pragmasByProfile)))
+        previousProfile, self.profile = self.profile, profile
+        # Apply to the current connection; later transactions pick up the profile in applyProfile
+        applyPragmas(self.session.connection().connection, pragmasByProfile[profile])
+        return previousProfile
 
     def getDatasetPath(self):
         return self.datasetPath
@@ -83,26 +220,73 @@ class Store(object):
         # Add the node
         node = Node(coordinates, (longitude, latitude), nodePack, is_fake)
         self.session.add(node)
+        # Make getSummary count the node
+        self.session.flush()
+        self.clearSummary()
         # Return
         return node
 
-    def addNodes(self, nodePacks):
-        # Check for duplicates
-        nodePacksByCoordinates = collections.defaultdict(list)
-        for nodePack in nodePacks:
-            coordinates = float(nodePack['x']), float(nodePack['y'])
-            nodePacksByCoordinates[coordinates].append(nodePack)
-        # For each row,
-        for coordinates, nodePacks in nodePacksByCoordinates.iteritems():
-            # If there are duplicates,
-            if len(nodePacks) > 1:
-                print 'Duplicate nodes' 
-                for nodePack in nodePacks:
-                    print '(%s) %s' % (str(coordinates), nodePack)
-            # Add
-            self.addNode(coordinates, nodePacks[0])
-        # Commit
-        self.session.commit()
+    @usingWriteProfile
+    def addNodes(self, nodePacks, progressCallback=None):
+        """
+        Add nodes from a list or generator in chunks, skipping nodes whose coordinates we have already seen.
+        progressCallback(nodeCount, totalCount) runs after each chunk; totalCount is None for generators.
+        """
+        # Initialize
+        totalCount = len(nodePacks) if hasattr(nodePacks, '__len__') else None
+        nodePacks = iter(nodePacks)
+        nodeCount = 0
+        connection = self.session.connection()
+        # Remember coordinates in an indexed temporary table instead of in memory
+        connection.execute('DROP TABLE IF EXISTS temp.node_coordinates')
+        connection.execute('CREATE TEMPORARY TABLE node_coordinates (position INTEGER PRIMARY KEY, x REAL, y REAL, UNIQUE (x, y))')
+        try:
+            # For each chunk,
+            while True:
+                nodePackChunk = list(itertools.islice(nodePacks, self.chunkSize))
+                if not nodePackChunk:
+                    break
+                chunkCoordinates = [(float(x['x']), float(x['y'])) for x in nodePackChunk]
+                # Keep the first node at each coordinate
+                connection.execute(sa.text('INSERT OR IGNORE INTO node_coordinates (position, x, y) VALUES (:position, :x, :y)'), [dict(
+                    position=nodeCount + chunkIndex, 
+                    x=x, 
+                    y=y,
+                ) for chunkIndex, (x, y) in enumerate(chunkCoordinates)])
+                firstPositions = set(x[0] for x in connection.execute(sa.text('SELECT position FROM node_coordinates WHERE position >= :position'), position=nodeCount))
+                chunkIndices = []
+                for chunkIndex, nodePack in enumerate(nodePackChunk):
+                    if nodeCount + chunkIndex in firstPositions:
+                        chunkIndices.append(chunkIndex)
+                    else:
+                        print 'Duplicate node' 
+                        print '(%s) %s' % (str(chunkCoordinates[chunkIndex]), nodePack)
+                # Transform coordinates in one call
+                chunkXYs = numpy.array([chunkCoordinates[x] for x in chunkIndices], dtype=float).reshape(-1, 2)
+                chunkCommonCoordinates = itertools.izip(*self.transform_points(chunkXYs[:, 0], chunkXYs[:, 1]))
+                # Insert
+                if chunkIndices:
+                    connection.execute(nodes_table.insert(), [dict(
+                        x=chunkCoordinates[chunkIndex][0], 
+                        y=chunkCoordinates[chunkIndex][1], 
+                        longitude=longitude, 
+                        latitude=latitude, 
+                        is_fake=False, 
+                        input=nodePackChunk[chunkIndex],
+                    ) for chunkIndex, (longitude, latitude) in itertools.izip(chunkIndices, chunkCommonCoordinates)])
+                # Report
+                nodeCount += len(nodePackChunk)
+                if progressCallback:
+                    progressCallback(nodeCount, totalCount)
+            # Commit
+            self.session.commit()
+        finally:
+            self.session.connection().execute('DROP TABLE IF EXISTS temp.node_coordinates')
+        self.clearOutputColumns()
+        self.invalidateOutputCaches()
+        self.clearCheckpoints()
+        # Index after loading rather than during
+        self.ensureIndexes()
 
     def addNodesFromNodeDict(self, nodeDict):
         """
@@ -124,38 +308,76 @@ class Store(object):
             self.session.add(newNode)
 
         self.session.commit()
+        # Read outputs from the pickled view that we just saved
+        self.clearOutputColumns()
+        self.invalidateOutputCaches()
 
 
     def countNodes(self):
         return self.session.query(Node).filter_by(is_fake=False).count()
 
-    def cycleNodes(self, isFake=False):
-        'Return nodes in dataset one at a time; set isFake=True to return fake nodes'
+    def cycleNodes(self, isFake=False, loadPickles=False):
+        """
+        Return nodes in dataset one at a time in batches of Store.chunkSize; set isFake=True to return fake nodes.
+        Set loadPickles=True if you need node.input or node.output, which are otherwise loaded one node at a time.
+        """
+        nodeQuery = self.session.query(Node).filter_by(is_fake=isFake).order_by(Node.id)
+        if loadPickles:
+            nodeQuery = nodeQuery.options(orm.undefer_group('pickled'))
         # For each node,
-        for node in self.session.query(Node).filter_by(is_fake=isFake).order_by(Node.id):
-            # If the node does not have the desired spatial reference,
+        for node in nodeQuery.yield_per(self.chunkSize):
             yield node
 
+    def queryNodesInBBox(self, bbox, isFake=False):
+        """
+        Return a query for nodes inside bbox, using the R*Tree if we have one; set isFake=None for real and fake nodes.
+        bbox is (minimum longitude, minimum latitude, maximum longitude, maximum latitude).
+        """
+        minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bbox
+        nodeQuery = self.session.query(Node).filter(Node.longitude.between(minimumLongitude, maximumLongitude)).filter(Node.latitude.between(minimumLatitude, maximumLatitude))
+        if isFake is not None:
+            nodeQuery = nodeQuery.filter(Node.is_fake == isFake)
+        if self.hasSpatialIndex():
+            nodeQuery = nodeQuery.filter(Node.id.in_(selectRTreeIDs(node_rtree_table, bbox)))
+        return nodeQuery
+
+    def getNearestNodes(self, longitude, latitude, count=1, isFake=False):
+        'Return up to count nodes nearest to the longitude and latitude by planar distance in degrees'
+        computeDistance = lambda node: math.hypot(node.longitude - longitude, node.latitude - latitude)
+        radius = self.nearestNodeRadius
+        # Widen the search until the box holds enough nodes within radius, which guarantees that no node outside is nearer
+        while True:
+            nodes = self.queryNodesInBBox((longitude - radius, latitude - radius, longitude + radius, latitude + radius), isFake).all()
+            if len([x for x in nodes if computeDistance(x) <= radius]) >= count or radius >= 360:
+                return sorted(nodes, key=computeDistance)[:count]
+            radius *= 4
+
     def getNodeStatistics(self):
-        maxLongitude, meanLongitude, minLongitude, maxLatitude, meanLatitude, minLatitude = self.session.query(sa.func.max(Node.longitude), sa.func.avg(Node.longitude), sa.func.min(Node.longitude), sa.func.max(Node.latitude), sa.func.avg(Node.latitude), sa.func.min(Node.latitude)).first()
-        return {
-            'node count': self.session.query(Node).filter_by(is_fake=False).count(),
-            'maximum longitude': maxLongitude,
-            'mean longitude': meanLongitude,
-            'minimum longitude': minLongitude,
-            'maximum latitude': maxLatitude,
-            'mean latitude': meanLatitude,
-            'minimum latitude': minLatitude,
-        }
+        return dict((x, self.getSummary()[x]) for x in nodeStatisticNames)
 
     def saveNodesSHP(self, targetPath, isFake=False):
-        'Save nodes to a shapefile'
-        geometry_store.save(store.replaceFileExtension(targetPath, 'shp'), self.getProj4(), [shapely.geometry.asShape(node) for node in self.cycleNodes(isFake)])
+        'Save nodes to a shapefile with their metric and, for real nodes, the output properties in nodePropertyByName'
+        ogr = geometry_store.ogr
+        # Prepare fields
+        outputColumns = None if isFake else self.getOutputColumns()
+        outputPacks = [(propertyName, outputColumns.getColumn(*nodePropertyByName[propertyName])) for propertyName in sorted(nodePropertyByName) if outputColumns and outputColumns.has(*nodePropertyByName[propertyName])]
+        fieldDefinitions = [('id', ogr.OFTInteger), ('metric', ogr.OFTReal)] + [(propertyName, getFieldType(column)) for propertyName, column in outputPacks]
+        # Stream nodes in batches
+        def yieldFeaturePacks():
+            connection = self.session.connection().execution_options(stream_results=True)
+            nodeQuery = sa.select([nodes_table.c.id, nodes_table.c.x, nodes_table.c.y, nodes_table.c.metric]).where(nodes_table.c.is_fake == isFake).order_by(nodes_table.c.id)
+            for rows in yieldChunks(connection.execute(nodeQuery), self.chunkSize):
+                nodeIndices = outputColumns.getNodeIndices([x[0] for x in rows]) if outputPacks else []
+                for rowIndex, (nodeID, x, y, nodeMetric) in enumerate(rows):
+                    # Leave properties unset for nodes without outputs, such as nodes that we added after applyMetric
+                    nodeIndex = nodeIndices[rowIndex] if outputPacks else -1
+                    yield (x, y), [nodeID, nodeMetric] + [column[nodeIndex].item() if nodeIndex >= 0 else None for propertyName, column in outputPacks]
+        geometry_store.save_features(store.replaceFileExtension(targetPath, 'shp'), self.getProj4(), 'Point', yieldFeaturePacks(), fieldDefinitions)
 
     def saveNodesCSV(self, targetPath, isFake=False):
         'Save nodes to a csv'
         # Initialize
-        node = self.cycleNodes(isFake).next()
+        node = self.cycleNodes(isFake, loadPickles=True).next()
         csvWriter = csv.writer(open(store.replaceFileExtension(targetPath, 'csv'), 'wb'))
         # Write spatial reference
         csvWriter.writerow(['PROJ.4 ' + self.getProj4()])
@@ -163,48 +385,244 @@ class Store(object):
         customHeaders = sorted(set(node.input) - set(['name', 'x', 'y']))
         csvWriter.writerow(['Name', 'X', 'Y'] + [x.capitalize() for x in customHeaders])
         # For each node,
-        for node in self.cycleNodes(isFake):
+        for node in self.cycleNodes(isFake, loadPickles=True):
             # Write row
             csvWriter.writerow([node.input.get('name', ''), node.getX(), node.getY()] + [node.input.get(x, '') for x in customHeaders])
 
     # Metric
+    @usingWriteProfile
     def applyMetric(self, metricModel, metricValueByOptionBySection):
         'Compute a metric for each node'
         # Load job-level configuration
         jobVS = metricModel.VariableStore(metricValueByOptionBySection)
-        # For each real node,
-        for node in self.session.query(Node).filter_by(is_fake=False):
+        columnWriter = column_store.Writer()
+        # For each real node, loading inputs with the rest of each batch
+        for node in self.cycleNodes(loadPickles=True):
             # Load node-level configuration
             nodeVS = metricModel.VariableStore(node.getValueByOptionBySection(), jobVS)
             # Save results
             node.metric = nodeVS.get(metricModel.Metric)
-            node.output = nodeVS.getValueByOptionBySection()
+            nodeOutput = nodeVS.getValueByOptionBySection()
+            columnWriter.add(node.id, nodeOutput)
+            if self.savePickledOutputs:
+                node.output = nodeOutput
         # Commit
         self.session.commit()
+        columnWriter.save(self.getOutputColumnsPath())
+        self.invalidateOutputCaches()
+        self.clearCheckpoints('applyMetric')
+        # Keep the outputs that updateMetric replaces so that we can run it again or merge tiles
+        copyFolder(self.getOutputColumnsPath(), self.getAppliedOutputColumnsPath())
+        if self.useSnapshot:
+            self.saveSnapshot()
         # Return outputs
         return jobVS.getValueByOptionBySection()
 
     def getMetricStatistics(self):
-        'Compute metric statistics'
-        # Prepare metrics
-        metrics = [x[0] for x in self.session.query(Node.metric).filter_by(is_fake=False)]
-        # Aggregate
-        populations = []
-        countBySystem = collections.defaultdict(int)
-        for node in self.cycleNodes():
-            nodeOutput = node.output
-            countBySystem[nodeOutput['metric']['system']] += 1
-            populations.append(int(nodeOutput['demographics']['population count']))
-        # Process
-        populations1, populations2 = store.splitList(populations, 2)
+        'Compute metric statistics, reusing the saved result until outputs change if cacheStatistics is true'
+        statisticsPath = self.getMetricStatisticsPath()
+        if self.cacheStatistics and os.path.exists(statisticsPath):
+            return json.load(open(statisticsPath, 'rt'))
+        # If we have a snapshot, read it instead
+        snapshot = self.getSnapshot()
+        if snapshot:
+            statistics = snapshot.getMetricStatistics()
+        else:
+            # Get metric aggregates from the summary
+            summary = self.getSummary()
+            # Load systems and populations as arrays
+            outputColumns = self.getOutputColumns()
+            if outputColumns:
+                systems = outputColumns.getColumn('metric', 'system')
+                populations = outputColumns.getColumn('demographics', 'population count')
+            else:
+                systems, populations = [], []
+                for node, (system, population) in self.cycleNodeOutputValues([('metric', 'system'), ('demographics', 'population count')]):
+                    systems.append(system)
+                    populations.append(int(population))
+            statistics = dict((x, summary[x]) for x in metricStatisticNames)
+            statistics.update(column_store.summarizeOutputs(systems, populations))
+        # Save
+        if self.cacheStatistics:
+            json.dump(statistics, open(statisticsPath, 'wt'))
         # Return
-        return {
-            'minimum metric': min(metrics),
-            'maximum metric': max(metrics),
-            'mean metric': numpy.mean(metrics),
-            'count by system': countBySystem,
-            'population quartiles': [numpy.median(populations1), numpy.median(populations), numpy.median(populations2)],
+        return statistics
+
+    def getMetricStatisticsPath(self):
+        return store.replaceFileExtension(self.datasetPath, 'statistics.json')
+
+    # Output columns
+
+    def getOutputColumnsPath(self):
+        return store.replaceFileExtension(self.datasetPath, 'columns')
+
+    def clearOutputColumns(self):
+        'Remove the output columns after the nodes change so that they do not describe other nodes'
+        store.removeFolderSafely(self.getOutputColumnsPath())
+
+    def getOutputColumns(self):
+        'Return a column_store.Reader for node outputs or None if we only have pickled outputs'
+        outputColumnsPath = self.getOutputColumnsPath()
+        if not os.path.exists(os.path.join(outputColumnsPath, column_store.indexName)):
+            return None
+        return column_store.Reader(outputColumnsPath)
+
+    def getAppliedOutputColumnsPath(self):
+        return os.path.join(self.getCheckpointPath('applyMetric'), 'columns')
+
+    def getAppliedOutputColumns(self):
+        'Return a column_store.Reader for node outputs as applyMetric left them or None if we do not have them'
+        appliedOutputColumnsPath = self.getAppliedOutputColumnsPath()
+        if not os.path.exists(os.path.join(appliedOutputColumnsPath, column_store.indexName)):
+            return None
+        return column_store.Reader(appliedOutputColumnsPath)
+
+    def getNodeOutput(self, node, outputColumns=None):
+        'Return the output of a node from the columns if we have them, otherwise from the pickled view'
+        outputColumns = outputColumns or self.getOutputColumns()
+        return outputColumns.getValueByOptionBySection(node.id) if outputColumns else node.output
+
+    def cycleNodeOutputValues(self, sectionOptions, isFake=False):
+        'Generate each node with the output values for the given section, option pairs, reading only those columns'
+        outputColumns = self.getOutputColumns()
+        # If we only have pickled outputs,
+        if not outputColumns:
+            for node in self.cycleNodes(isFake, loadPickles=True):
+                nodeOutput = node.output
+                yield node, [nodeOutput[section][option] for section, option in sectionOptions]
+            return
+        # Otherwise, read the columns
+        columns = [outputColumns.getColumn(section, option) for section, option in sectionOptions]
+        for node in self.cycleNodes(isFake):
+            nodeIndex = outputColumns.getNodeIndex(node.id)
+            yield node, [column_store.formatValue(x[nodeIndex]) for x in columns]
+
+    def invalidateOutputCaches(self):
+        'Remove caches derived from nodes, segments or outputs and recompute the summary; every write phase calls this at the end'
+        store.removeFolderSafely(self.getLevelOfDetailPath())
+        store.removeSafely(self.getMetricStatisticsPath())
+        store.removeFolderSafely(self.getSnapshotPath())
+        self.summarize()
+
+    # Summary
+
+    def summarize(self):
+        'Compute node, metric and network statistics in one pass over each table and save them in the summaries table'
+        connection = self.session.connection()
+        # Aggregate nodes
+        isReal = nodes_table.c.is_fake == False
+        nodeCount, maxLongitude, meanLongitude, minLongitude, maxLatitude, meanLatitude, minLatitude, minMetric, maxMetric, meanMetric = connection.execute(sa.select([
+            sa.func.sum(sa.case([(isReal, 1)], else_=0)),
+            sa.func.max(nodes_table.c.longitude), sa.func.avg(nodes_table.c.longitude), sa.func.min(nodes_table.c.longitude),
+            sa.func.max(nodes_table.c.latitude), sa.func.avg(nodes_table.c.latitude), sa.func.min(nodes_table.c.latitude),
+            sa.func.min(sa.case([(isReal, nodes_table.c.metric)])), sa.func.max(sa.case([(isReal, nodes_table.c.metric)])), sa.func.avg(sa.case([(isReal, nodes_table.c.metric)])),
+        ])).first()
+        # Aggregate segments
+        segmentCount, newSegmentWeight, oldSegmentWeight = connection.execute(sa.select([
+            sa.func.count(segments_table.c.node1_id),
+            sa.func.sum(sa.case([(segments_table.c.is_existing == False, segments_table.c.weight)], else_=0)),
+            sa.func.sum(sa.case([(segments_table.c.is_existing == True, segments_table.c.weight)], else_=0)),
+        ])).first()
+        summary = {
+            'node count': nodeCount or 0,
+            'maximum longitude': maxLongitude,
+            'mean longitude': meanLongitude,
+            'minimum longitude': minLongitude,
+            'maximum latitude': maxLatitude,
+            'mean latitude': meanLatitude,
+            'minimum latitude': minLatitude,
+            'minimum metric': minMetric,
+            'maximum metric': maxMetric,
+            'mean metric': meanMetric,
+            'segment count': segmentCount,
+            'new segment weight': newSegmentWeight or 0,
+            'old segment weight': oldSegmentWeight or 0,
         }
+        # Save
+        connection.execute(summaries_table.delete().where(summaries_table.c.name == 'dataset'))
+        connection.execute(summaries_table.insert(), name='dataset', value=json.dumps(summary))
+        self.session.commit()
+        return summary
+
+    def clearSummary(self):
+        'Remove the saved summary in the current transaction so that getSummary computes it again'
+        self.session.execute(summaries_table.delete().where(summaries_table.c.name == 'dataset'))
+
+    def getSummary(self):
+        'Return the saved summary in one lookup, computing it if no write phase has saved one since the nodes changed'
+        value = self.session.execute(sa.select([summaries_table.c.value]).where(summaries_table.c.name == 'dataset')).scalar()
+        return json.loads(value) if value else self.summarize()
+
+    # Snapshot
+
+    def getSnapshotPath(self):
+        return store.replaceFileExtension(self.datasetPath, 'snapshot')
+
+    def getSnapshot(self):
+        'Return a snapshot_store.Snapshot if useSnapshot is true and nothing changed since we saved it, otherwise None'
+        snapshotPath = self.getSnapshotPath()
+        if not self.useSnapshot or not snapshot_store.has(snapshotPath):
+            return None
+        return snapshot_store.load(snapshotPath)
+
+    def saveSnapshot(self):
+        'Save nodes, segments and selected node outputs as aligned arrays for fast reloads'
+        connection = self.session.connection()
+        # Load nodes in id order
+        nodeArrayByName = makeArrayByName(connection.execute(sa.select([nodes_table.c[x] for x in snapshot_store.nodeFieldNames]).order_by(nodes_table.c.id)), [
+            ('id', numpy.int64),
+            ('x', float),
+            ('y', float),
+            ('longitude', float),
+            ('latitude', float),
+            ('metric', float),
+            ('is_fake', bool),
+        ])
+        # Load segments
+        segmentArrayByName = makeArrayByName(connection.execute(sa.select([segments_table.c[x] for x in snapshot_store.segmentFieldNames])), [
+            ('node1_id', numpy.int64),
+            ('node2_id', numpy.int64),
+            ('subnet_id', numpy.int64),
+            ('is_existing', bool),
+            ('weight', float),
+        ])
+        # Copy output columns, which are in id order for real nodes
+        outputPacks = []
+        outputColumns = self.getOutputColumns()
+        if outputColumns:
+            if not numpy.array_equal(outputColumns.nodeIDs, nodeArrayByName['id'][~nodeArrayByName['is_fake']]):
+                raise DatasetError('Output columns do not match nodes')
+            for propertyName in self.snapshotPropertyNames or sorted(nodePropertyByName):
+                section, option = parseNodePropertyName(propertyName)
+                if outputColumns.has(section, option):
+                    outputPacks.append((propertyName, section, option, outputColumns.getColumn(section, option)))
+        # Save
+        snapshot_store.save(self.getSnapshotPath(), self.getProj4(), nodeArrayByName, segmentArrayByName, outputPacks)
+
+    # Level of detail
+
+    def getLevelOfDetailPath(self):
+        return store.replaceFileExtension(self.datasetPath, 'lod')
+
+    def buildLevelsOfDetail(self):
+        'Precompute node clusters and simplified subnets for each zoom level up to maximumDetailZoom'
+        longitudes, latitudes, populations, systems = [], [], [], []
+        for node, (population, system) in self.cycleNodeOutputValues([('demographics', 'population count'), ('metric', 'system')]):
+            longitudes.append(node.longitude)
+            latitudes.append(node.latitude)
+            populations.append(float(population))
+            systems.append(system)
+        subnetPacks = list(self.cycleSubnetCoordinates(isCommon=True))
+        cluster_store.save(self.getLevelOfDetailPath(), cluster_store.build(longitudes, latitudes, populations, systems, subnetPacks, self.maximumDetailZoom))
+
+    def exportLevelOfDetailGeoJSON(self, zoom):
+        'Return clustered nodes and simplified subnets for the zoom level as a GeoJSON string'
+        if not 0 <= zoom <= self.maximumDetailZoom:
+            raise DatasetError('Zoom must be between 0 and %s; use yieldGeoJSON with a bbox for closer views' % self.maximumDetailZoom)
+        levelOfDetailPath = self.getLevelOfDetailPath()
+        if not cluster_store.has(levelOfDetailPath, zoom):
+            self.buildLevelsOfDetail()
+        return cluster_store.load(levelOfDetailPath, zoom)
 
     def saveMetricsCSV(self, targetPath, metricModel, headerType=VS.HEADER_TYPE_SECTION_OPTION):
         'Save node-level metrics in CSV format'
@@ -214,19 +632,13 @@ class Store(object):
 
         # Prepare column headers in order
         # Use the 1st node's input to get the "pass-through" fields 
-        node = self.cycleNodes().next()
+        node = self.cycleNodes(loadPickles=True).next()
         nodeInput = node.input
         headerPacks = [('', key) for key in sorted(nodeInput)]
 
         # get the section/option values in order from the model
         # and append to the headerPacks
-        # Note:  metricModel.VariableStore.variableClasses should have all the
-        #        the variableClasses associated with the model as long as 
-        #        metricModel.VariableStore() has been called.
-        baseVars = metricModel.VariableStore.variableClasses
-        baseVarHeaders = [(var.section, var.option) for var in 
-                          sorted(baseVars, key=lambda v: (v.section, v.option))]
-        headerPacks.extend(baseVarHeaders)
+        headerPacks.extend(metric.getVariableClassIndex(metricModel).sectionOptions)
         headerPacksToNames = VS.getFieldNamesForHeaderPacks(metricModel, 
                                 headerPacks, headerType)
        
@@ -238,47 +650,243 @@ class Store(object):
     
         # csvWriter.writerow(['%s > %s' % (section.capitalize(), option.capitalize()) if section else option.capitalize() for section, option in headerPacks])
         # For each node,
-        for node in self.cycleNodes():
+        outputColumns = self.getOutputColumns()
+        for node in self.cycleNodes(loadPickles=True):
             # Write row
-            csvWriter.writerow([node.output.get(section, {}).get(option, '') if section else node.input.get(option, '') for section, option in headerPacks])
+            nodeOutput = self.getNodeOutput(node, outputColumns)
+            csvWriter.writerow([nodeOutput.get(section, {}).get(option, '') if section else node.input.get(option, '') for section, option in headerPacks])
 
     # Network
-    def buildNetwork(self, networkModel, networkValueByOptionBySection, jobLogger=None):
-        'Build a network using the nodes and network building algorithm'
+    @usingWriteProfile
+    def buildNetwork(self, networkModel, networkValueByOptionBySection, jobLogger=None, checkpoint=None):
+        'Build a network using the nodes and network building algorithm; checkpoint is a NetworkCheckpoint from process'
         # Load job-level configuration
         # NOTE:  state[0] is the current dataset_store which is used in the network
         #        model to retrieve the basePath of the archive.
         #        This seems like an anti-pattern, coupling the dataset_store to the 
         #        network model in a non-transparent way. 
         jobVS = networkModel.VariableStore(networkValueByOptionBySection, state=[self])
-        # Build network
-        net = jobVS.buildNetworkFromNodes(list(self.cycleNodes()), self.getProj4(), jobLogger=jobLogger)
-        # For each subnet in the generated network,
-        for networkSubnet in net.cycleSubnets():
-            # Create the subnet in our dataset
-            datasetSubnet = Subnet()
-            self.session.add(datasetSubnet)
-            self.session.commit()
-            # For each segment in the subnetwork,
+        # Build network, loading nodes from the snapshot if we have one
+        snapshot = self.getSnapshot()
+        nodes = list(snapshot.cycleNodes() if snapshot else self.cycleNodes())
+        net = jobVS.buildNetworkFromNodes(nodes, self.getProj4(), jobLogger=jobLogger, checkpoint=checkpoint)
+        # Save network
+        self.saveNetwork(net)
+        self.clearCheckpoints('buildNetwork')
+        # Return outputs
+        return jobVS.getValueByOptionBySection()
+
+    def saveNetwork(self, net):
+        'Save the subnets, segments and fake nodes of a network in one transaction'
+        # Gather fake nodes, which have negative ids until we save them
+        networkSubnets = list(net.cycleSubnets())
+        fakeNodeByObjectID = collections.OrderedDict()
+        for networkSubnet in networkSubnets:
             for networkSegment in networkSubnet.cycleSegments():
-                # Save fake nodes if we have any
-                for networkNode in (x for x in networkSegment.getNodes() if x.getID() < 0):
-                    # Create the fake node in our dataset
-                    datasetNode = self.addNode(networkNode.getCoordinates(), is_fake=True)
-                    self.session.add(datasetNode)
-                    self.session.commit()
-                    # Store the id
-                    networkNode.setID(datasetNode.id)
-                # Add segment
-                segment = Segment(*networkSegment.getSortedNodeIDs())
-                segment.subnet_id = datasetSubnet.id
-                segment.is_existing = networkSegment.is_existing
-                segment.weight = networkSegment.getWeight()
-                self.session.add(segment)
+                for networkNode in networkSegment.getNodes():
+                    if networkNode.getID() < 0:
+                        fakeNodeByObjectID.setdefault(id(networkNode), networkNode)
+        fakeNodes = fakeNodeByObjectID.values()
+        # Pre-allocate ids in a block
+        connection = self.session.connection()
+        firstNodeID = (connection.execute(sa.select([sa.func.max(nodes_table.c.id)])).scalar() or 0) + 1
+        firstSubnetID = (connection.execute(sa.select([sa.func.max(subnets_table.c.id)])).scalar() or 0) + 1
+        fakeCoordinates = [x.getCoordinates() for x in fakeNodes]
+        fakeXYs = numpy.array(fakeCoordinates, dtype=float).reshape(-1, 2)
+        fakeCommonCoordinates = itertools.izip(*self.transform_points(fakeXYs[:, 0], fakeXYs[:, 1]))
+        for nodeIndex, networkNode in enumerate(fakeNodes):
+            networkNode.setID(firstNodeID + nodeIndex)
+        # Insert fake nodes
+        insertRows(connection, nodes_table, (dict(
+            id=networkNode.getID(), 
+            x=x, 
+            y=y, 
+            longitude=longitude, 
+            latitude=latitude, 
+            is_fake=True,
+        ) for networkNode, (x, y), (longitude, latitude) in itertools.izip(fakeNodes, fakeCoordinates, fakeCommonCoordinates)), self.chunkSize)
+        # Insert subnets
+        insertRows(connection, subnets_table, (dict(id=firstSubnetID + x) for x in xrange(len(networkSubnets))), self.chunkSize)
+        # Insert segments
+        insertRows(connection, segments_table, (dict(
+            node1_id=node1ID, 
+            node2_id=node2ID, 
+            subnet_id=firstSubnetID + subnetIndex, 
+            is_existing=networkSegment.is_existing, 
+            weight=networkSegment.getWeight(),
+        ) for subnetIndex, networkSubnet in enumerate(networkSubnets) for networkSegment in networkSubnet.cycleSegments() for node1ID, node2ID in [networkSegment.getSortedNodeIDs()]), self.chunkSize)
         # Commit
         self.session.commit()
-        # Return outputs
-        return jobVS.getValueByOptionBySection()
+        self.invalidateOutputCaches()
+        # Index after loading rather than during
+        self.ensureIndexes()
+
+    def clearNetwork(self):
+        'Delete segments, subnets and fake nodes without committing'
+        connection = self.session.connection()
+        connection.execute(segments_table.delete())
+        connection.execute(subnets_table.delete())
+        connection.execute(nodes_table.delete().where(nodes_table.c.is_fake == True))
+        if self.hasSpatialIndex():
+            connection.execute('DELETE FROM node_rtree WHERE id NOT IN (SELECT id FROM nodes)')
+            connection.execute('DELETE FROM segment_rtree')
+
+    # Partition
+
+    def getPartitionPath(self):
+        return store.replaceFileExtension(self.datasetPath, 'tiles')
+
+    def partition(self, method='grid', tileCount=4, bufferSize=0):
+        """
+        Copy real nodes into a tile dataset for each box from tile_store.makeTiles and return the tile paths.
+        Tiles keep the node ids of the dataset and include nodes within bufferSize degrees of the box.
+        If we partitioned before with the same parameters and the boxes still cover every node, reuse the boxes.
+        """
+        connection = self.session.connection()
+        partitionPath = self.getPartitionPath()
+        parameters = dict(method=method, tileCount=tileCount, bufferSize=bufferSize)
+        # Load node coordinates
+        nodeArrayByName = makeArrayByName(connection.execute(sa.select([nodes_table.c.longitude, nodes_table.c.latitude]).where(nodes_table.c.is_fake == False)), [
+            ('longitude', float),
+            ('latitude', float),
+        ])
+        longitudes, latitudes = nodeArrayByName['longitude'], nodeArrayByName['latitude']
+        # Prepare tiles
+        bboxes = None
+        if tile_store.has(partitionPath):
+            partition = tile_store.load(partitionPath)
+            if partition['parameters'] == parameters:
+                bboxes = [tuple(x['bbox']) for x in partition['tiles']]
+                if (tile_store.getOwnerIndices(longitudes, latitudes, bboxes) < 0).any():
+                    bboxes = None
+        if bboxes is None:
+            bboxes = tile_store.makeTiles(longitudes, latitudes, method, tileCount)
+        store.removeFolderSafely(partitionPath)
+        store.makeFolderSafely(partitionPath)
+        # For each tile,
+        tilePacks = []
+        for tileIndex, bbox in enumerate(bboxes):
+            tileName = 'tile%d' % tileIndex
+            bufferedBBox = tile_store.getBufferedBBox(bbox, bufferSize)
+            minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bufferedBBox
+            # Copy nodes with their ids
+            tile = Store(os.path.join(partitionPath, tileName), self.getProj4())
+            nodeQuery = sa.select([nodes_table.c.id, nodes_table.c.x, nodes_table.c.y, nodes_table.c.longitude, nodes_table.c.latitude, nodes_table.c.input]).where(nodes_table.c.is_fake == False)
+            nodeQuery = nodeQuery.where(nodes_table.c.longitude.between(minimumLongitude, maximumLongitude)).where(nodes_table.c.latitude.between(minimumLatitude, maximumLatitude))
+            insertRows(tile.session.connection(), nodes_table, (dict(
+                id=nodeID,
+                x=x,
+                y=y,
+                longitude=longitude,
+                latitude=latitude,
+                is_fake=False,
+                input=nodeInput,
+            ) for nodeID, x, y, longitude, latitude, nodeInput in connection.execute(nodeQuery)), self.chunkSize)
+            tile.session.commit()
+            tile.ensureIndexes()
+            tile.session.close()
+            tilePacks.append(dict(name=tileName, bbox=bbox, bufferedBBox=bufferedBBox))
+        # Record the tiling so that later runs reuse it
+        tile_store.save(partitionPath, dict(parameters=parameters, tiles=tilePacks))
+        return [os.path.join(partitionPath, x['name'] + '.db') for x in tilePacks]
+
+    def loadTiles(self):
+        'Return a Store for each tile from partition'
+        partitionPath = self.getPartitionPath()
+        tiles = [Store(os.path.join(partitionPath, x['name'])) for x in tile_store.load(partitionPath)['tiles']]
+        for tile in tiles:
+            tile.basePath = self.getBasePath()
+        return tiles
+
+    @usingWriteProfile
+    def mergeTiles(self, metricModel, metricValueByOptionBySection):
+        """
+        Replace metrics, outputs and the network with those of the tiles from partition and return the outputs of updateMetric.
+        Each node comes from the tile that owns it and each segment from the tile that owns its midpoint;
+        fake nodes get new ids, new segments that would close a cycle are skipped and subnets are renumbered by connectivity across tiles.
+        Node outputs come from applyMetric on each tile, then updateMetric recomputes systems and aggregates for the merged network.
+        """
+        partitionPath = self.getPartitionPath()
+        partition = tile_store.load(partitionPath)
+        bboxes = [tuple(x['bbox']) for x in partition['tiles']]
+        connection = self.session.connection()
+        self.clearNetwork()
+        nextNodeID = (connection.execute(sa.select([sa.func.max(nodes_table.c.id)])).scalar() or 0) + 1
+        # Prepare updates
+        nodeUpdate = nodes_table.update().where(nodes_table.c.id == sa.bindparam('nodeID'))
+        nodeUpdate = nodeUpdate.values(metric=sa.bindparam('nodeMetric'), output=sa.bindparam('nodeOutput', type_=nodes_table.c.output.type)) if self.savePickledOutputs else nodeUpdate.values(metric=sa.bindparam('nodeMetric'))
+        columnWriter = column_store.Writer()
+        fakeNodePacks, segmentPacks, segmentKeys = [], [], set()
+        components = tile_store.Components()
+        # For each tile,
+        for tileIndex, tile in enumerate(self.loadTiles()):
+            tileOutputColumns = tile.getAppliedOutputColumns()
+            if not tileOutputColumns:
+                raise DatasetError('Run applyMetric on each tile before merging: %s' % tile.getDatasetPath())
+            tileConnection = tile.session.connection()
+            # Copy metrics and outputs of the nodes that the tile owns
+            nodeQuery = sa.select([nodes_table.c.id, nodes_table.c.longitude, nodes_table.c.latitude, nodes_table.c.metric]).where(nodes_table.c.is_fake == False).order_by(nodes_table.c.id)
+            for rows in yieldChunks(tileConnection.execute(nodeQuery), self.chunkSize):
+                ownerIndices = tile_store.getOwnerIndices([x[1] for x in rows], [x[2] for x in rows], bboxes)
+                nodePacks = []
+                for row in itertools.compress(rows, ownerIndices == tileIndex):
+                    nodeOutput = tileOutputColumns.getValueByOptionBySection(row[0])
+                    if nodeOutput:
+                        columnWriter.add(row[0], nodeOutput)
+                    nodePacks.append(dict(nodeID=row[0], nodeMetric=row[3], nodeOutput=nodeOutput))
+                if nodePacks:
+                    connection.execute(nodeUpdate, nodePacks)
+            # Copy segments whose midpoints the tile owns
+            tileFakeNodeIDs = set(x[0] for x in tileConnection.execute(sa.select([nodes_table.c.id]).where(nodes_table.c.is_fake == True)))
+            nodeIDByTileNodeID = {}
+            for rows in yieldChunks(tile.cycleSegmentRows(), self.chunkSize):
+                midpointLongitudes, midpointLatitudes = tile_store.clampToTiles(
+                    numpy.array([(x.longitude1 + x.longitude2) / 2. for x in rows]),
+                    numpy.array([(x.latitude1 + x.latitude2) / 2. for x in rows]), bboxes)
+                ownerIndices = tile_store.getOwnerIndices(midpointLongitudes, midpointLatitudes, bboxes)
+                for row in itertools.compress(rows, ownerIndices == tileIndex):
+                    # Give fake nodes new ids
+                    nodeIDs = []
+                    for tileNodeID, x, y, longitude, latitude in (row.node1_id, row.x1, row.y1, row.longitude1, row.latitude1), (row.node2_id, row.x2, row.y2, row.longitude2, row.latitude2):
+                        if tileNodeID not in nodeIDByTileNodeID:
+                            if tileNodeID in tileFakeNodeIDs:
+                                nodeIDByTileNodeID[tileNodeID] = nextNodeID
+                                fakeNodePacks.append(dict(id=nextNodeID, x=x, y=y, longitude=longitude, latitude=latitude, is_fake=True))
+                                nextNodeID += 1
+                            else:
+                                nodeIDByTileNodeID[tileNodeID] = tileNodeID
+                        nodeIDs.append(nodeIDByTileNodeID[tileNodeID])
+                    # Skip segments that another tile already gave us
+                    segmentKey = tuple(sorted(nodeIDs))
+                    if segmentKey in segmentKeys:
+                        continue
+                    segmentKeys.add(segmentKey)
+                    # Skip new segments that would close a cycle with segments from other tiles
+                    if not components.join(*segmentKey) and not row.is_existing:
+                        continue
+                    segmentPacks.append((segmentKey, row.is_existing, row.weight))
+            tile.session.close()
+        # Renumber subnets by connectivity
+        firstSubnetID = (connection.execute(sa.select([sa.func.max(subnets_table.c.id)])).scalar() or 0) + 1
+        componentIndices = tile_store.labelComponents([x[0] for x in segmentPacks])
+        # Save
+        insertRows(connection, nodes_table, fakeNodePacks, self.chunkSize)
+        insertRows(connection, subnets_table, (dict(id=firstSubnetID + x) for x in xrange(len(set(componentIndices)))), self.chunkSize)
+        insertRows(connection, segments_table, (dict(
+            node1_id=node1ID,
+            node2_id=node2ID,
+            subnet_id=firstSubnetID + componentIndex,
+            is_existing=isExisting,
+            weight=weight,
+        ) for ((node1ID, node2ID), isExisting, weight), componentIndex in itertools.izip(segmentPacks, componentIndices)), self.chunkSize)
+        self.session.commit()
+        columnWriter.save(self.getOutputColumnsPath())
+        self.invalidateOutputCaches()
+        self.clearCheckpoints()
+        copyFolder(self.getOutputColumnsPath(), self.getAppliedOutputColumnsPath())
+        self.ensureIndexes()
+        # Make systems and aggregates agree with the merged network
+        return self.updateMetric(metricModel, metricValueByOptionBySection)
 
     # Segment
 
@@ -298,27 +906,111 @@ class Store(object):
         return self.getSegmentQuery(is_existing).count()
 
     def cycleSegments(self, is_existing=None):
-        'Generate segments'
-        for segment in self.getSegmentQuery(is_existing):
+        'Generate segments in batches of Store.chunkSize; use cycleSegmentRows if you only need coordinates'
+        for segment in self.getSegmentQuery(is_existing).yield_per(self.chunkSize):
             yield segment
 
+    def querySegmentsInBBox(self, bbox, is_existing=None):
+        'Return a query for segments whose bounding boxes intersect bbox, using the R*Tree if we have one'
+        node1, node2 = orm.aliased(Node), orm.aliased(Node)
+        segmentQuery = self.getSegmentQuery(is_existing).join(node1, Segment.node1_id == node1.id).join(node2, Segment.node2_id == node2.id)
+        segmentQuery = segmentQuery.filter(makeSegmentBBoxCondition(bbox, (node1.longitude, node1.latitude), (node2.longitude, node2.latitude)))
+        if self.hasSpatialIndex():
+            segmentQuery = segmentQuery.filter(sa.literal_column('segments.rowid').in_(selectRTreeIDs(segment_rtree_table, bbox)))
+        return segmentQuery
+
+    def getSegmentRowQuery(self, is_existing=None, bbox=None):
+        """
+        Return a Core query for segments joined to the coordinates of their nodes.
+        bbox is (minimum longitude, minimum latitude, maximum longitude, maximum latitude).
+        """
+        node1, node2 = nodes_table.alias('node1'), nodes_table.alias('node2')
+        query = sa.select([
+            segments_table.c.node1_id, segments_table.c.node2_id, segments_table.c.subnet_id, segments_table.c.is_existing, segments_table.c.weight,
+            node1.c.x.label('x1'), node1.c.y.label('y1'), node2.c.x.label('x2'), node2.c.y.label('y2'),
+            node1.c.longitude.label('longitude1'), node1.c.latitude.label('latitude1'), node2.c.longitude.label('longitude2'), node2.c.latitude.label('latitude2'),
+        ]).where(segments_table.c.node1_id == node1.c.id).where(segments_table.c.node2_id == node2.c.id)
+        # If the user wants to filter existing segments,
+        if is_existing != None:
+            query = query.where(segments_table.c.is_existing == is_existing)
+        # If we have a bounding box,
+        if bbox:
+            query = query.where(makeSegmentBBoxCondition(bbox, (node1.c.longitude, node1.c.latitude), (node2.c.longitude, node2.c.latitude)))
+            if self.hasSpatialIndex():
+                query = query.where(sa.literal_column('segments.rowid').in_(selectRTreeIDs(segment_rtree_table, bbox)))
+        return query
+
+    def cycleSegmentRows(self, is_existing=None, bbox=None, orderBySubnet=False):
+        'Generate lightweight segment rows from getSegmentRowQuery without building ORM objects'
+        query = self.getSegmentRowQuery(is_existing, bbox)
+        if orderBySubnet:
+            query = query.order_by(segments_table.c.subnet_id)
+        connection = self.session.connection().execution_options(stream_results=True)
+        for rows in yieldChunks(connection.execute(query), self.chunkSize):
+            for row in rows:
+                yield row
+
     def countSubnets(self):
         return self.session.query(Subnet).count()
 
     def cycleSubnets(self):
+        'Generate subnets with their segments; use cycleSubnetCoordinates if you only need coordinates'
         for subnet in self.session.query(Subnet):
             yield subnet
 
+    def cycleSubnetCoordinates(self, isCommon=False):
+        'Generate (subnetID, segment coordinates) for each subnet one subnet at a time; set isCommon=True for longitude and latitude'
+        getCoordinates = (lambda x: ((x.longitude1, x.latitude1), (x.longitude2, x.latitude2))) if isCommon else (lambda x: ((x.x1, x.y1), (x.x2, x.y2)))
+        for subnetID, rows in itertools.groupby(self.cycleSegmentRows(orderBySubnet=True), lambda x: x.subnet_id):
+            yield subnetID, [getCoordinates(x) for x in rows]
+
+    def getConnectionQuery(self, node, is_existing=None):
+        'Return SQLAlchemy query for segments connected to the node'
+        return self.getSegmentQuery(is_existing).filter((Segment.node1_id==node.id) | (Segment.node2_id==node.id))
+
     def cycleConnections(self, node, is_existing=None):
-        'Cycle through segments connected to the node'
-        for connection in self.getSegmentQuery(is_existing).filter((Segment.node1_id==node.id) | (Segment.node2_id==node.id)):
+        """
+        Cycle through Segments connected to the node; during a connection summary,
+        new connections come as one ConnectionWeight whose weight is their total weight
+        """
+        if is_existing == False and self.connectionSummaryByNodeID is not None:
+            newConnectionWeight = self.connectionSummaryByNodeID.get(node.id, (False, 0))[1]
+            if newConnectionWeight:
+                yield ConnectionWeight(newConnectionWeight)
+            return
+        for connection in self.getConnectionQuery(node, is_existing):
             yield connection
 
     def isNodeConnected(self, node):
-        return True if self.session.query(Segment).filter((Segment.node1_id==node.id) | (Segment.node2_id==node.id)).first() else False
+        if self.connectionSummaryByNodeID is not None:
+            return node.id in self.connectionSummaryByNodeID
+        return True if self.getConnectionQuery(node).first() else False
 
     def wasNodeAlreadyConnected(self, node):
-        return True if self.session.query(Segment).filter(Segment.is_existing==True).filter((Segment.node1_id==node.id) | (Segment.node2_id==node.id)).first() else False
+        if self.connectionSummaryByNodeID is not None:
+            return self.connectionSummaryByNodeID.get(node.id, (False, 0))[0]
+        return True if self.getConnectionQuery(node, is_existing=True).first() else False
+
+    def summarizeConnections(self):
+        """
+        Summarize segments by node in one scan; isNodeConnected, wasNodeAlreadyConnected and
+        cycleConnections(node, is_existing=False) use the summary until clearConnectionSummary
+        """
+        # Pair each segment with both of its nodes
+        endpoints = sa.union_all(
+            sa.select([segments_table.c.node1_id.label('node_id'), segments_table.c.is_existing, segments_table.c.weight]),
+            sa.select([segments_table.c.node2_id.label('node_id'), segments_table.c.is_existing, segments_table.c.weight]),
+        ).alias('endpoints')
+        # Record whether each node was already connected and the total weight of its new connections
+        query = sa.select([
+            endpoints.c.node_id,
+            sa.func.max(endpoints.c.is_existing),
+            sa.func.sum(sa.case([(endpoints.c.is_existing == True, 0)], else_=endpoints.c.weight)),
+        ]).group_by(endpoints.c.node_id)
+        self.connectionSummaryByNodeID = dict((nodeID, (bool(wasAlreadyConnected), newConnectionWeight or 0)) for nodeID, wasAlreadyConnected, newConnectionWeight in self.session.execute(query))
+
+    def clearConnectionSummary(self):
+        self.connectionSummaryByNodeID = None
 
     def sumNetworkWeight(self, is_existing=None):
         'Get the weight of the network, where weight corresponds to length in most cases'
@@ -334,18 +1026,22 @@ class Store(object):
         return value if value else 0
 
     def getNetworkStatistics(self):
-        return {
-            'segment count': self.session.query(Segment).count(),
-            'new segment weight': self.sumNetworkWeight(is_existing=False),
-            'old segment weight':  self.sumNetworkWeight(is_existing=True),
-        }
+        return dict((x, self.getSummary()[x]) for x in networkStatisticNames)
 
     def saveSegmentsSHP(self, targetPath, is_existing=None):
         # If there are no segments,
         if not self.countSegments(is_existing):
             return
         # Save
-        return geometry_store.save(store.replaceFileExtension(targetPath, 'shp'), self.getProj4(), [shapely.geometry.asShape(x) for x in self.cycleSegments(is_existing)])
+        ogr = geometry_store.ogr
+        return geometry_store.save_features(store.replaceFileExtension(targetPath, 'shp'), self.getProj4(), 'LineString', ((
+            ((x.x1, x.y1), (x.x2, x.y2)),
+            [x.subnet_id, 1 if x.is_existing else 0, x.weight],
+        ) for x in self.cycleSegmentRows(is_existing)), [
+            ('subnet_id', ogr.OFTInteger),
+            ('existing', ogr.OFTInteger),
+            ('weight', ogr.OFTReal),
+        ])
 
     def saveSubnetsSHP(self, targetPath):
         'Save subnets to a shapefile'
@@ -353,74 +1049,322 @@ class Store(object):
         if not self.countSubnets():
             return
         # Save
-        geometry_store.save(store.replaceFileExtension(targetPath, 'shp'), self.getProj4(), [shapely.geometry.asShape(x) for x in self.cycleSubnets()])
+        geometry_store.save_features(store.replaceFileExtension(targetPath, 'shp'), self.getProj4(), 'MultiLineString', ((
+            coordinates,
+            [subnetID],
+        ) for subnetID, coordinates in self.cycleSubnetCoordinates()), [
+            ('subnet_id', geometry_store.ogr.OFTInteger),
+        ])
 
     # Output
 
+    @usingWriteProfile
     def updateMetric(self, metricModel, metricValueByOptionBySection):
         'Add outputs that can only be determined after we have both the metric and network'
         # Load job-level configuration
         jobVS = metricModel.VariableStore(metricValueByOptionBySection, state=[self])
         jobVS.initializeAggregates()
-        # For each real node,
-        for node in self.session.query(Node).filter_by(is_fake=False):
-            # Restore node-level configuration
-            nodeVS = metricModel.VariableStore(node.output, state=[self, node])
-            # Compute more
-            nodeVS.get(metricModel.System)
-            jobVS.updateAggregates(nodeVS)
-            # Set output
-            node.output = nodeVS.getValueByOptionBySection()
+        outputColumns = self.getOutputColumns()
+        columnWriter = column_store.Writer()
+        self.summarizeConnections()
+        try:
+            # For each real node, loading pickled outputs with the rest of each batch if we do not have columns
+            for node in self.cycleNodes(loadPickles=outputColumns is None):
+                # Restore node-level configuration
+                nodeVS = metricModel.VariableStore(self.getNodeOutput(node, outputColumns), state=[self, node])
+                # Compute more
+                nodeVS.get(metricModel.System)
+                jobVS.updateAggregates(nodeVS)
+                # Set output
+                nodeOutput = nodeVS.getValueByOptionBySection()
+                columnWriter.add(node.id, nodeOutput)
+                if self.savePickledOutputs:
+                    node.output = nodeOutput
+        finally:
+            self.clearConnectionSummary()
         # Compute summary variables
         jobVS.processAggregates()
         # Commit
         self.session.commit()
+        columnWriter.save(self.getOutputColumnsPath())
+        self.invalidateOutputCaches()
+        self.clearCheckpoints('updateMetric')
+        if self.useSnapshot:
+            self.saveSnapshot()
         # Return
         return jobVS.getValueByOptionBySection()
-    
-    def exportGeoJSON(self, transform_point=None):
-        # Initialize features as a list
-        features = []
-        # For each node,
-        for node in self.cycleNodes():
-            # Load node
-            nodeOutput = node.output
-            # Append a geojson feature using the node's id and other desired properties
-            features.append(geojson.Feature(
-                id='n%s' % node.id, 
-                geometry=node.exportGeoJSONGeometry(transform_point), 
-                properties={
-                    'population': nodeOutput['demographics']['population count'],
-                    'system': nodeOutput['metric']['system'],
-                },
-            ))
-        # For each segment,
-        for segment in self.cycleSegments():
-            # Append a geojson feature using the segment's id and other desired properties
-            features.append(geojson.Feature(
-                id='s%s-%s' % (segment.node1_id, segment.node2_id), 
-                geometry=segment.exportGeoJSONGeometry(transform_point),
-                properties={
-                    'subnet_id': segment.subnet_id,
-                    'is_existing': 1 if segment.is_existing else 0,
-                    'weight': int(math.ceil(segment.weight)),
-                },
-            ))
+
+    # Process
+
+    def process(self, metricModel, metricValueByOptionBySection, networkModel, networkValueByOptionBySection, jobLogger=None):
+        """
+        Run applyMetric, buildNetwork and updateMetric and return the outputs of each.
+        If a previous run stopped, skip the phases that it completed with the same inputs
+        and resume the network from its last NetworkCheckpoint.
+        """
+        # Start the chain of input hashes from the nodes and the source code of both models
+        # so that we start over when any of them change, even if nothing cleared the checkpoints
+        inputHash = cache_store.hashValues(self.hashNodes(), cache_store.hashModel(metricModel), cache_store.hashModel(networkModel))
+        # Compute metric
+        inputHash = cache_store.hashValues(inputHash, 'applyMetric', metricModel.__name__, metricValueByOptionBySection)
+        metricOutputs = self.loadCheckpoint('applyMetric', 'complete', inputHash)
+        if metricOutputs is None:
+            metricOutputs = self.applyMetric(metricModel, metricValueByOptionBySection)
+            self.saveCheckpoint('applyMetric', 'complete', inputHash, metricOutputs)
+        # Build network
+        inputHash = cache_store.hashValues(inputHash, 'buildNetwork', networkModel.__name__, networkValueByOptionBySection)
+        networkOutputs = self.loadCheckpoint('buildNetwork', 'complete', inputHash)
+        if networkOutputs is None:
+            # Remove a network that we saved before stopping
+            self.clearNetwork()
+            self.session.commit()
+            networkOutputs = self.buildNetwork(networkModel, networkValueByOptionBySection, jobLogger, NetworkCheckpoint(self, inputHash))
+            self.saveCheckpoint('buildNetwork', 'complete', inputHash, networkOutputs)
+        # Update metric
+        inputHash = cache_store.hashValues(inputHash, 'updateMetric', metricModel.__name__, metricValueByOptionBySection)
+        updateOutputs = self.loadCheckpoint('updateMetric', 'complete', inputHash)
+        if updateOutputs is None:
+            # Start from the outputs of applyMetric in case we stopped after replacing them
+            copyFolder(self.getAppliedOutputColumnsPath(), self.getOutputColumnsPath())
+            updateOutputs = self.updateMetric(metricModel, metricValueByOptionBySection)
+            self.saveCheckpoint('updateMetric', 'complete', inputHash, updateOutputs)
         # Return
-        return geojson.dumps(geojson.FeatureCollection(features))
+        return metricOutputs, networkOutputs, updateOutputs
+
+    def hashNodes(self):
+        'Return a digest of the spatial reference with the ids, coordinates and inputs of real nodes'
+        nodeHash = hashlib.sha1(self.getProj4())
+        nodeQuery = sa.select([nodes_table.c.id, nodes_table.c.x, nodes_table.c.y, nodes_table.c.input]).where(nodes_table.c.is_fake == False).order_by(nodes_table.c.id)
+        for row in self.session.connection().execute(nodeQuery):
+            nodeHash.update(json.dumps(list(row), sort_keys=True, default=str))
+        return nodeHash.hexdigest()
+
+    def getResultKey(self, metricModel, metricValueByOptionBySection, networkModel, networkValueByOptionBySection):
+        'Return the key of the result of process in a cache_store.Cache'
+        return cache_store.hashValues(
+            self.hashNodes(),
+            metricModel.__name__, cache_store.hashModel(metricModel), cache_store.normalizeValueByOptionBySection(metricValueByOptionBySection),
+            networkModel.__name__, cache_store.hashModel(networkModel), cache_store.normalizeValueByOptionBySection(networkValueByOptionBySection))
+
+    def checkpointLog(self):
+        'Move committed changes from the write-ahead log into the database file so that a copy of the file is complete'
+        self.session.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.session.commit()
+
+    # Checkpoint
+
+    def getCheckpointPath(self, phaseName):
+        return os.path.join(store.replaceFileExtension(self.datasetPath, 'checkpoints'), phaseName)
+
+    def loadCheckpoint(self, phaseName, name, inputHash):
+        'Return the state that saveCheckpoint saved for the same inputs or None'
+        row = self.session.execute(sa.select([checkpoints_table.c.input_hash, checkpoints_table.c.state]).where(checkpoints_table.c.phase == phaseName).where(checkpoints_table.c.name == name)).first()
+        return row.state if row and row.input_hash == inputHash else None
+
+    def saveCheckpoint(self, phaseName, name, inputHash, state):
+        'Replace and commit the named state of a phase; name is complete for the marker that process saves at the end of the phase'
+        connection = self.session.connection()
+        connection.execute(checkpoints_table.delete().where(checkpoints_table.c.phase == phaseName).where(checkpoints_table.c.name == name))
+        connection.execute(checkpoints_table.insert(), phase=phaseName, name=name, input_hash=inputHash, state=state)
+        self.session.commit()
+
+    def clearCheckpoints(self, phaseName=None):
+        'Remove checkpoints of the phase and the phases after it, or of every phase if phaseName is None'
+        clearedPhaseNames = phaseNames[phaseNames.index(phaseName):] if phaseName else phaseNames
+        self.session.execute(checkpoints_table.delete().where(checkpoints_table.c.phase.in_(clearedPhaseNames)))
+        self.session.commit()
+        for clearedPhaseName in clearedPhaseNames:
+            store.removeFolderSafely(self.getCheckpointPath(clearedPhaseName))
+    
+    def exportGeoJSON(self, transform_point=None, transform_points=None, bbox=None, propertyNames=None):
+        'Export nodes and segments as a GeoJSON FeatureCollection string'
+        if transform_point and not transform_points:
+            transform_points = lambda xs, ys: zip(*[transform_point(x, y) for x, y in itertools.izip(xs, ys)]) or ([], [])
+        return ''.join(self.yieldGeoJSON(transform_points, bbox, propertyNames))
+
+    def yieldGeoJSON(self, transform_points=None, bbox=None, propertyNames=None):
+        """
+        Generate a GeoJSON FeatureCollection in chunks of Store.chunkSize features.
+        bbox is (minimum longitude, minimum latitude, maximum longitude, maximum latitude).
+        propertyNames selects from nodePropertyByName, segmentPropertyNames or 'section > option'.
+        transform_points comes from geometry_store.get_transform_points.
+        """
+        # Prepare properties
+        if propertyNames is None:
+            propertyNames = sorted(nodePropertyByName) + segmentPropertyNames
+        nodePropertyPacks = [(x, parseNodePropertyName(x)) for x in propertyNames if x not in segmentPropertyNames]
+        # If the snapshot has the properties, read it instead
+        snapshot = self.getSnapshot()
+        if snapshot and all(snapshot.hasOutput(section, option) for propertyName, (section, option) in nodePropertyPacks):
+            snapshot.chunkSize = self.chunkSize
+            for text in snapshot.yieldGeoJSON(transform_points, bbox, propertyNames):
+                yield text
+            return
+        selectedSegmentPropertyNames = [x for x in propertyNames if x in segmentPropertyNames]
+        outputColumns = self.getOutputColumns()
+        if outputColumns:
+            nodePropertyColumns = [outputColumns.getColumn(section, option) for propertyName, (section, option) in nodePropertyPacks]
+        # Prepare queries
+        connection = self.session.connection().execution_options(stream_results=True)
+        nodeQuery = sa.select([nodes_table.c.id, nodes_table.c.longitude, nodes_table.c.latitude] + ([] if outputColumns or not nodePropertyPacks else [nodes_table.c.output])).where(nodes_table.c.is_fake == False).order_by(nodes_table.c.id)
+        segmentQuery = self.getSegmentRowQuery(bbox=bbox)
+        # If we have a bounding box,
+        if bbox:
+            minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bbox
+            nodeQuery = nodeQuery.where(nodes_table.c.longitude.between(minimumLongitude, maximumLongitude)).where(nodes_table.c.latitude.between(minimumLatitude, maximumLatitude))
+            if self.hasSpatialIndex():
+                nodeQuery = nodeQuery.where(nodes_table.c.id.in_(selectRTreeIDs(node_rtree_table, bbox)))
+        # Yield
+        def yieldFeatureChunks():
+            # For each chunk of nodes,
+            for rows in yieldChunks(connection.execute(nodeQuery), self.chunkSize):
+                if outputColumns:
+                    nodeIndices = [outputColumns.getNodeIndex(x[0]) for x in rows]
+                    propertyColumns = [[column_store.formatValue(x[y]) for y in nodeIndices] for x in nodePropertyColumns]
+                else:
+                    propertyColumns = [[x[3][section][option] for x in rows] for propertyName, (section, option) in nodePropertyPacks]
+                yield geojson_store.encodeNodes(
+                    [x[0] for x in rows],
+                    transformCoordinates([(x[1], x[2]) for x in rows], transform_points),
+                    [x[0] for x in nodePropertyPacks],
+                    propertyColumns)
+            # For each chunk of segments,
+            for rows in yieldChunks(connection.execute(segmentQuery), self.chunkSize):
+                yield geojson_store.encodeSegments(
+                    (x[:5] for x in rows),
+                    transformCoordinates([y for x in rows for y in ((x.longitude1, x.latitude1), (x.longitude2, x.latitude2))], transform_points),
+                    selectedSegmentPropertyNames)
+        for text in geojson_store.yieldFeatureCollection(yieldFeatureChunks()):
+            yield text
+
+
+class NetworkCheckpoint(object):
+    'Save the sorted candidate segments and progress of a network model so that a restarted buildNetwork can resume'
+
+    # Save progress after this many candidate segments
+    interval = 100000
+
+    def __init__(self, dataset, inputHash):
+        self.dataset = dataset
+        self.inputHash = inputHash
+        self.candidatesPath = os.path.join(dataset.getCheckpointPath('buildNetwork'), 'candidates.npy')
+
+    def loadCandidates(self):
+        'Return the candidates that we saved for the same inputs as a memory-mapped array or None'
+        if self.dataset.loadCheckpoint('buildNetwork', 'candidates', self.inputHash) is None or not os.path.exists(self.candidatesPath):
+            return None
+        return numpy.load(self.candidatesPath, mmap_mode='r')
+
+    def saveCandidates(self, nodeTuples):
+        'Save the candidates after sorting them, replacing the file in one step'
+        store.makeFolderSafely(os.path.dirname(self.candidatesPath))
+        temporaryPath = store.replaceFileExtension(self.candidatesPath, 'tmp.npy')
+        numpy.save(temporaryPath, nodeTuples)
+        os.rename(temporaryPath, self.candidatesPath)
+        self.dataset.saveCheckpoint('buildNetwork', 'candidates', self.inputHash, len(nodeTuples))
+
+    def loadProgress(self):
+        'Return the number of candidates that we processed and the indices of those that we added'
+        progress = self.dataset.loadCheckpoint('buildNetwork', 'progress', self.inputHash)
+        if progress is None:
+            return 0, []
+        completedCount, addedIndices = progress
+        return completedCount, list(addedIndices)
+
+    def saveProgress(self, completedCount, addedIndices):
+        self.dataset.saveCheckpoint('buildNetwork', 'progress', self.inputHash, (completedCount, list(addedIndices)))
+
+
+# Define result cache
+
+# Files and folders that processCached saves, by extension; the database comes first
+resultExtensions = ['db', 'columns', 'snapshot', 'checkpoints']
+
+
+# Define export properties
+
+nodePropertyByName = {
+    'population': ('demographics', 'population count'),
+    'system': ('metric', 'system'),
+}
+segmentPropertyNames = geojson_store.segmentPropertyNames
+
+def parseNodePropertyName(propertyName):
+    'Return the section and option for a node property name'
+    if propertyName in nodePropertyByName:
+        return nodePropertyByName[propertyName]
+    match = re.match(r'(.*?)\s*>\s*(.*)', propertyName)
+    if not match:
+        raise DatasetError('Unknown property: %s' % propertyName)
+    return match.groups()
+
+def makeArrayByName(rows, fieldPacks):
+    'Return a NumPy array for each (fieldName, dtype) from rows of values; None becomes NaN in float arrays'
+    columns = zip(*rows) or [()] * len(fieldPacks)
+    return dict((fieldName, numpy.array(column, dtype=dtype)) for (fieldName, dtype), column in itertools.izip(fieldPacks, columns))
+
+def selectRTreeIDs(rtreeTable, bbox):
+    'Return a Core query for the ids of R*Tree boxes that intersect bbox; boxes are rounded outward, so check exact coordinates too'
+    minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bbox
+    return sa.select([rtreeTable.c.id]).where(sa.and_(
+        rtreeTable.c.minimum_longitude <= maximumLongitude,
+        rtreeTable.c.maximum_longitude >= minimumLongitude,
+        rtreeTable.c.minimum_latitude <= maximumLatitude,
+        rtreeTable.c.maximum_latitude >= minimumLatitude))
+
+def makeSegmentBBoxCondition(bbox, (longitude1, latitude1), (longitude2, latitude2)):
+    'Return a condition that is true when the box around the segment intersects bbox'
+    minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bbox
+    return sa.and_(
+        sa.func.max(longitude1, longitude2) >= minimumLongitude,
+        sa.func.min(longitude1, longitude2) <= maximumLongitude,
+        sa.func.max(latitude1, latitude2) >= minimumLatitude,
+        sa.func.min(latitude1, latitude2) <= maximumLatitude)
+
+def getFieldType(column):
+    'Return the OGR field type for a typed output column'
+    ogr = geometry_store.ogr
+    return {'i': ogr.OFTInteger, 'f': ogr.OFTReal}.get(column.dtype.kind, ogr.OFTString)
+
+def yieldChunks(rows, chunkSize):
+    'Generate lists of up to chunkSize rows'
+    rows = iter(rows)
+    while True:
+        rowChunk = list(itertools.islice(rows, chunkSize))
+        if not rowChunk:
+            break
+        yield rowChunk
+
+def copyFolder(sourcePath, targetPath):
+    'Replace targetPath with a copy of sourcePath in one step'
+    temporaryPath = targetPath + '.tmp'
+    store.removeFolderSafely(temporaryPath)
+    shutil.copytree(sourcePath, temporaryPath)
+    store.removeFolderSafely(targetPath)
+    os.rename(temporaryPath, targetPath)
+
+def transformCoordinates(coordinates, transform_points=None):
+    'Transform a list of coordinate pairs in one call if we have transform_points'
+    if not transform_points:
+        return coordinates
+    xys = numpy.array(coordinates, dtype=float).reshape(-1, 2)
+    return zip(*[list(x) for x in transform_points(xys[:, 0], xys[:, 1])])
 
 
 # Digest
 def digestNodesFromCSV(sourcePath):
     'Import nodes from a comma separated values file'
     csvStream = open(sourcePath, 'rU')
-    proj4, nodePacks = digestNodesFromCSVStream(csvStream)
-    csvStream.close()
-    return proj4, nodePacks
+    try:
+        proj4, nodePacks = digestNodesFromCSVStream(csvStream)
+    except:
+        csvStream.close()
+        raise
+    return proj4, closeAfter(nodePacks, csvStream)
 
 
 def digestNodesFromCSVStream(sourceStream):
-    'Import nodes from a comma separated values stream'
+    'Import nodes from a comma separated values stream; nodePacks are generated one row at a time'
     # Initialize
     rowGenerator = csv.reader(sourceStream)
     try:
@@ -449,16 +1393,30 @@ def digestNodesFromCSVStream(sourceStream):
     # Check whether we do in fact have labels
     if not set(labels).intersection(['name', 'x', 'y']):
         raise DatasetError('Expected spatial reference or labels but found this instead: %s' % labels)
-    # Prepare nodePacks
-    nodePacks = [dict(itertools.izip(labels, values)) for values in rowGenerator]
-    ignoreNodesWithMissingCoordinates = lambda x: x['x'] != '' and x['y'] != ''
     # Return
-    return proj4, filter(ignoreNodesWithMissingCoordinates, nodePacks)
+    return proj4, yieldNodePacksFromCSVRows(labels, rowGenerator)
+
+
+def yieldNodePacksFromCSVRows(labels, rowGenerator):
+    'Generate nodePacks, ignoring nodes with missing coordinates'
+    for values in rowGenerator:
+        nodePack = dict(itertools.izip(labels, values))
+        if nodePack['x'] != '' and nodePack['y'] != '':
+            yield nodePack
+
+
+def closeAfter(iterable, stream):
+    'Generate items from the iterable, then close the stream'
+    try:
+        for item in iterable:
+            yield item
+    finally:
+        stream.close()
 
 def digestNodesFromSHP(sourcePath):
     'Import nodes from a shapefile'
     # Initialize
-    shapeData = osgeo.ogr.Open(sourcePath)
+    shapeData = geometry_store.ogr.Open(sourcePath)
     layer = shapeData.GetLayer()
     # Prepare spatial reference
     proj4 = layer.GetSpatialRef().ExportToProj4()
@@ -487,10 +1445,152 @@ def digestNodesFromZIP(sourcePath):
     return digestNodesFromSHP(shapePath)
 
 
+def insertRows(connection, table, rows, chunkSize):
+    'Insert rows from a list or generator with one executemany per chunk'
+    for rowChunk in yieldChunks(rows, chunkSize):
+        connection.execute(table.insert(), rowChunk)
+
+
+# Define connection profiles
+
+# Persistent settings that only take effect on a new database or stay with the file
+connectPragmas = [
+    ('page_size', '4096'),
+    ('journal_mode', 'WAL'),
+]
+# Per-connection settings; both profiles keep WAL so we never switch journal modes mid-session
+pragmasByProfile = {
+    # Heavy write phases: skip fsync and give SQLite a large page cache
+    'bulk-write': [
+        ('synchronous', 'OFF'),
+        ('cache_size', '-262144'),
+        ('temp_store', 'FILE'),
+        ('mmap_size', '0'),
+    ],
+    # Read-mostly exports and API calls: memory-map the file and keep temporary tables in memory
+    'serve': [
+        ('synchronous', 'NORMAL'),
+        ('cache_size', '-65536'),
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', '268435456'),
+    ],
+}
+
+def applyPragmas(dbapiConnection, pragmas):
+    'Set SQLite pragmas on a DB-API connection'
+    cursor = dbapiConnection.cursor()
+    for name, value in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+# Define engine cache
+
+# Bump when the tables change so that Store creates them in files with an older user_version
+schemaVersion = 3
+
+
+class EngineEntry(object):
+    'Engine, spatial reference and transforms of a dataset file'
+
+    def __init__(self, datasetPath, fileStamp, debug=False):
+        self.fileStamp = fileStamp
+        self.engine = sa.create_engine('sqlite:///' + datasetPath, echo=debug)
+        sa.event.listen(self.engine, 'connect', lambda dbapiConnection, connectionRecord: applyPragmas(dbapiConnection, connectPragmas + pragmasByProfile[Store.profile]))
+        # Create tables unless the file already has the current schema
+        if self.engine.execute('PRAGMA user_version').scalar() < schemaVersion:
+            metadata.create_all(self.engine)
+            self.engine.execute('PRAGMA user_version = %d' % schemaVersion)
+        # Load spatial reference, which new datasets do not have yet
+        proj4 = self.engine.execute(sa.select([spatial_references_table.c.proj4])).scalar()
+        self.setProj4(proj4)
+
+    def setProj4(self, proj4):
+        'Prepare transforms for the spatial reference'
+        self.proj4 = str(proj4) if proj4 else None
+        self.transform_point = geometry_store.get_transform_point(self.proj4) if proj4 else None
+        self.transform_points = geometry_store.get_transform_points(self.proj4) if proj4 else None
+
+    def dispose(self):
+        self.engine.dispose()
+
+
+class EngineCache(object):
+    'Keep EngineEntries of recently opened datasets, replacing an entry when its file changes'
+
+    maximumCount = 16
+
+    def __init__(self):
+        self.entryByPath = collections.OrderedDict()
+
+    def get(self, datasetPath, debug=False):
+        'Return the EngineEntry for the dataset file, making one if we do not have it or if the file changed'
+        fileStamp = getFileStamp(datasetPath)
+        engineEntry = self.entryByPath.pop(datasetPath, None)
+        if engineEntry and engineEntry.fileStamp != fileStamp:
+            engineEntry.dispose()
+            engineEntry = None
+        if not engineEntry:
+            engineEntry = EngineEntry(datasetPath, fileStamp, debug)
+            # Our own DDL may have touched the file
+            engineEntry.fileStamp = getFileStamp(datasetPath)
+        # Keep the most recently used entries
+        self.entryByPath[datasetPath] = engineEntry
+        while len(self.entryByPath) > self.maximumCount:
+            self.entryByPath.popitem(last=False)[1].dispose()
+        return engineEntry
+
+    def invalidate(self, datasetPath):
+        engineEntry = self.entryByPath.pop(datasetPath, None)
+        if engineEntry:
+            engineEntry.dispose()
+
+    def clear(self):
+        while self.entryByPath:
+            self.entryByPath.popitem()[1].dispose()
+
+
+def getFileStamp(datasetPath):
+    'Return what changes when the dataset file is replaced or modified'
+    try:
+        fileStatus = os.stat(datasetPath)
+    except OSError:
+        return None
+    return fileStatus.st_ino, fileStatus.st_mtime, fileStatus.st_size
+
+
+engineCache = EngineCache()
+
+
 # Define tables
 
 metadata = sa.MetaData()
 
+# Secondary indexes, which Store.ensureIndexes creates after bulk loads;
+# segments(node1_id) is already covered by the primary key
+indexPacks = [
+    ('ix_nodes_is_fake', 'nodes', ['is_fake']),
+    ('ix_nodes_longitude_latitude', 'nodes', ['longitude', 'latitude']),
+    ('ix_segments_node2_id', 'segments', ['node2_id']),
+    ('ix_segments_is_existing', 'segments', ['is_existing']),
+    ('ix_segments_subnet_id', 'segments', ['subnet_id']),
+]
+
+# R*Tree tables, which Store.ensureSpatialIndexes creates outside of metadata because they are virtual;
+# each pack is the table and the start of a query for its rows, which gets completed with the last id
+spatialIndexPacks = [
+    ('node_rtree', 'SELECT id, longitude, longitude, latitude, latitude FROM nodes WHERE id'),
+    ('segment_rtree', 'SELECT segments.rowid, min(node1.longitude, node2.longitude), max(node1.longitude, node2.longitude), min(node1.latitude, node2.latitude), max(node1.latitude, node2.latitude) FROM segments JOIN nodes AS node1 ON segments.node1_id = node1.id JOIN nodes AS node2 ON segments.node2_id = node2.id WHERE segments.rowid'),
+]
+spatialMetadata = sa.MetaData()
+node_rtree_table, segment_rtree_table = [sa.Table(tableName, spatialMetadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('minimum_longitude', sa.Float),
+    sa.Column('maximum_longitude', sa.Float),
+    sa.Column('minimum_latitude', sa.Float),
+    sa.Column('maximum_latitude', sa.Float),
+) for tableName, selectSQL in spatialIndexPacks]
+
 spatial_references_table = sa.Table('spatial_references', metadata,
     sa.Column('id', sa.Integer, primary_key=True),
     sa.Column('proj4', sa.String, unique=True),
@@ -521,6 +1621,25 @@ subnets_table = sa.Table('subnets', metadata,
     sa.Column('id', sa.Integer, primary_key=True),
 )
 
+# Statistics that Store.summarize saves as JSON after each write phase
+summaries_table = sa.Table('summaries', metadata,
+    sa.Column('name', sa.String, primary_key=True),
+    sa.Column('value', sa.Text),
+)
+
+# Markers and partial state that let Store.process resume, by phase in the order that process runs them
+checkpoints_table = sa.Table('checkpoints', metadata,
+    sa.Column('phase', sa.String, primary_key=True),
+    sa.Column('name', sa.String, primary_key=True),
+    sa.Column('input_hash', sa.String),
+    sa.Column('state', sa.types.PickleType(mutable=False)),
+)
+phaseNames = ['applyMetric', 'buildNetwork', 'updateMetric']
+
+nodeStatisticNames = ['node count', 'maximum longitude', 'mean longitude', 'minimum longitude', 'maximum latitude', 'mean latitude', 'minimum latitude']
+metricStatisticNames = ['minimum metric', 'maximum metric', 'mean metric']
+networkStatisticNames = ['segment count', 'new segment weight', 'old segment weight']
+
 
 class SpatialReference(object):
 
@@ -630,6 +1749,11 @@ class Segment(object):
         return geojson.LineString(coordinates)
 
 
+# What cycleConnections returns for new connections during a connection summary,
+# one per node with the total weight, because aggregates only need the sum
+ConnectionWeight = collections.namedtuple('ConnectionWeight', ['weight'])
+
+
 class Subnet(object):
 
     def getCoordinates(self):
@@ -0,0 +1,58 @@
+"""
+Encode nodes and segments as a GeoJSON FeatureCollection in chunks
+
+Store.yieldGeoJSON and Snapshot.yieldGeoJSON read arrays from different
+places and feed them here, so that both give the same features.
+"""
+# Import system modules
+import json
+import math
+import itertools
+
+
+# Set constants
+segmentPropertyNames = ['subnet_id', 'is_existing', 'weight']
+
+
+# Core
+
+def yieldFeatureCollection(featureChunks):
+    'Wrap chunks of features from encodeNodes and encodeSegments in a FeatureCollection'
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for features in featureChunks:
+        if not features:
+            continue
+        yield separator + features
+        separator = ', '
+    yield ']}'
+
+def encodeNodes(nodeIDs, coordinates, propertyNames, propertyColumns):
+    'Return point features as text; coordinates and each column in propertyColumns are aligned with nodeIDs'
+    propertyRows = itertools.izip(*propertyColumns) if propertyColumns else itertools.repeat(())
+    return ', '.join(json.dumps({
+        'type': 'Feature',
+        'id': 'n%s' % nodeID,
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': dict(itertools.izip(propertyNames, propertyValues)),
+    }) for nodeID, (longitude, latitude), propertyValues in itertools.izip(nodeIDs, coordinates, propertyRows))
+
+def encodeSegments(segmentPacks, coordinates, propertyNames):
+    """
+    Return line features as text; segmentPacks are (node1ID, node2ID, subnetID, isExisting, weight)
+    and coordinates has two pairs for each segment; propertyNames selects from segmentPropertyNames
+    """
+    features = []
+    for segmentIndex, (node1ID, node2ID, subnetID, isExisting, weight) in enumerate(segmentPacks):
+        valueByName = {
+            'subnet_id': subnetID,
+            'is_existing': 1 if isExisting else 0,
+            'weight': int(math.ceil(weight)),
+        }
+        features.append(json.dumps({
+            'type': 'Feature',
+            'id': 's%s-%s' % (node1ID, node2ID),
+            'geometry': {'type': 'LineString', 'coordinates': [list(x) for x in coordinates[2 * segmentIndex:2 * segmentIndex + 2]]},
+            'properties': dict((x, valueByName[x]) for x in propertyNames),
+        }))
+    return ', '.join(features)
@@ -7,13 +7,19 @@ please see http://www.gdal.org/ogr/ogr_formats.html
 """
 # Import system modules
 import os
+import numpy
 import itertools
-from osgeo import ogr, osr
 from shapely import wkb, geometry
 # Import custom modules
+import store
 import zip_store
 
 
+# Import GDAL/OGR only when we touch geospatial data
+ogr = store.LazyModule('osgeo.ogr')
+osr = store.LazyModule('osgeo.osr')
+
+
 # Set constants
 proj4LL = '+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs'
 proj4SM = '+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs'
@@ -43,21 +49,8 @@ def save(targetPath, sourceProj4, shapelyGeometries, fieldPacks=None, fieldDefin
         fieldDefinitions = []
     if fieldPacks and set(len(x) for x in fieldPacks) != set([len(fieldDefinitions)]):
         raise GeometryError('A field definition is required for each field')
-    # Make dataSource
-    if os.path.exists(targetPath): 
-        os.remove(targetPath)
-    dataDriver = ogr.GetDriverByName(driverName)
-    if not dataDriver:
-        raise GeometryError('Could not load driver: {}'.format(driverName))
-    dataSource = dataDriver.CreateDataSource(targetPath)
     # Make layer
-    layerName = os.path.splitext(os.path.basename(targetPath))[0]
-    spatialReference = get_spatialReference(targetProj4 or sourceProj4)
-    geometryType = get_geometryType(shapelyGeometries)
-    layer = dataSource.CreateLayer(layerName, spatialReference, geometryType)
-    # Make fieldDefinitions in featureDefinition
-    for fieldName, fieldType in fieldDefinitions:
-        layer.CreateField(ogr.FieldDefn(fieldName, fieldType))
+    dataSource, layer = make_layer(targetPath, get_spatialReference(targetProj4 or sourceProj4), get_geometryType(shapelyGeometries), fieldDefinitions, driverName)
     featureDefinition = layer.GetLayerDefn()
     # Save features
     transform_geometry = get_transform_geometry(sourceProj4, targetProj4)
@@ -65,11 +58,37 @@ def save(targetPath, sourceProj4, shapelyGeometries, fieldPacks=None, fieldDefin
         # Prepare feature
         feature = ogr.Feature(featureDefinition)
         feature.SetGeometry(transform_geometry(ogr.CreateGeometryFromWkb(shapelyGeometry.wkb)))
-        for fieldIndex, fieldValue in enumerate(fieldPack):
-            if (hasattr(feature, 'SetField2')): 
-                feature.SetField2(fieldIndex, fieldValue)
-            else:
-                feature.SetField(fieldIndex, fieldValue)
+        set_fields(feature, fieldPack)
+        # Save feature
+        layer.CreateFeature(feature)
+        # Clean up
+        feature.Destroy()
+    # Return
+    return targetPath
+
+@zip_store.save
+def save_features(targetPath, sourceProj4, geometryType, featurePacks, fieldDefinitions=None, driverName='ESRI Shapefile', targetProj4=''):
+    """
+    Save (coordinates, fieldPack) pairs from a list or generator one feature at a time.
+    geometryType is 'Point', 'LineString' or 'MultiLineString'; we build OGR geometries from the coordinates without shapely.
+    """
+    # Validate arguments
+    if geometryType not in ('Point', 'LineString', 'MultiLineString'):
+        raise GeometryError('Unsupported geometry type: %s' % geometryType)
+    if not fieldDefinitions:
+        fieldDefinitions = []
+    # Make layer
+    dataSource, layer = make_layer(targetPath, get_spatialReference(targetProj4 or sourceProj4), getattr(ogr, 'wkb' + geometryType), fieldDefinitions, driverName)
+    featureDefinition = layer.GetLayerDefn()
+    # Save features
+    transform_geometry = get_transform_geometry(sourceProj4, targetProj4)
+    for coordinates, fieldPack in featurePacks:
+        if len(fieldPack) != len(fieldDefinitions):
+            raise GeometryError('A field definition is required for each field')
+        # Prepare feature
+        feature = ogr.Feature(featureDefinition)
+        feature.SetGeometry(transform_geometry(make_geometry(geometryType, coordinates)))
+        set_fields(feature, fieldPack)
         # Save feature
         layer.CreateFeature(feature)
         # Clean up
@@ -115,6 +134,23 @@ def get_transform_point(sourceProj4, targetProj4=proj4LL):
     coordinateTransformation = get_coordinateTransformation(sourceProj4, targetProj4)
     return lambda x, y: coordinateTransformation.TransformPoint(x, y)[:2]
 
+def get_transform_points(sourceProj4, targetProj4=proj4LL):
+    'Return a function that transforms arrays of x and y coordinates from one spatial reference to another in one call'
+    if sourceProj4 == targetProj4:
+        # Return the arrays themselves if they are already float arrays
+        return lambda xs, ys: (numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float))
+    coordinateTransformation = get_coordinateTransformation(sourceProj4, targetProj4)
+    def transform_points(xs, ys):
+        'Transform x and y coordinate arrays using coordinateTransformation'
+        # Pair coordinates
+        xys = numpy.column_stack((xs, ys)).astype(float)
+        if not len(xys):
+            return numpy.array([]), numpy.array([])
+        # Transform a list of pairs, which every version of the bindings accepts, and drop z
+        transformedXYs = numpy.array(coordinateTransformation.TransformPoints(xys.tolist()), dtype=float)
+        return transformedXYs[:, 0], transformedXYs[:, 1]
+    return transform_points
+
 def get_transform_geometry(sourceProj4, targetProj4=proj4LL):
     'Return a function that transforms a geometry from one spatial reference to another'
     if not targetProj4 or sourceProj4 == targetProj4:
@@ -151,6 +187,46 @@ def get_spatialReference(proj4):
         raise GeometryError('Could not import proj4: {}'.format(proj4))
     return spatialReference
 
+def make_layer(targetPath, spatialReference, geometryType, fieldDefinitions, driverName):
+    'Replace targetPath with a dataSource that has one layer with the given fields'
+    # Make dataSource
+    if os.path.exists(targetPath): 
+        os.remove(targetPath)
+    dataDriver = ogr.GetDriverByName(driverName)
+    if not dataDriver:
+        raise GeometryError('Could not load driver: {}'.format(driverName))
+    dataSource = dataDriver.CreateDataSource(targetPath)
+    # Make layer
+    layerName = os.path.splitext(os.path.basename(targetPath))[0]
+    layer = dataSource.CreateLayer(layerName, spatialReference, geometryType)
+    # Make fieldDefinitions in featureDefinition
+    for fieldName, fieldType in fieldDefinitions:
+        layer.CreateField(ogr.FieldDefn(fieldName, fieldType))
+    # Return the dataSource too because the layer is only valid while it exists
+    return dataSource, layer
+
+def make_geometry(geometryType, coordinates):
+    'Build a Point, LineString or MultiLineString gdalGeometry from coordinates'
+    if geometryType == 'MultiLineString':
+        g = ogr.Geometry(ogr.wkbMultiLineString)
+        for lineCoordinates in coordinates:
+            g.AddGeometryDirectly(make_geometry('LineString', lineCoordinates))
+        return g
+    g = ogr.Geometry(getattr(ogr, 'wkb' + geometryType))
+    for x, y in [coordinates] if geometryType == 'Point' else coordinates:
+        g.AddPoint_2D(x, y)
+    return g
+
+def set_fields(feature, fieldPack):
+    'Set field values in order, leaving fields whose value is None unset'
+    for fieldIndex, fieldValue in enumerate(fieldPack):
+        if fieldValue is None:
+            continue
+        if (hasattr(feature, 'SetField2')): 
+            feature.SetField2(fieldIndex, fieldValue)
+        else:
+            feature.SetField(fieldIndex, fieldValue)
+
 def get_geometryType(shapelyGeometries):
     'Determine geometry type for layer'
     geometryTypes = list(set(type(x) for x in shapelyGeometries))
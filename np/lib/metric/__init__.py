@@ -14,7 +14,12 @@ def getModelNames():
     return ['mvMax5', 'mvMax4', 'mvMax3', 'mvMax2']
 
 def getModel(modelName):
-    return store.getModel(__file__, modelName, getModelNames())
+    return modelRegistry.getModel(modelName)
+
+def getModelImportTimes():
+    return modelRegistry.getImportTimes()
+
+modelRegistry = store.ModelRegistry(__name__, getModelNames())
 
 
 # Define helpers
@@ -42,18 +47,12 @@ def computeSystemCounts(desiredCapacity, availableCapacities):
 
 def saveMetricsCSV(targetPath, metricModel, valueByOptionBySection):
     'Save scenario-level metrics as a CSV file'
-    # Initialize
-    csvFile = open(store.replaceFileExtension(targetPath, 'csv'), 'wt')
-    csvWriter = csv.writer(csvFile)
-    vs = metricModel.VariableStore
-    for variableClass in sorted(itertools.chain(vs.aggregateClasses, 
-                                                vs.summaryClasses), 
-                                key=lambda x: (x.__module__, x.__name__)):
-        section = variableClass.section
-        option = variableClass.option
-        value = valueByOptionBySection[section][option]
-        csvWriter.writerow([section, option, value])
-    csvFile.close()
+    variableClassIndex = getVariableClassIndex(metricModel)
+    writeCSV(targetPath, ([
+        variableClass.section,
+        variableClass.option,
+        valueByOptionBySection[variableClass.section][variableClass.option],
+    ] for variableClass in variableClassIndex.summaryClasses))
 
 def saveMetricsConfigurationCSV(targetPath, valueByOptionBySection):
     'Save scenario-level INPUT metrics as a CSV file'
@@ -67,18 +66,56 @@ def saveMetricsConfigurationCSV(targetPath, valueByOptionBySection):
     
 def saveMetricsConfigurationFullCSV(targetPath, metricModel, valueByOptionBySection):
     'Save scenario-level INPUT metrics WITH DETAIL as a CSV file'
-    variableStore = metricModel.VariableStore(valueByOptionBySection)
+    variableClassIndex = getVariableClassIndex(metricModel)
+    writeCSV(targetPath, variableClassIndex.yieldConfigurationRows(valueByOptionBySection))
+
+def writeCSV(targetPath, rows):
+    'Write rows to a CSV file one at a time as they are generated'
     csvFile = open(store.replaceFileExtension(targetPath, 'csv'), 'wt')
     csvWriter = csv.writer(csvFile)
-    # Note, this assumes section, option, value tuples returned by flatten function
-    for section, option, value in sorted(util.flatten_to_tuples(valueByOptionBySection)):
+    for row in rows:
+        csvWriter.writerow(row)
+    csvFile.close()
 
-        find_var = lambda x, section=section, option=option: \
-                isinstance(x, type) and x.section == section and x.option == option
-        var = filter(find_var, variableStore.variableClasses)[0]
-        alias = ""
-        if var.aliases and len(var.aliases) > 0:
-            alias = var.aliases[0]
-        csvWriter.writerow([section, option, alias, value, var.units, var.__doc__])
 
-    csvFile.close()
+# Define indices
+
+variableClassIndexByModelName = {}
+
+def getVariableClassIndex(metricModel):
+    'Return the cached VariableClassIndex for the given model'
+    modelName = metricModel.__name__
+    if modelName not in variableClassIndexByModelName:
+        variableClassIndexByModelName[modelName] = VariableClassIndex(metricModel)
+    return variableClassIndexByModelName[modelName]
+
+
+class VariableClassIndex(object):
+    'Lookup tables for the variable classes of a model, built once per model'
+
+    def __init__(self, metricModel):
+        # Make sure that VariableStore.variableClasses includes the classes from variableModules
+        metricModel.VariableStore()
+        variableStore = metricModel.VariableStore
+        # Index variableClasses by (section, option)
+        self.variableClassBySectionOption = dict(((x.section, x.option), x) for x in variableStore.variableClasses)
+        self.sectionOptions = sorted(self.variableClassBySectionOption)
+        # Sort aggregate and summary classes in the order we save them
+        self.summaryClasses = sorted(itertools.chain(
+            variableStore.aggregateClasses, 
+            variableStore.summaryClasses), key=lambda x: (x.__module__, x.__name__))
+
+    def getVariableClass(self, section, option):
+        return self.variableClassBySectionOption[(section, option)]
+
+    def yieldConfigurationRows(self, valueByOptionBySection):
+        'Generate section, option, alias, value, units, description in (section, option) order'
+        # For each variableClass in order,
+        for section, option in self.sectionOptions:
+            # If the configuration does not mention the variable, skip it
+            valueByOption = valueByOptionBySection.get(section)
+            if not isinstance(valueByOption, dict) or option not in valueByOption:
+                continue
+            variableClass = self.variableClassBySectionOption[(section, option)]
+            alias = variableClass.aliases[0] if variableClass.aliases else ''
+            yield [section, option, alias, valueByOption[option], variableClass.units, variableClass.__doc__]
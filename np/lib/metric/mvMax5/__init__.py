@@ -9,6 +9,7 @@ import costDistribution
 import costOffGrid
 import costMiniGrid
 import costGrid
+import costEngine
 
 
 
@@ -661,6 +662,10 @@ class VariableStore(VS):
         GridSystemTotalProposedNetworkLength,
     ]
 
+    def getCostEngine(self):
+        'Return a CostEngine that computes system costs for arrays of nodes with the parameters of this job'
+        return costEngine.CostEngine(self)
+
 
 
 # Set order
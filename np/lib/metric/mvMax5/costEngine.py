@@ -0,0 +1,210 @@
+'Compute off-grid, mini-grid and grid system costs for arrays of nodes in one call'
+# Import system modules
+import numpy
+# Import custom modules
+import finance
+import demand
+import costDistribution
+import costOffGrid
+import costMiniGrid
+import costGrid
+
+
+
+# Engine
+
+
+class CostEngine(object):
+    """
+    Vectorized counterpart of the system cost variables.
+
+    Job-level parameters come from the job VariableStore.  Node-level values
+    are passed as arrays keyed by variable class; passing an array for a
+    parameter class overrides the job-level value node by node.  Available
+    system capacities always come from the job.
+    """
+
+    # Node-level values that the system costs depend on
+    inputClasses = [
+        demand.ProjectedNodalDemandPerYear,
+        demand.ProjectedHouseholdDemandPerYear,
+        demand.ProjectedHealthFacilityDemandPerYear,
+        demand.ProjectedEducationFacilityDemandPerYear,
+        demand.ProjectedPublicLightingFacilityDemandPerYear,
+        demand.ProjectedCommercialFacilityDemandPerYear,
+        demand.ProjectedProductiveDemandPerYear,
+        demand.ProjectedPeakCommercialFacilityDemand,
+        demand.ProjectedPeakProductiveDemand,
+        demand.ProjectedPeakNodalDemand,
+        demand.ProjectedHealthFacilityCount,
+        demand.ProjectedEducationFacilityCount,
+        demand.ProjectedPublicLightingFacilityCount,
+        demand.ProjectedCommercialFacilityCount,
+        demand.TargetHouseholdCount,
+        costDistribution.LowVoltageLineInitialCost,
+        costDistribution.LowVoltageLineRecurringCostPerYear,
+    ]
+
+    def __init__(self, jobVS):
+        self.jobVS = jobVS
+
+    def get(self, valueByClass, variableClass):
+        'Return node-level values if we have them, otherwise the job-level value'
+        value = valueByClass[variableClass] if variableClass in valueByClass else self.jobVS.get(variableClass)
+        return numpy.asarray(value, dtype=float)
+
+    def compute(self, valueByClass):
+        'Return initial, recurring and nodal discounted cost arrays by variable class'
+        get = lambda variableClass: self.get(valueByClass, variableClass)
+        costByClass = {}
+        costByClass.update(computeOffGridCosts(get))
+        costByClass.update(computeMiniGridCosts(get))
+        costByClass.update(computeGridCosts(get))
+        return costByClass
+
+    def computeFromVariableStores(self, nodeVSs):
+        'Gather inputClasses from each node-level VariableStore and compute costs'
+        return self.compute(dict((variableClass, numpy.array([x.get(variableClass) for x in nodeVSs], dtype=float)) for variableClass in self.inputClasses))
+
+
+
+# Kernels
+
+
+def computeOffGridCosts(get):
+    'Mirror costOffGrid for arrays of nodes'
+    # Size photovoltaic panels
+    photovoltaicDesiredCapacities = (
+        get(demand.ProjectedHouseholdDemandPerYear) +
+        get(demand.ProjectedHealthFacilityDemandPerYear) +
+        get(demand.ProjectedEducationFacilityDemandPerYear) +
+        get(demand.ProjectedPublicLightingFacilityDemandPerYear)
+    ) / (1 - get(costOffGrid.PhotovoltaicComponentEfficiencyLoss)) / get(costOffGrid.PeakSunHoursPerYear)
+    photovoltaicCapacities = computeActualSystemCapacities(
+        photovoltaicDesiredCapacities,
+        get(costOffGrid.PhotovoltaicPanelAvailableSystemCapacities))
+    # Cost photovoltaic components
+    panelCosts = get(costOffGrid.PhotovoltaicPanelCostPerPhotovoltaicComponentKilowatt) * photovoltaicCapacities
+    batteryCosts = get(costOffGrid.PhotovoltaicBatteryCostPerKilowattHour) * get(costOffGrid.PhotovoltaicBatteryKilowattHoursPerPhotovoltaicComponentKilowatt) * photovoltaicCapacities
+    balanceCosts = get(costOffGrid.PhotovoltaicBalanceCostAsFractionOfPanelCost) * panelCosts
+    photovoltaicInitialCosts = panelCosts + batteryCosts + balanceCosts
+    photovoltaicRecurringCosts = (
+        panelCosts / get(costOffGrid.PhotovoltaicPanelLifetime) +
+        batteryCosts / get(costOffGrid.PhotovoltaicBatteryLifetime) +
+        balanceCosts / get(costOffGrid.PhotovoltaicBalanceLifetime) +
+        get(costOffGrid.PhotovoltaicComponentOperationsAndMaintenanceCostPerYearAsFractionOfComponentCost) * photovoltaicInitialCosts)
+    # Size diesel generators
+    dieselDesiredCapacities = get(demand.ProjectedPeakCommercialFacilityDemand) + get(demand.ProjectedPeakProductiveDemand)
+    dieselCapacities = computeActualSystemCapacities(
+        dieselDesiredCapacities,
+        get(costOffGrid.DieselGeneratorAvailableSystemCapacities))
+    dieselDemands = get(demand.ProjectedCommercialFacilityDemandPerYear) + get(demand.ProjectedProductiveDemandPerYear)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        dieselHours = numpy.where(dieselCapacities == 0, 0, numpy.maximum(
+            get(costOffGrid.DieselGeneratorMinimumHoursOfOperationPerYear),
+            dieselDemands / dieselCapacities))
+    # Cost diesel components
+    generatorCosts = get(costOffGrid.DieselGeneratorCostPerDieselSystemKilowatt) * dieselCapacities
+    dieselInitialCosts = generatorCosts + get(costOffGrid.DieselGeneratorInstallationCostAsFractionOfGeneratorCost) * generatorCosts
+    dieselRecurringCosts = (
+        get(costOffGrid.DieselGeneratorOperationsAndMaintenanceCostPerYearAsFractionOfGeneratorCost) * generatorCosts +
+        generatorCosts / get(costOffGrid.DieselGeneratorLifetime) +
+        get(costOffGrid.DieselFuelCostPerLiter) * get(costOffGrid.DieselFuelLitersConsumedPerKilowattHour) * dieselCapacities * dieselHours)
+    # Return
+    return packSystemCosts(get,
+        costOffGrid.OffGridSystemInitialCost, photovoltaicInitialCosts + dieselInitialCosts,
+        costOffGrid.OffGridSystemRecurringCostPerYear, photovoltaicRecurringCosts + dieselRecurringCosts,
+        costOffGrid.OffGridSystemNodalDiscountedCost)
+
+
+def computeMiniGridCosts(get):
+    'Mirror costMiniGrid for arrays of nodes'
+    # Size generation
+    effectiveDemands = get(demand.ProjectedNodalDemandPerYear) / (1 - get(costMiniGrid.DistributionLoss))
+    generationDesiredCapacities = effectiveDemands / get(costMiniGrid.GenerationCapacityFactor) / get(costMiniGrid.UtilizationFactor) / (365 * 24)
+    generationCapacities = computeActualSystemCapacities(
+        generationDesiredCapacities,
+        get(costMiniGrid.GenerationAvailableSystemCapacities))
+    # Cost generation
+    generationCosts = get(costMiniGrid.GenerationCostPerSystemKilowatt) * generationCapacities
+    energyStorageDemands = numpy.maximum(
+        get(costMiniGrid.MinimumEnergyStorageCapacity) * 365,
+        effectiveDemands * get(costMiniGrid.PercentOfDailyKilowattHourLoadRequiringStorage))
+    # Cost low voltage line equipment
+    equipmentCosts = get(costDistribution.LowVoltageLineEquipmentCostPerConnection) * get(demand.TargetHouseholdCount)
+    # Return
+    return packSystemCosts(get,
+        costMiniGrid.MiniGridSystemInitialCost, (
+            generationCosts +
+            get(costMiniGrid.GenerationInstallationCostAsFractionOfGenerationCost) * generationCosts +
+            equipmentCosts +
+            get(costDistribution.LowVoltageLineInitialCost)),
+        costMiniGrid.MiniGridSystemRecurringCostPerYear, (
+            get(costMiniGrid.GenerationOperationsAndMaintenanceCostPerYearAsFractionOfGenerationCost) * generationCosts +
+            generationCosts / get(costMiniGrid.GenerationLifetime) +
+            get(costMiniGrid.EnergyStorageCostPerKilowattHour) * energyStorageDemands +
+            get(costDistribution.LowVoltageLineEquipmentOperationsAndMaintenanceCostPerYearAsFractionOfEquipmentCost) * equipmentCosts +
+            get(costDistribution.LowVoltageLineRecurringCostPerYear)),
+        costMiniGrid.MiniGridSystemNodalDiscountedCost)
+
+
+def computeGridCosts(get):
+    'Mirror costGrid for arrays of nodes'
+    # Count connections
+    connectionCounts = get(demand.TargetHouseholdCount) + (
+        get(demand.ProjectedHealthFacilityCount) +
+        get(demand.ProjectedEducationFacilityCount) +
+        get(demand.ProjectedPublicLightingFacilityCount) +
+        get(demand.ProjectedCommercialFacilityCount))
+    # Size transformers
+    distributionLoss = get(costGrid.DistributionLoss)
+    transformerCapacities = computeActualSystemCapacities(
+        get(demand.ProjectedPeakNodalDemand) / (1 - distributionLoss),
+        get(costGrid.GridTransformerAvailableSystemCapacities))
+    # Cost components
+    transformerCosts = get(costGrid.GridTransformerCostPerGridSystemKilowatt) * transformerCapacities
+    equipmentCosts = get(costDistribution.LowVoltageLineEquipmentCostPerConnection) * connectionCounts
+    # Return
+    return packSystemCosts(get,
+        costGrid.GridInternalSystemInitialCost, (
+            get(costGrid.GridInstallationCostPerConnection) * connectionCounts +
+            transformerCosts +
+            equipmentCosts +
+            get(costDistribution.LowVoltageLineInitialCost)),
+        costGrid.GridInternalSystemRecurringCostPerYear, (
+            get(costGrid.GridTransformerOperationsAndMaintenanceCostPerYearAsFractionOfTransformerCost) * transformerCosts +
+            transformerCosts / get(costGrid.GridTransformerLifetime) +
+            get(costGrid.GridElectricityCostPerKilowattHour) * get(demand.ProjectedNodalDemandPerYear) / (1 - distributionLoss) +
+            get(costDistribution.LowVoltageLineEquipmentOperationsAndMaintenanceCostPerYearAsFractionOfEquipmentCost) * equipmentCosts +
+            get(costDistribution.LowVoltageLineRecurringCostPerYear)),
+        costGrid.GridInternalSystemNodalDiscountedCost)
+
+
+
+# Helpers
+
+
+def computeActualSystemCapacities(desiredCapacities, availableCapacities):
+    'Return the capacity of the systems that metric.computeSystemCounts would choose for each node'
+    # Initialize
+    availableCapacities = sorted(availableCapacities.tolist(), reverse=True)
+    remainingCapacities = numpy.array(desiredCapacities, dtype=float)
+    actualCapacities = numpy.zeros(remainingCapacities.shape)
+    # For each availableCapacity from largest to smallest,
+    for availableCapacity in availableCapacities:
+        # Use as many as fit in the remaining capacity
+        actualCapacities += numpy.trunc(remainingCapacities / availableCapacity) * availableCapacity
+        remainingCapacities = remainingCapacities % availableCapacity
+    # If we have a remainder, add one more of the smallest capacity
+    return actualCapacities + numpy.where(remainingCapacities != 0, availableCapacities[-1], 0)
+
+
+def packSystemCosts(get, initialClass, initialCosts, recurringClass, recurringCosts, nodalDiscountedClass):
+    'Compute nodal discounted costs and arrange costs by variable class'
+    nodalDemands = get(demand.ProjectedNodalDemandPerYear)
+    nodalDiscountedCosts = numpy.where(nodalDemands == 0, 0, initialCosts + recurringCosts * get(finance.DiscountedCashFlowFactor))
+    return {
+        initialClass: initialCosts * numpy.ones(nodalDemands.shape),
+        recurringClass: recurringCosts * numpy.ones(nodalDemands.shape),
+        nodalDiscountedClass: nodalDiscountedCosts,
+    }
@@ -5,19 +5,27 @@ import math
 import shapely.ops
 import shapely.geometry
 import shapely.topology
-from rtree import index
 from time import localtime, strftime
 # Import custom modules
 from np.lib import store, geometry_store
 
 
+# Import rtree only when we build an indexed network
+index = store.LazyModule('rtree.index')
+
+
 # Define model wrappers
 
 def getModelNames():
     return ['modKruskal']
 
 def getModel(modelName):
-    return store.getModel(__file__, modelName, getModelNames())
+    return modelRegistry.getModel(modelName)
+
+def getModelImportTimes():
+    return modelRegistry.getImportTimes()
+
+modelRegistry = store.ModelRegistry(__name__, getModelNames())
 
 def getValueByOptionBySection(modelName):
     return getModel(modelName).VariableStore().getValueByOptionBySection()
@@ -33,11 +33,21 @@ class CandidateManager(object):
     """
     dtype = [('i', 'uint16'), ('j', 'uint16'), ('w', 'f4')]
 
-    def __init__(self, nodes, distanceFunction):
-        'initialize the set of nodes and the index pair, distance array'
+    def __init__(self, nodes, distanceFunction, nodeTuples=None):
+        """
+        initialize the set of nodes and the index pair, distance array;
+        nodeTuples restores sorted candidates that a checkpoint saved, 
+        including those that extendNodeTuples added
+        """
         self.nodes = nodes
         self.distanceFromNodeTuple = lambda index_tuple:\
                     distanceFunction(nodes[index_tuple[0]], nodes[index_tuple[1]])
+        'for keeping track of target segments of projected nodes'
+        self.targetSegmentLookup = {}
+        self.isRestored = nodeTuples is not None
+        if self.isRestored:
+            self.nodeTuples = nodeTuples
+            return
         nodeIndexPairs = numpy.array(list(itertools.combinations(range(len(self.nodes)), 2)))
         self.nodeTuples = numpy.zeros((len(nodeIndexPairs)), dtype=CandidateManager.dtype)
         self.nodeTuples['i'] = nodeIndexPairs[:, 0]
@@ -45,9 +55,6 @@ class CandidateManager(object):
         self.nodeTuples['w'] = numpy.apply_along_axis(self.distanceFromNodeTuple, 
                 1, nodeIndexPairs)
         
-        'for keeping track of target segments of projected nodes'
-        self.targetSegmentLookup = {}
-        
 
     def extendNodeTuples(self, tuples):
         """
@@ -67,7 +74,9 @@ class CandidateManager(object):
             newNodeIndex += 1
             tupleIndex += 1
  
-        self.nodeTuples = numpy.concatenate((newNodeTuples, self.nodeTuples))
+        # Restored candidates already include these
+        if not self.isRestored:
+            self.nodeTuples = numpy.concatenate((newNodeTuples, self.nodeTuples))
         # nodeIndexPairs = numpy.array(list(itertools.combinations(range(len(networkNodes)), 2)))
         # segmentsByNodeIndex = numpy.zeros((len(nodeIndexPairs)), dtype=[('x', 'i2'), ('y', 'i2'), ('w', 'f4')])
         # segmentsByNodeIndex['i'] = nodeIndexPairs[:, 0]
@@ -85,8 +94,12 @@ class VariableStore(variable_store.VariableStore):
         ExistingNetworks,
     ]
 
-    def buildNetworkFromNodes(self, nodes, proj4, jobLogger=None):
-        'Build a network using the given nodes'
+    def buildNetworkFromNodes(self, nodes, proj4, jobLogger=None, checkpoint=None):
+        """
+        Build a network using the given nodes;
+        checkpoint saves candidates and progress so that a restarted job can resume,
+        see dataset_store.NetworkCheckpoint
+        """
         # If the spatial reference has units in meters,
         if '+units=m' in proj4:
             # Use euclidean distance
@@ -95,20 +108,20 @@ class VariableStore(variable_store.VariableStore):
             # Use spherical distance
             computeDistance = network.computeSphericalDistance
         # Run algorithm given nodes
-        net = self.buildNetworkFromSegments(*self.generateSegments(nodes, computeDistance, proj4), jobLogger=jobLogger)
+        net = self.buildNetworkFromSegments(*self.generateSegments(nodes, computeDistance, proj4, checkpoint), jobLogger=jobLogger, checkpoint=checkpoint)
         # Eliminate subnetworks that have too few real nodes
         minimumNodeCountPerSubnetwork = self.get(MinimumNodeCountPerSubnetwork)
         subnetFilter = lambda subnet: subnet.countNodes() >= minimumNodeCountPerSubnetwork
         net.filterSubnets(subnetFilter)
         return net
 
-    def generateSegments(self, nodes, computeDistance, proj4):
+    def generateSegments(self, nodes, computeDistance, proj4, checkpoint=None):
         'Generate segment candidates connecting nodes to the existing grid'
         # Prepare
         segmentFactory = network.SegmentFactory(nodes, computeDistance, proj4)
 
         # Use more efficient CandidateManager for candidate segments
-        candidateManager = CandidateManager(segmentFactory.getNodes(), computeDistance)
+        candidateManager = CandidateManager(segmentFactory.getNodes(), computeDistance, checkpoint.loadCandidates() if checkpoint else None)
 
         net = network.Network(segmentFactory, useIndex=True)
         networkRelativePath = self.get(ExistingNetworks)
@@ -123,11 +136,13 @@ class VariableStore(variable_store.VariableStore):
                 raise variable_store.VariableError('Could not find shapefile in ZIP archive for existing networks')
             # Load network
             networkProj4, networkGeometries = geometry_store.load(networkPath)[:2]
-            networkCoordinatePairs = network.yieldSimplifiedCoordinatePairs(networkGeometries)
-            # Prepare
-            transform_point = geometry_store.get_transform_point(networkProj4, proj4)
+            networkCoordinatePairs = numpy.array([(c1[:2], c2[:2]) for c1, c2 in network.yieldSimplifiedCoordinatePairs(networkGeometries)], dtype=float).reshape(-1, 2, 2)
+            # Transform all coordinates in one call
+            transform_points = geometry_store.get_transform_points(networkProj4, proj4)
+            xs, ys = transform_points(networkCoordinatePairs[:, :, 0].ravel(), networkCoordinatePairs[:, :, 1].ravel())
+            coordinates = zip(numpy.asarray(xs).tolist(), numpy.asarray(ys).tolist())
             # Load existing network as a single subnet and allow overlapping segments
-            net.addSubnet(network.Subnet([segmentFactory.getSegment(transform_point(c1[0], c1[1]), transform_point(c2[0], c2[1]), is_existing=True) for c1, c2 in networkCoordinatePairs]))
+            net.addSubnet(network.Subnet([segmentFactory.getSegment(c1, c2, is_existing=True) for c1, c2 in itertools.izip(coordinates[::2], coordinates[1::2])]))
             # Add candidate segments that connect each node to its 
             # projection on the existing network
             projectedTuples = net.projectEfficient(candidateManager.nodes)
@@ -136,7 +151,7 @@ class VariableStore(variable_store.VariableStore):
         return candidateManager, net 
 
 
-    def buildNetworkFromSegments(self, candidateManager, net, jobLogger=None):
+    def buildNetworkFromSegments(self, candidateManager, net, jobLogger=None, checkpoint=None):
         """
         MAKE SURE THAT SEGMENTS WITH IDENTICAL COORDINATES CORRESPOND TO THE SAME OBJECT
         MAKE SURE THAT NODES WITH IDENTICAL COORDINATES CORRESPOND TO THE SAME OBJECT
@@ -156,10 +171,16 @@ class VariableStore(variable_store.VariableStore):
         increment = 0.10
 
         # Cycle segments starting with the smallest first
-        candidateManager.nodeTuples.sort(order='w')
-        # keep a ref to the node array for convenience
-        nodes = candidateManager.nodes
-        for candidateTuple in candidateManager.nodeTuples:
+        if not candidateManager.isRestored:
+            candidateManager.nodeTuples.sort(order='w')
+            if checkpoint:
+                checkpoint.saveCandidates(candidateManager.nodeTuples)
+        # Resume from the last checkpoint by adding the segments we had added,
+        # which leaves the network and node weights as they were
+        completedSegments, addedCandidateIndices = checkpoint.loadProgress() if checkpoint else (0, [])
+        for candidateIndex in addedCandidateIndices:
+            self.addCandidate(candidateManager, net, candidateManager.nodeTuples[candidateIndex])
+        for candidateIndex in xrange(completedSegments, numSegments):
             completionPercentage = completedSegments / float(numSegments)
             if completionPercentage > nextReportThreshold:
                 time_format = "%Y-%m-%d %H:%M:%S"
@@ -169,37 +190,12 @@ class VariableStore(variable_store.VariableStore):
                 print "%s Processed %s (of %s) segments" % (strftime(time_format, localtime()), completedSegments, numSegments)
                 nextReportThreshold += increment
 
-            # Prepare
-            node1Index, node2Index = candidateTuple['i'], candidateTuple['j']
-            node1, node2 = nodes[node1Index], nodes[node2Index]
-            # Prepare
-            n1Weight, n2Weight, sWeight = node1.getWeight(), node2.getWeight(), candidateTuple['w']
-            node1Qualifies = n1Weight >= sWeight or node1.getID() < 0 # canAfford or isFake
-            node2Qualifies = n2Weight >= sWeight or node2.getID() < 0 # canAfford or isFake
-            # If the segment qualifies,
-            if node1Qualifies and node2Qualifies:
-            
-                # create a real segment at this point
-                # TODO:  Worth creating a segment view???
-                #        Might make this cleaner and save more space
-                #        in the event that many node pairs "qualify"
-                targetSegment = None
-                indexTuple = (node1Index, node2Index)
-                if candidateManager.targetSegmentLookup.has_key(indexTuple):
-                    targetSegment = candidateManager.targetSegmentLookup[indexTuple]
-                segment = net.segmentFactory.getSegment(node1.point.coords[0], 
-                        node2.point.coords[0], segmentWeight=sWeight, targetSegment=targetSegment) 
-
-                # Try to add the segment
-                subnet = net.addSegment(segment)
-
-                # If the segment was added,
-                if subnet:
-                    weight = n1Weight + n2Weight - sWeight
-                    for node in subnet.cycleNodes():
-                        node.setWeight(weight)
+            if self.addCandidate(candidateManager, net, candidateManager.nodeTuples[candidateIndex]):
+                addedCandidateIndices.append(candidateIndex)
 
             completedSegments += 1
+            if checkpoint and completedSegments % checkpoint.interval == 0:
+                checkpoint.saveProgress(completedSegments, addedCandidateIndices)
 
 
         time_format = "%Y-%m-%d %H:%M:%S"
@@ -211,6 +207,43 @@ class VariableStore(variable_store.VariableStore):
         return net
 
 
+    def addCandidate(self, candidateManager, net, candidateTuple):
+        'Add the candidate segment if both nodes qualify and it does not make a cycle; return True if we added it'
+        # Prepare
+        nodes = candidateManager.nodes
+        node1Index, node2Index = candidateTuple['i'], candidateTuple['j']
+        node1, node2 = nodes[node1Index], nodes[node2Index]
+        # Prepare
+        n1Weight, n2Weight, sWeight = node1.getWeight(), node2.getWeight(), candidateTuple['w']
+        node1Qualifies = n1Weight >= sWeight or node1.getID() < 0 # canAfford or isFake
+        node2Qualifies = n2Weight >= sWeight or node2.getID() < 0 # canAfford or isFake
+        # If the segment does not qualify,
+        if not (node1Qualifies and node2Qualifies):
+            return False
+        
+        # create a real segment at this point
+        # TODO:  Worth creating a segment view???
+        #        Might make this cleaner and save more space
+        #        in the event that many node pairs "qualify"
+        targetSegment = None
+        indexTuple = (node1Index, node2Index)
+        if candidateManager.targetSegmentLookup.has_key(indexTuple):
+            targetSegment = candidateManager.targetSegmentLookup[indexTuple]
+        segment = net.segmentFactory.getSegment(node1.point.coords[0], 
+                node2.point.coords[0], segmentWeight=sWeight, targetSegment=targetSegment) 
+
+        # Try to add the segment
+        subnet = net.addSegment(segment)
+
+        # If the segment was added,
+        if subnet:
+            weight = n1Weight + n2Weight - sWeight
+            for node in subnet.cycleNodes():
+                node.setWeight(weight)
+            return True
+        return False
+
+
 roots = [
     ExistingNetworks,
     MinimumNodeCountPerSubnetwork,
@@ -0,0 +1,281 @@
+"""
+Save and memory-map binary snapshots of a computed dataset
+
+A snapshot holds aligned NumPy arrays of nodes, segments and selected node
+outputs in a folder beside the dataset so that readers can iterate,
+summarize and export nodes without opening the database.
+"""
+# Import system modules
+import re
+import os
+import json
+import math
+import numpy
+import itertools
+# Import custom modules
+import store
+import column_store
+import geojson_store
+
+
+# Set constants
+indexName = 'snapshot.json'
+nodeFieldNames = ['id', 'x', 'y', 'longitude', 'latitude', 'metric', 'is_fake']
+segmentFieldNames = ['node1_id', 'node2_id', 'subnet_id', 'is_existing', 'weight']
+segmentPropertyNames = geojson_store.segmentPropertyNames
+
+
+# Core
+
+def save(folderPath, proj4, nodeArrayByName, segmentArrayByName, outputPacks):
+    """
+    Replace the snapshot in folderPath.
+    Node arrays are sorted by id; outputPacks are (propertyName, section, option, column)
+    where each column is aligned with the real nodes.
+    """
+    # Write into a temporary folder so that readers never see half a snapshot
+    temporaryPath = folderPath + '.tmp'
+    store.removeFolderSafely(temporaryPath)
+    store.makeFolderSafely(temporaryPath)
+    # Save arrays
+    for prefix, fieldNames, arrayByName in ('node', nodeFieldNames, nodeArrayByName), ('segment', segmentFieldNames, segmentArrayByName):
+        for fieldName in fieldNames:
+            numpy.save(os.path.join(temporaryPath, '%s_%s.npy' % (prefix, fieldName)), arrayByName[fieldName])
+    outputs = []
+    for outputIndex, (propertyName, section, option, column) in enumerate(outputPacks):
+        fileName = 'output%d.npy' % outputIndex
+        numpy.save(os.path.join(temporaryPath, fileName), column)
+        outputs.append([propertyName, section, option, fileName])
+    # Save index
+    json.dump({'proj4': proj4, 'outputs': outputs}, open(os.path.join(temporaryPath, indexName), 'wt'))
+    # Replace
+    store.removeFolderSafely(folderPath)
+    os.rename(temporaryPath, folderPath)
+
+def load(folderPath):
+    'Return the Snapshot in folderPath'
+    if not has(folderPath):
+        raise SnapshotError('Snapshot not found: %s' % folderPath)
+    return Snapshot(folderPath)
+
+def has(folderPath):
+    return os.path.exists(os.path.join(folderPath, indexName))
+
+
+class Snapshot(object):
+    'Memory-map snapshot arrays on demand'
+
+    chunkSize = 10000
+
+    def __init__(self, folderPath):
+        self.folderPath = folderPath
+        self.arrayByFileName = {}
+        # Load index
+        index = json.load(open(os.path.join(folderPath, indexName), 'rt'))
+        self.proj4 = str(index['proj4'])
+        self.outputPacks = [tuple(str(y) for y in x) for x in index['outputs']]
+
+    def getProj4(self):
+        return self.proj4
+
+    def getArray(self, fileName):
+        if fileName not in self.arrayByFileName:
+            self.arrayByFileName[fileName] = numpy.load(os.path.join(self.folderPath, fileName), mmap_mode='r')
+        return self.arrayByFileName[fileName]
+
+    def getNodeArray(self, fieldName):
+        'Return the memory-mapped field for all nodes in id order'
+        if fieldName not in nodeFieldNames:
+            raise SnapshotError('Node field not found: %s' % fieldName)
+        return self.getArray('node_%s.npy' % fieldName)
+
+    def getSegmentArray(self, fieldName):
+        'Return the memory-mapped field for all segments'
+        if fieldName not in segmentFieldNames:
+            raise SnapshotError('Segment field not found: %s' % fieldName)
+        return self.getArray('segment_%s.npy' % fieldName)
+
+    def getOutputPropertyNames(self):
+        return [x[0] for x in self.outputPacks]
+
+    def hasOutput(self, section, option):
+        return any(x[1:3] == (section, option) for x in self.outputPacks)
+
+    def getOutputColumn(self, section, option):
+        'Return the memory-mapped output column aligned with the real nodes'
+        for propertyName, outputSection, outputOption, fileName in self.outputPacks:
+            if (outputSection, outputOption) == (section, option):
+                return self.getArray(fileName)
+        raise SnapshotError('Output not found: %s > %s' % (section, option))
+
+    def parseOutputPropertyName(self, propertyName):
+        'Return the section and option for an output property name'
+        for outputPropertyName, section, option, fileName in self.outputPacks:
+            if outputPropertyName == propertyName:
+                return section, option
+        match = re.match(r'(.*?)\s*>\s*(.*)', propertyName)
+        if not match:
+            raise SnapshotError('Unknown property: %s' % propertyName)
+        return match.groups()
+
+    def getNodeIndices(self, isFake=False):
+        'Return the positions of real or fake nodes in the node arrays'
+        return numpy.flatnonzero(self.getNodeArray('is_fake') == isFake)
+
+    # Node
+
+    def countNodes(self, isFake=False):
+        return len(self.getNodeIndices(isFake))
+
+    def cycleNodes(self, isFake=False):
+        'Generate SnapshotNodes in id order; set isFake=True to return fake nodes'
+        arrays = [self.getNodeArray(x) for x in nodeFieldNames]
+        nodeIndices = self.getNodeIndices(isFake)
+        # For each chunk,
+        for chunkIndex in xrange(0, len(nodeIndices), self.chunkSize):
+            chunkIndices = nodeIndices[chunkIndex:chunkIndex + self.chunkSize]
+            for values in itertools.izip(*[x[chunkIndices].tolist() for x in arrays]):
+                yield SnapshotNode(*values)
+
+    def getNodeStatistics(self):
+        'Match Store.getNodeStatistics'
+        longitudes, latitudes = self.getNodeArray('longitude'), self.getNodeArray('latitude')
+        hasNodes = len(longitudes) > 0
+        return {
+            'node count': self.countNodes(),
+            'maximum longitude': float(longitudes.max()) if hasNodes else None,
+            'mean longitude': float(longitudes.mean()) if hasNodes else None,
+            'minimum longitude': float(longitudes.min()) if hasNodes else None,
+            'maximum latitude': float(latitudes.max()) if hasNodes else None,
+            'mean latitude': float(latitudes.mean()) if hasNodes else None,
+            'minimum latitude': float(latitudes.min()) if hasNodes else None,
+        }
+
+    def getMetricStatistics(self):
+        'Match Store.getMetricStatistics'
+        metrics = numpy.asarray(self.getNodeArray('metric'))[self.getNodeIndices()]
+        metrics = metrics[~numpy.isnan(metrics)]
+        hasMetrics = len(metrics) > 0
+        statistics = {
+            'minimum metric': float(metrics.min()) if hasMetrics else None,
+            'maximum metric': float(metrics.max()) if hasMetrics else None,
+            'mean metric': float(metrics.mean()) if hasMetrics else None,
+        }
+        statistics.update(column_store.summarizeOutputs(
+            self.getOutputColumn('metric', 'system'),
+            self.getOutputColumn('demographics', 'population count')))
+        return statistics
+
+    # Segment
+
+    def countSegments(self, is_existing=None):
+        isExistings = self.getSegmentArray('is_existing')
+        return len(isExistings) if is_existing is None else int(numpy.count_nonzero(isExistings == is_existing))
+
+    def getSegmentCommonCoordinates(self):
+        'Return an array of ((longitude1, latitude1), (longitude2, latitude2)) for each segment'
+        nodeIDs = self.getNodeArray('id')
+        commonCoordinates = numpy.column_stack([self.getNodeArray('longitude'), self.getNodeArray('latitude')])
+        return numpy.concatenate([
+            commonCoordinates[numpy.searchsorted(nodeIDs, self.getSegmentArray('node1_id'))][:, numpy.newaxis],
+            commonCoordinates[numpy.searchsorted(nodeIDs, self.getSegmentArray('node2_id'))][:, numpy.newaxis],
+        ], axis=1).reshape(-1, 2, 2)
+
+    # Export
+
+    def yieldGeoJSON(self, transform_points=None, bbox=None, propertyNames=None):
+        """
+        Generate the same GeoJSON FeatureCollection as Store.yieldGeoJSON.
+        propertyNames selects from the output property names of the snapshot, 'section > option' or segmentPropertyNames.
+        """
+        # Prepare properties
+        if propertyNames is None:
+            propertyNames = sorted(self.getOutputPropertyNames()) + segmentPropertyNames
+        nodePropertyNames = [x for x in propertyNames if x not in segmentPropertyNames]
+        nodePropertyColumns = [self.getOutputColumn(*self.parseOutputPropertyName(x)) for x in nodePropertyNames]
+        selectedSegmentPropertyNames = [x for x in propertyNames if x in segmentPropertyNames]
+        # Prepare nodes
+        nodeIndices = self.getNodeIndices()
+        nodeIDs = self.getNodeArray('id')[nodeIndices]
+        longitudes = self.getNodeArray('longitude')[nodeIndices]
+        latitudes = self.getNodeArray('latitude')[nodeIndices]
+        outputIndices = numpy.arange(len(nodeIndices))
+        # Prepare segments
+        segmentCoordinates = self.getSegmentCommonCoordinates()
+        segmentIndices = numpy.arange(len(segmentCoordinates))
+        # If we have a bounding box,
+        if bbox:
+            minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bbox
+            isInside = (longitudes >= minimumLongitude) & (longitudes <= maximumLongitude) & (latitudes >= minimumLatitude) & (latitudes <= maximumLatitude)
+            outputIndices = outputIndices[isInside]
+            segmentMinimums, segmentMaximums = segmentCoordinates.min(axis=1), segmentCoordinates.max(axis=1)
+            segmentIndices = segmentIndices[
+                (segmentMaximums[:, 0] >= minimumLongitude) & (segmentMinimums[:, 0] <= maximumLongitude) &
+                (segmentMaximums[:, 1] >= minimumLatitude) & (segmentMinimums[:, 1] <= maximumLatitude)]
+        # Yield
+        segmentArrays = [self.getSegmentArray(x) for x in segmentFieldNames]
+        def yieldFeatureChunks():
+            # For each chunk of nodes,
+            for chunkIndex in xrange(0, len(outputIndices), self.chunkSize):
+                chunkIndices = outputIndices[chunkIndex:chunkIndex + self.chunkSize]
+                yield geojson_store.encodeNodes(
+                    nodeIDs[chunkIndices].tolist(),
+                    transformArrays(longitudes[chunkIndices], latitudes[chunkIndices], transform_points),
+                    nodePropertyNames,
+                    [[column_store.formatValue(y) for y in x[chunkIndices]] for x in nodePropertyColumns])
+            # For each chunk of segments,
+            for chunkIndex in xrange(0, len(segmentIndices), self.chunkSize):
+                chunkIndices = segmentIndices[chunkIndex:chunkIndex + self.chunkSize]
+                chunkCoordinates = segmentCoordinates[chunkIndices].reshape(-1, 2)
+                yield geojson_store.encodeSegments(
+                    itertools.izip(*[x[chunkIndices].tolist() for x in segmentArrays]),
+                    transformArrays(chunkCoordinates[:, 0], chunkCoordinates[:, 1], transform_points),
+                    selectedSegmentPropertyNames)
+        return geojson_store.yieldFeatureCollection(yieldFeatureChunks())
+
+
+class SnapshotNode(object):
+    'Lightweight node with the coordinates and metric of a dataset_store.Node'
+
+    __slots__ = nodeFieldNames
+
+    def __init__(self, id, x, y, longitude, latitude, metric, is_fake):
+        self.id = id
+        self.x, self.y = x, y
+        self.longitude, self.latitude = longitude, latitude
+        self.metric = None if metric is None or math.isnan(metric) else metric
+        self.is_fake = bool(is_fake)
+
+    def getX(self):
+        return self.x
+
+    def getY(self):
+        return self.y
+
+    def getCoordinates(self):
+        return self.getX(), self.getY()
+
+    def getCommonCoordinates(self):
+        return self.longitude, self.latitude
+
+    @property
+    def __geo_interface__(self):
+        return {'type': 'Point', 'coordinates': self.getCoordinates()}
+
+    def __repr__(self):
+        return '<SnapshotNode(longitude=%s, latitude=%s)>' % (self.longitude, self.latitude)
+
+
+# Helpers
+
+def transformArrays(xs, ys, transform_points=None):
+    'Return a list of coordinate pairs, transformed in one call if we have transform_points'
+    if transform_points:
+        xs, ys = transform_points(xs, ys)
+    return zip(numpy.asarray(xs).tolist(), numpy.asarray(ys).tolist())
+
+
+# Error
+
+class SnapshotError(Exception):
+    pass
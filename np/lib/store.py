@@ -2,10 +2,11 @@
 # Import system modules
 import re
 import os
-import sys
 import math
 import time
 import random
+import shutil
+import importlib
 import zipfile
 import datetime
 import itertools
@@ -46,6 +47,10 @@ def removeSafely(filePath):
     if os.path.exists(filePath): 
         os.remove(filePath)
 
+def removeFolderSafely(folderPath):
+    if os.path.exists(folderPath):
+        shutil.rmtree(folderPath)
+
 def binPath(rootPath, fileID):
     # Convert to an integer
     fileID = int(fileID)
@@ -202,19 +207,56 @@ def loadQueue(queuePath, convertByName=None):
     return parameterByTaskByName
 
 
+# Import
+
+class LazyModule(object):
+    'Proxy that defers importing a heavy module until one of its attributes is requested'
+
+    def __init__(self, moduleName):
+        self.__dict__['moduleName'] = moduleName
+        self.__dict__['module'] = None
+
+    def __getattr__(self, name):
+        # If we have not imported the module yet,
+        if self.__dict__['module'] is None:
+            # Import it
+            self.__dict__['module'] = importlib.import_module(self.__dict__['moduleName'])
+        # Return
+        return getattr(self.__dict__['module'], name)
+
+    def __repr__(self):
+        return '<LazyModule(%s)>' % self.__dict__['moduleName']
+
+
 # Model
 
-def getModel(scriptPath, modelName, availableNames):
-    # If the modelName is invalid,
-    if modelName not in availableNames:
-        raise StoreError('Model %s is not available' % modelName)
-    # Load model
-    modelFolderPath = os.path.dirname(scriptPath)
-    sys.path.append(modelFolderPath)
-    model = __import__(modelName)
-    sys.path.remove(modelFolderPath)
-    # Return
-    return model
+class ModelRegistry(object):
+    'Import each model once as a submodule of its package and remember how long the import took'
+
+    def __init__(self, packageName, modelNames):
+        self.packageName = packageName
+        self.modelNames = modelNames
+        self.modelByName = {}
+        self.importTimeByName = {}
+
+    def getModel(self, modelName):
+        'Return the model, importing it on first request'
+        # If the modelName is invalid,
+        if modelName not in self.modelNames:
+            raise StoreError('Model %s is not available' % modelName)
+        # If we have not loaded the model yet,
+        if modelName not in self.modelByName:
+            # Import it as packageName.modelName so that its sibling modules stay namespaced
+            startTimeInSeconds = time.time()
+            model = importlib.import_module('%s.%s' % (self.packageName, modelName))
+            self.importTimeByName[modelName] = time.time() - startTimeInSeconds
+            self.modelByName[modelName] = model
+        # Return
+        return self.modelByName[modelName]
+
+    def getImportTimes(self):
+        'Return import time in seconds for each model loaded so far'
+        return dict(self.importTimeByName)
 
 
 # Stringify
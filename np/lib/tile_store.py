@@ -0,0 +1,151 @@
+"""
+Split the extent of a dataset into spatial tiles for parallel processing
+
+Tiles are boxes in longitude and latitude that together cover every real
+node.  Each node and each segment midpoint belongs to the first tile whose
+box contains it, so that a merge can keep exactly one copy of everything
+that overlapping buffers duplicate.
+"""
+# Import system modules
+import os
+import json
+import math
+import numpy
+# Import custom modules
+import store
+
+
+# Set constants
+indexName = 'partition.json'
+
+
+# Core
+
+def makeTiles(longitudes, latitudes, method, tileCount):
+    'Return up to tileCount boxes that cover the nodes using a method from makeTilesByMethod'
+    if method not in makeTilesByMethod:
+        raise TileError('Partition method must be one of: ' + ' '.join(sorted(makeTilesByMethod)))
+    if not len(longitudes):
+        raise TileError('Cannot partition a dataset without nodes')
+    return makeTilesByMethod[method](numpy.asarray(longitudes, dtype=float), numpy.asarray(latitudes, dtype=float), int(tileCount))
+
+def makeGridTiles(longitudes, latitudes, tileCount):
+    'Split the extent into a grid of equal boxes with about as many columns as rows'
+    columnCount = int(math.ceil(math.sqrt(tileCount)))
+    rowCount = int(math.ceil(tileCount / float(columnCount)))
+    longitudeEdges = numpy.linspace(longitudes.min(), longitudes.max(), columnCount + 1).tolist()
+    latitudeEdges = numpy.linspace(latitudes.min(), latitudes.max(), rowCount + 1).tolist()
+    return [(longitudeEdges[columnIndex], latitudeEdges[rowIndex], longitudeEdges[columnIndex + 1], latitudeEdges[rowIndex + 1]) for rowIndex in xrange(rowCount) for columnIndex in xrange(columnCount)]
+
+def makeKDTiles(longitudes, latitudes, tileCount):
+    'Split the box with the most nodes at the median of its wider side until we have tileCount boxes'
+    tilePacks = [((longitudes.min(), latitudes.min(), longitudes.max(), latitudes.max()), numpy.arange(len(longitudes)))]
+    while len(tilePacks) < tileCount:
+        # Pick the box with the most nodes
+        tileIndex = max(xrange(len(tilePacks)), key=lambda x: len(tilePacks[x][1]))
+        (minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude), nodeIndices = tilePacks[tileIndex]
+        # Split its wider side at the median
+        isLongitude = maximumLongitude - minimumLongitude >= maximumLatitude - minimumLatitude
+        values = (longitudes if isLongitude else latitudes)[nodeIndices]
+        median = float(numpy.median(values))
+        isLower = values <= median
+        # If every node is on one side, we cannot split any further
+        if isLower.all():
+            break
+        if isLongitude:
+            lowerBBox, upperBBox = (minimumLongitude, minimumLatitude, median, maximumLatitude), (median, minimumLatitude, maximumLongitude, maximumLatitude)
+        else:
+            lowerBBox, upperBBox = (minimumLongitude, minimumLatitude, maximumLongitude, median), (minimumLongitude, median, maximumLongitude, maximumLatitude)
+        tilePacks[tileIndex:tileIndex + 1] = [(lowerBBox, nodeIndices[isLower]), (upperBBox, nodeIndices[~isLower])]
+    return [tuple(float(y) for y in x[0]) for x in tilePacks]
+
+makeTilesByMethod = {
+    'grid': makeGridTiles,
+    'kd': makeKDTiles,
+}
+
+def getOwnerIndices(longitudes, latitudes, bboxes):
+    'Return the index of the first box that contains each point or -1 if no box does'
+    longitudes = numpy.asarray(longitudes, dtype=float)
+    latitudes = numpy.asarray(latitudes, dtype=float)
+    ownerIndices = -numpy.ones(len(longitudes), dtype=int)
+    for tileIndex, bbox in enumerate(bboxes):
+        ownerIndices[(ownerIndices < 0) & isInside(longitudes, latitudes, bbox)] = tileIndex
+    return ownerIndices
+
+def clampToTiles(longitudes, latitudes, bboxes):
+    'Move points outside of the tiles to the nearest edge of their extent'
+    bboxes = numpy.array(bboxes, dtype=float).reshape(-1, 4)
+    return (
+        numpy.clip(longitudes, bboxes[:, 0].min(), bboxes[:, 2].max()),
+        numpy.clip(latitudes, bboxes[:, 1].min(), bboxes[:, 3].max()))
+
+def isInside(longitudes, latitudes, bbox):
+    minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bbox
+    return (longitudes >= minimumLongitude) & (longitudes <= maximumLongitude) & (latitudes >= minimumLatitude) & (latitudes <= maximumLatitude)
+
+def getBufferedBBox(bbox, bufferSize):
+    'Expand the box by bufferSize degrees on every side'
+    minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude = bbox
+    return minimumLongitude - bufferSize, minimumLatitude - bufferSize, maximumLongitude + bufferSize, maximumLatitude + bufferSize
+
+
+# Partition
+
+def save(folderPath, partition):
+    'Save partition metadata'
+    store.makeFolderSafely(folderPath)
+    json.dump(partition, open(os.path.join(folderPath, indexName), 'wt'), indent=4)
+
+def load(folderPath):
+    'Load partition metadata'
+    if not has(folderPath):
+        raise TileError('Partition not found: %s' % folderPath)
+    return json.load(open(os.path.join(folderPath, indexName), 'rt'))
+
+def has(folderPath):
+    return os.path.exists(os.path.join(folderPath, indexName))
+
+
+# Helpers
+
+def labelComponents(nodeIDPairs):
+    'Return the index of the connected component of each pair of node ids'
+    components = Components()
+    for node1ID, node2ID in nodeIDPairs:
+        components.join(node1ID, node2ID)
+    componentIndexByRoot = {}
+    return [componentIndexByRoot.setdefault(components.find(node1ID), len(componentIndexByRoot)) for node1ID, node2ID in nodeIDPairs]
+
+
+class Components(object):
+    'Track connected components of node ids with union-find'
+
+    def __init__(self):
+        self.parentByNodeID = {}
+
+    def find(self, nodeID):
+        'Return the root node id of the component of the node'
+        parentByNodeID = self.parentByNodeID
+        root = nodeID
+        while parentByNodeID.setdefault(root, root) != root:
+            root = parentByNodeID[root]
+        while nodeID != root:
+            parentNodeID = parentByNodeID[nodeID]
+            parentByNodeID[nodeID] = root
+            nodeID = parentNodeID
+        return root
+
+    def join(self, node1ID, node2ID):
+        'Connect the nodes and return False if they were already connected'
+        root1, root2 = self.find(node1ID), self.find(node2ID)
+        if root1 == root2:
+            return False
+        self.parentByNodeID[root1] = root2
+        return True
+
+
+# Error
+
+class TileError(Exception):
+    pass
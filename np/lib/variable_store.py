@@ -5,6 +5,7 @@ Classes for caching variables
 !!! Add support for html_output property
 """
 # Import system modules
+import sys
 import collections
 
 
@@ -33,6 +34,9 @@ class VariableStore(object):
             valueByOptionBySection = {}
         self.variableStore = variableStore
         self.variableByClass = {}
+        self.overrideClasses = frozenset()
+        self.isLocalByClass = None
+        self.isLocalByClassByOverrideClasses = {}
         self.state = state
         # Populate variableClasses using variableModules
         for variableModule in self.variableModules:
@@ -47,18 +51,30 @@ class VariableStore(object):
         # Make sure there are no name or alias overlaps
         validateVariableClasses(self.variableClasses + self.aggregateClasses + self.summaryClasses)
         # Prepare cache
+        variableClassValuePacks = []
         for variableClass in self.variableClasses:
             # Extract
             storeInCache, value = extractVariableValue(valueByOptionBySection, variableClass, variableStore)
             # If we need to store the variable in the cache,
             if storeInCache:
-                # Store the variable by class in the cache
-                self.set(variableClass, value)
+                variableClassValuePacks.append((variableClass, value))
+        self.setMany(variableClassValuePacks)
 
     def set(self, variableClass, value=None):
         'Set the value of the variable corresponding to the given class'
-        # Store the variable by class in the cache
-        self.variableByClass[variableClass] = variableClass(self, value)
+        self.setMany([(variableClass, value)])
+
+    def setMany(self, variableClassValuePacks):
+        'Set the values of the variables corresponding to the given classes, updating the overrides once'
+        variableClasses = []
+        for variableClass, value in variableClassValuePacks:
+            # Store the variable by class in the cache
+            self.variableByClass[variableClass] = variableClass(self, value)
+            variableClasses.append(variableClass)
+        # Variables that depend on these must now be computed locally
+        if variableClasses:
+            self.overrideClasses = self.overrideClasses.union(variableClasses)
+            self.isLocalByClass = None
 
     def get(self, variableClass):
         return self.getVariable(variableClass).value
@@ -70,14 +86,14 @@ class VariableStore(object):
             # Return the variable from the cache
             return self.variableByClass[variableClass]
         # If the variable has dependencies and any of the variable's 
-        # dependencies are in the cache,
+        # dependencies are overridden in this store,
         if variableClass.dependencies and self.has(variableClass.dependencies):
             # Recompute the variable
             variable = variableClass(self)
         # If a parent is defined,
         elif self.variableStore:
-            # Get the variable from the parent
-            variable = self.variableStore.getVariable(variableClass)
+            # Read the variable from the parent without keeping a copy
+            return self.variableStore.getVariable(variableClass)
         # Otherwise,
         else:
             raise VariableError('Unable to get ' + variableClass.__name__)
@@ -121,21 +137,43 @@ class VariableStore(object):
         return valueByOptionBySection
 
     def has(self, variableClasses):
-        'Return true if any of the variables are in the cache'
+        'Return true if any of the variables are overridden or depend on an override in this store'
+        # Share answers between stores that override the same variables
+        if self.isLocalByClass is None:
+            self.isLocalByClass = self.getRoot().getIsLocalByClass(self.overrideClasses)
         # For each variableClass,
         for variableClass in variableClasses:
-            # If the variableClass is in the cache or any of its dependencies is in the cache,
-            if variableClass in self.variableByClass or (variableClass.dependencies and self.has(variableClass.dependencies)):
+            # If the variableClass is overridden or any of its dependencies is overridden,
+            if isLocal(variableClass, self.overrideClasses, self.isLocalByClass):
                 # Return true
                 return True
         # Return false
         return False
 
+    def getOverlaySize(self):
+        'Return the number of variables cached in this store and their approximate size in bytes'
+        byteCount = sys.getsizeof(self.variableByClass)
+        for variable in self.variableByClass.itervalues():
+            byteCount += sys.getsizeof(variable) + sys.getsizeof(variable.__dict__) + sys.getsizeof(variable.value)
+        return len(self.variableByClass), byteCount
+
+    def getRoot(self):
+        'Return the store at the top of the hierarchy'
+        return self.variableStore.getRoot() if self.variableStore else self
+
+    def getIsLocalByClass(self, overrideClasses):
+        'Return the memo of which classes depend on the given overrides, shared between the stores under this root'
+        if overrideClasses in self.isLocalByClassByOverrideClasses:
+            return self.isLocalByClassByOverrideClasses[overrideClasses]
+        isLocalByClass = {}
+        # Stop sharing once there are too many distinct sets of overrides
+        if len(self.isLocalByClassByOverrideClasses) < maximumOverrideMemoCount:
+            self.isLocalByClassByOverrideClasses[overrideClasses] = isLocalByClass
+        return isLocalByClass
+
     def initializeAggregates(self):
-        # For each aggregateClass,
-        for aggregateClass in self.aggregateClasses:
-            # Set
-            self.set(aggregateClass)
+        # Set each aggregateClass
+        self.setMany((x, None) for x in self.aggregateClasses)
 
     def updateAggregates(self, childVS):
         # For each aggregateClass,
@@ -150,6 +188,19 @@ class VariableStore(object):
             self.get(summaryClass)
 
 
+# Overlay
+
+maximumOverrideMemoCount = 256
+
+def isLocal(variableClass, overrideClasses, isLocalByClass):
+    'Return true if the variableClass is overridden or depends on an override'
+    if variableClass not in isLocalByClass:
+        isLocalByClass[variableClass] = variableClass in overrideClasses or bool(
+            variableClass.dependencies and 
+            any(isLocal(x, overrideClasses, isLocalByClass) for x in variableClass.dependencies))
+    return isLocalByClass[variableClass]
+
+
 # Variable
 
 class Variable(object):
@@ -460,7 +511,8 @@ def parseKey(key):
 
 def formatLabel(x):
     'Return label whether we have an object or a class'
-    return '%s-%s' % (x.__module__.lower().replace('.', '-'), getattr(x, '__name__', x.__class__.__name__).lower())
+    moduleName = x.__module__.replace(BASE_PATH + ".", "")
+    return '%s-%s' % (moduleName.lower().replace('.', '-'), getattr(x, '__name__', x.__class__.__name__).lower())
 
 
 # Input
@@ -0,0 +1,299 @@
+'Measure the performance of np/lib to catch regressions locally'
+# Import system modules
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import tempfile
+import itertools
+import subprocess
+import collections
+import numpy
+
+
+# Define imports benchmark
+
+importTargets = [
+    'np',
+    'np.lib.dataset_store',
+    'np.lib.network.modKruskal',
+    'np.lib.metric.mvMax2',
+    'np.lib.metric.mvMax3',
+    'np.lib.metric.mvMax4',
+    'np.lib.metric.mvMax5',
+]
+importScript = """\
+import sys, time, resource
+startTimeInSeconds = time.time()
+__import__(sys.argv[1])
+print time.time() - startTimeInSeconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+
+def measureImport(moduleName, repeatCount=3):
+    'Return the best cold import time in seconds and peak RSS in kilobytes over repeatCount fresh interpreters'
+    measurements = []
+    for repeatIndex in xrange(repeatCount):
+        output = subprocess.check_output([sys.executable, '-c', importScript, moduleName])
+        elapsedTimeInSeconds, maximumRSS = output.split()[-2:]
+        measurements.append((float(elapsedTimeInSeconds), int(maximumRSS)))
+    return min(measurements)
+
+
+def benchmarkImports(argv):
+    """
+    Measure cold import time and RSS for each target module
+    --baseline PATH   compare against (or, with --save, write) a JSON baseline
+    --save            write the measurements to the baseline
+    --threshold X     fail if a module is more than X times slower than its baseline (default 1.25)
+    --repeat N        number of fresh interpreters per module (default 3)
+    """
+    options = parseOptions(argv, dict(baseline='', threshold='1.25', repeat='3'), ['save'])
+    threshold = float(options['threshold'])
+    # Measure
+    resultByModuleName = {}
+    for moduleName in importTargets:
+        elapsedTimeInSeconds, maximumRSS = measureImport(moduleName, int(options['repeat']))
+        resultByModuleName[moduleName] = {
+            'import time in seconds': elapsedTimeInSeconds,
+            'maximum rss in kilobytes': maximumRSS,
+        }
+    # Load baseline
+    baselineByModuleName = {}
+    if options['baseline'] and os.path.exists(options['baseline']) and not options['save']:
+        baselineByModuleName = json.load(open(options['baseline']))
+    # Report
+    regressions = []
+    print '%-30s %10s %10s %10s' % ('module', 'seconds', 'rss (kB)', 'baseline')
+    for moduleName in importTargets:
+        result = resultByModuleName[moduleName]
+        elapsedTimeInSeconds = result['import time in seconds']
+        baseline = baselineByModuleName.get(moduleName, {}).get('import time in seconds')
+        print '%-30s %10.3f %10d %10s' % (moduleName, elapsedTimeInSeconds, result['maximum rss in kilobytes'], '%.3f' % baseline if baseline else '')
+        if baseline and elapsedTimeInSeconds > baseline * threshold:
+            regressions.append(moduleName)
+    # Save baseline
+    if options['save'] and options['baseline']:
+        json.dump(resultByModuleName, open(options['baseline'], 'wt'), indent=4, sort_keys=True)
+    # If we have regressions,
+    if regressions:
+        print 'Import time regressed by more than %sx: %s' % (threshold, ' '.join(regressions))
+        return 1
+    return 0
+
+
+# Define overlay benchmark
+
+def benchmarkOverlay(argv):
+    """
+    Report the size of node-level VariableStore overlays on a synthetic dataset
+    --model NAME      metric model (default mvMax5)
+    --nodes N         number of nodes (default 1000)
+    --seed N          random seed for node populations (default 0)
+    """
+    from np.lib import metric
+    options = parseOptions(argv, dict(model='mvMax5', nodes='1000', seed='0'))
+    metricModel = metric.getModel(options['model'])
+    random = numpy.random.RandomState(int(options['seed']))
+    # Most nodes override only the population; a few override a second column
+    jobVS = metricModel.VariableStore()
+    variableCounts, byteCounts = [], []
+    for nodeIndex in xrange(int(options['nodes'])):
+        valueByOptionBySection = {'demographics': {'population count': int(random.lognormal(6, 1.5))}}
+        if random.random_sample() < 0.1:
+            valueByOptionBySection['demand (household)'] = {'target household count': int(random.lognormal(5, 1.5))}
+        nodeVS = metricModel.VariableStore(valueByOptionBySection, jobVS)
+        nodeVS.get(metricModel.Metric)
+        nodeVS.getValueByOptionBySection()
+        variableCount, byteCount = nodeVS.getOverlaySize()
+        variableCounts.append(variableCount)
+        byteCounts.append(byteCount)
+    # Report
+    jobVariableCount, jobByteCount = jobVS.getOverlaySize()
+    print '%-30s %10s %10s' % ('store', 'variables', 'bytes')
+    print '%-30s %10d %10d' % ('job', jobVariableCount, jobByteCount)
+    print '%-30s %10.1f %10.1f' % ('node (mean)', numpy.mean(variableCounts), numpy.mean(byteCounts))
+    print '%-30s %10d %10d' % ('node (max)', max(variableCounts), max(byteCounts))
+    print '%-30s %10s %10d' % ('nodes (total)', '', sum(byteCounts))
+    return 0
+
+
+# Define ingest benchmark
+
+def benchmarkIngest(argv):
+    """
+    Time Store.addNodes on synthetic nodes
+    --counts N,N,...  node counts (default 10000,100000,1000000)
+    --proj4 TEXT      spatial reference of the synthetic coordinates (default longitude and latitude)
+    --duplicates X    fraction of nodes that repeat an earlier coordinate (default 0.01)
+    """
+    from np.lib import dataset_store, geometry_store
+    options = parseOptions(argv, dict(counts='10000,100000,1000000', proj4=geometry_store.proj4LL, duplicates='0.01'))
+    random = numpy.random.RandomState(0)
+    temporaryFolder = tempfile.mkdtemp()
+    try:
+        print '%-10s %10s %12s' % ('nodes', 'seconds', 'nodes/second')
+        for nodeCount in (int(x) for x in options['counts'].split(',')):
+            # Make nodes
+            coordinates = random.uniform(-10, 10, (nodeCount, 2))
+            duplicateCount = int(nodeCount * float(options['duplicates']))
+            coordinates[random.randint(0, nodeCount, duplicateCount)] = coordinates[random.randint(0, nodeCount, duplicateCount)]
+            populationCounts = random.randint(0, 5000, nodeCount)
+            nodePacks = [dict(name='n%s' % index, x=repr(x), y=repr(y), population=str(population)) for index, ((x, y), population) in enumerate(itertools.izip(coordinates.tolist(), populationCounts))]
+            # Ingest
+            dataset = dataset_store.Store(os.path.join(temporaryFolder, 'ingest%s' % nodeCount), options['proj4'])
+            startTimeInSeconds = time.time()
+            dataset.addNodes(nodePacks, lambda x, y: sys.stdout.write('%s/%s\r' % (x, y)))
+            elapsedTimeInSeconds = time.time() - startTimeInSeconds
+            print '%-10d %10.3f %12.0f' % (nodeCount, elapsedTimeInSeconds, nodeCount / elapsedTimeInSeconds)
+            dataset.session.close()
+    finally:
+        shutil.rmtree(temporaryFolder)
+    return 0
+
+
+# Define profiles benchmark
+
+def benchmarkProfiles(argv):
+    """
+    Time each phase of a job under each SQLite connection profile
+    --nodes N         number of synthetic nodes (default 10000)
+    --metric NAME     metric model (default mvMax5)
+    --network NAME    network model (default modKruskal)
+    """
+    from np.lib import dataset_store, geometry_store, metric, network
+    options = parseOptions(argv, dict(nodes='10000', metric='mvMax5', network='modKruskal'))
+    metricModel = metric.getModel(options['metric'])
+    networkModel = network.getModel(options['network'])
+    nodeCount = int(options['nodes'])
+    random = numpy.random.RandomState(0)
+    nodePacks = [dict(name='n%s' % index, x=repr(x), y=repr(y), population=str(population)) for index, ((x, y), population) in enumerate(itertools.izip(
+        random.uniform(-1, 1, (nodeCount, 2)).tolist(), 
+        random.randint(0, 5000, nodeCount)))]
+    phases = [
+        ('addNodes', lambda dataset: dataset.addNodes(nodePacks)),
+        ('applyMetric', lambda dataset: dataset.applyMetric(metricModel, {})),
+        ('buildNetwork', lambda dataset: dataset.buildNetwork(networkModel, {})),
+        ('updateMetric', lambda dataset: dataset.updateMetric(metricModel, {})),
+        ('getMetricStatistics', lambda dataset: dataset.getMetricStatistics()),
+        ('exportGeoJSON', lambda dataset: dataset.exportGeoJSON()),
+        ('saveMetricsCSV', lambda dataset: dataset.saveMetricsCSV(os.path.join(temporaryFolder, 'metrics.csv'), metricModel)),
+    ]
+    temporaryFolder = tempfile.mkdtemp()
+    try:
+        profiles = sorted(dataset_store.pragmasByProfile)
+        print '%-20s' % 'phase' + ''.join('%12s' % x for x in profiles)
+        elapsedTimesByPhase = collections.defaultdict(list)
+        for profile in profiles:
+            # Run every phase, reads and writes alike, under the same profile
+            dataset = dataset_store.Store(os.path.join(temporaryFolder, profile), geometry_store.proj4LL, profile=profile)
+            dataset.writeProfile = profile
+            for phaseName, runPhase in phases:
+                startTimeInSeconds = time.time()
+                runPhase(dataset)
+                elapsedTimesByPhase[phaseName].append(time.time() - startTimeInSeconds)
+            dataset.session.close()
+        for phaseName, runPhase in phases:
+            print '%-20s' % phaseName + ''.join('%12.3f' % x for x in elapsedTimesByPhase[phaseName])
+    finally:
+        shutil.rmtree(temporaryFolder)
+    return 0
+
+
+# Define bbox benchmark
+
+def benchmarkBBox(argv):
+    """
+    Time viewport and nearest node queries with the spatial index against a full scan
+    --nodes N         number of synthetic nodes (default 500000)
+    --queries N       number of random boxes and points (default 20)
+    --size X          width of each box in degrees (default 0.1)
+    """
+    from np.lib import dataset_store, geometry_store
+    options = parseOptions(argv, dict(nodes='500000', queries='20', size='0.1'))
+    nodeCount, queryCount, boxSize = int(options['nodes']), int(options['queries']), float(options['size'])
+    random = numpy.random.RandomState(0)
+    temporaryFolder = tempfile.mkdtemp()
+    try:
+        # Make dataset
+        nodePacks = [dict(name='n%s' % index, x=repr(x), y=repr(y)) for index, (x, y) in enumerate(random.uniform(-10, 10, (nodeCount, 2)).tolist())]
+        dataset = dataset_store.Store(os.path.join(temporaryFolder, 'bbox'), geometry_store.proj4LL)
+        dataset.addNodes(nodePacks)
+        bboxes = [(x, y, x + boxSize, y + boxSize) for x, y in random.uniform(-10, 10 - boxSize, (queryCount, 2)).tolist()]
+        points = random.uniform(-10, 10, (queryCount, 2)).tolist()
+        connection = dataset.session.connection()
+        nodeQuery = dataset_store.sa.select([dataset_store.nodes_table.c.id, dataset_store.nodes_table.c.longitude, dataset_store.nodes_table.c.latitude])
+        # Define methods
+        def scanBBox((minimumLongitude, minimumLatitude, maximumLongitude, maximumLatitude)):
+            return len([x for x in connection.execute(nodeQuery) if minimumLongitude <= x[1] <= maximumLongitude and minimumLatitude <= x[2] <= maximumLatitude])
+        def scanNearest((longitude, latitude)):
+            return min(connection.execute(nodeQuery), key=lambda x: math.hypot(x[1] - longitude, x[2] - latitude))[0]
+        methodPacks = [
+            ('bbox (index)', bboxes, lambda x: dataset.queryNodesInBBox(x).count()),
+            ('bbox (scan)', bboxes, scanBBox),
+            ('nearest (index)', points, lambda x: dataset.getNearestNodes(*x)[0].id),
+            ('nearest (scan)', points, scanNearest),
+        ]
+        # Time
+        print 'R*Tree available: %s' % dataset.hasSpatialIndex()
+        print '%-20s %16s' % ('method', 'seconds/query')
+        resultsByName = {}
+        for methodName, arguments, runMethod in methodPacks:
+            startTimeInSeconds = time.time()
+            resultsByName[methodName] = [runMethod(x) for x in arguments]
+            print '%-20s %16.6f' % (methodName, (time.time() - startTimeInSeconds) / queryCount)
+        # Check
+        for queryName in 'bbox', 'nearest':
+            if resultsByName[queryName + ' (index)'] != resultsByName[queryName + ' (scan)']:
+                print 'Results differ: %s' % queryName
+                return 1
+        dataset.session.close()
+    finally:
+        shutil.rmtree(temporaryFolder)
+    return 0
+
+
+# Define helpers
+
+def parseOptions(argv, defaultByName, flagNames=()):
+    'Parse --name value and --flag arguments'
+    valueByName = dict(defaultByName)
+    for flagName in flagNames:
+        valueByName[flagName] = False
+    arguments = list(argv)
+    while arguments:
+        argument = arguments.pop(0)
+        name = argument.lstrip('-')
+        if not argument.startswith('--') or (name not in defaultByName and name not in flagNames):
+            raise SystemExit('Unexpected argument: %s' % argument)
+        if name in flagNames:
+            valueByName[name] = True
+        else:
+            valueByName[name] = arguments.pop(0)
+    return valueByName
+
+
+benchmarkByName = {
+    'imports': benchmarkImports,
+    'overlay': benchmarkOverlay,
+    'ingest': benchmarkIngest,
+    'profiles': benchmarkProfiles,
+    'bbox': benchmarkBBox,
+}
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <benchmark> [options]\n'
+          '(example: "%s imports --baseline imports.json --save")' % (cmd, cmd))
+    for benchmarkName, benchmark in sorted(benchmarkByName.iteritems()):
+        print('\n%s%s' % (benchmarkName, benchmark.__doc__.rstrip()))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2 or argv[1] not in benchmarkByName:
+        usage(argv)
+    sys.exit(benchmarkByName[argv[1]](argv[2:]))
@@ -1,3 +1,4 @@
+import os
 import unittest
 import transaction
 
@@ -30,3 +31,316 @@ class TestMyView(unittest.TestCase):
         info = my_view(request)
         self.assertEqual(info['one'].name, 'one')
         self.assertEqual(info['project'], 'np')
+
+
+class TestCostEngine(unittest.TestCase):
+    'Make sure that the vectorized cost kernels match the per-node variables'
+
+    def setUp(self):
+        import numpy
+        from np.lib import metric
+        self.metricModel = metric.getModel('mvMax5')
+        self.random = numpy.random.RandomState(0)
+
+    def makeNodeVSs(self, jobVS, valueByOptionBySectionByIndex):
+        return [self.metricModel.VariableStore(x, jobVS) for x in valueByOptionBySectionByIndex]
+
+    def assertParity(self, costByClass, nodeVSs):
+        import numpy
+        for variableClass, costs in costByClass.iteritems():
+            expectedCosts = [x.get(variableClass) for x in nodeVSs]
+            self.assertTrue(numpy.allclose(costs, expectedCosts, rtol=1e-9, atol=1e-6), variableClass.__name__)
+
+    def test_randomPopulations(self):
+        jobVS = self.metricModel.VariableStore()
+        populationCounts = list(self.random.randint(0, 20000, 50)) + [0, 1]
+        nodeVSs = self.makeNodeVSs(jobVS, [{
+            'demographics': {'population count': x},
+        } for x in populationCounts])
+        self.assertParity(jobVS.getCostEngine().computeFromVariableStores(nodeVSs), nodeVSs)
+
+    def test_randomNodeParameters(self):
+        import numpy
+        from np.lib.metric.mvMax5 import costEngine, costGrid, costOffGrid
+        jobVS = self.metricModel.VariableStore({
+            'finance': {'interest rate per year': self.random.uniform(0.01, 0.2)},
+        })
+        nodeCount = 30
+        populationCounts = self.random.randint(1, 5000, nodeCount)
+        electricityCosts = self.random.uniform(0.05, 0.5, nodeCount)
+        fuelCosts = self.random.uniform(0.5, 2, nodeCount)
+        nodeVSs = self.makeNodeVSs(jobVS, [{
+            'demographics': {'population count': populationCounts[index]},
+            'system (grid)': {'electricity cost per kilowatt-hour': electricityCosts[index]},
+            'system (off-grid)': {'diesel fuel cost per liter': fuelCosts[index]},
+        } for index in xrange(nodeCount)])
+        engine = costEngine.CostEngine(jobVS)
+        valueByClass = dict((x, numpy.array([y.get(x) for y in nodeVSs])) for x in engine.inputClasses)
+        valueByClass[costGrid.GridElectricityCostPerKilowattHour] = electricityCosts
+        valueByClass[costOffGrid.DieselFuelCostPerLiter] = fuelCosts
+        self.assertParity(engine.compute(valueByClass), nodeVSs)
+
+
+class TestColumns(unittest.TestCase):
+    'Make sure that node output columns give back the pickled outputs'
+
+    def setUp(self):
+        import tempfile
+        self.temporaryFolder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        from np.lib import dataset_store
+        dataset_store.closeAll()
+        shutil.rmtree(self.temporaryFolder)
+
+    def test_mixedValues(self):
+        from np.lib import column_store
+        valueByOptionBySectionByNodeID = {
+            3: {'a': {'integer': '0', 'mixed': '0', 'padded': '05', 'float': '1.5', 'text': 'grid'}},
+            1: {'a': {'integer': '12', 'mixed': '1.5', 'padded': '5', 'float': '2.0', 'text': 'off-grid'}, 'b': {'sparse': '7'}},
+            2: {'a': {'integer': '-3', 'mixed': 'x', 'padded': '6', 'float': '1e-05'}},
+        }
+        columnWriter = column_store.Writer()
+        for nodeID, valueByOptionBySection in sorted(valueByOptionBySectionByNodeID.iteritems(), reverse=True):
+            columnWriter.add(nodeID, valueByOptionBySection)
+        folderPath = os.path.join(self.temporaryFolder, 'columns')
+        columnWriter.save(folderPath)
+        columnReader = column_store.Reader(folderPath)
+        for nodeID, valueByOptionBySection in valueByOptionBySectionByNodeID.iteritems():
+            self.assertEqual(columnReader.getValueByOptionBySection(nodeID), valueByOptionBySection)
+
+    def test_applyMetric(self):
+        from np.lib import dataset_store, geometry_store, metric
+        dataset = dataset_store.Store(os.path.join(self.temporaryFolder, 'dataset'), geometry_store.proj4LL)
+        dataset.addNodes([{
+            'name': str(index),
+            'x': str(index),
+            'y': str(index),
+            'demographics > population count': population,
+        } for index, population in enumerate(['0', '05', '1.5', '300', '12000'])])
+        dataset.applyMetric(metric.getModel('mvMax5'), {})
+        outputColumns = dataset.getOutputColumns()
+        for node in dataset.cycleNodes(loadPickles=True):
+            self.assertEqual(outputColumns.getValueByOptionBySection(node.id), node.output)
+        dataset.close()
+
+
+class TestDatasetIndexes(unittest.TestCase):
+    'Make sure that node and segment lookups use indexes'
+
+    def setUp(self):
+        import tempfile
+        from np.lib import dataset_store, geometry_store
+        self.temporaryFolder = tempfile.mkdtemp()
+        self.datasetPath = os.path.join(self.temporaryFolder, 'dataset.db')
+        self.dataset = dataset_store.Store(self.datasetPath, geometry_store.proj4LL)
+        self.dataset.addNodes([dict(name=str(x), x=str(x), y=str(x)) for x in xrange(10)])
+        dataset_store.insertRows(self.dataset.session.connection(), dataset_store.segments_table, [dict(
+            node1_id=x,
+            node2_id=x + 1,
+            is_existing=x % 2 == 0,
+            weight=1,
+        ) for x in xrange(1, 10)], self.dataset.chunkSize)
+        self.dataset.session.commit()
+        self.node = self.dataset.cycleNodes().next()
+
+    def tearDown(self):
+        import shutil
+        self.dataset.session.close()
+        shutil.rmtree(self.temporaryFolder)
+
+    def assertSearches(self, query):
+        queryPlan = self.dataset.getQueryPlan(query)
+        self.assertFalse([x for x in queryPlan if x.startswith('SCAN')], queryPlan)
+
+    def test_connectionQueries(self):
+        self.assertSearches(self.dataset.getConnectionQuery(self.node))
+        self.assertSearches(self.dataset.getConnectionQuery(self.node, is_existing=True))
+        self.assertSearches(self.dataset.getConnectionQuery(self.node, is_existing=False))
+
+    def test_connectionSummary(self):
+        nodes = list(self.dataset.cycleNodes())
+        packs = [(self.dataset.isNodeConnected(x), self.dataset.wasNodeAlreadyConnected(x), sum(y.weight for y in self.dataset.cycleConnections(x, is_existing=False))) for x in nodes]
+        self.dataset.summarizeConnections()
+        try:
+            self.assertEqual([(self.dataset.isNodeConnected(x), self.dataset.wasNodeAlreadyConnected(x), sum(y.weight for y in self.dataset.cycleConnections(x, is_existing=False))) for x in nodes], packs)
+        finally:
+            self.dataset.clearConnectionSummary()
+
+    def test_addNode(self):
+        self.assertEqual(self.dataset.getNodeStatistics()['node count'], 10)
+        self.dataset.addNode((20, 30), dict(name='20', x='20', y='30'))
+        nodeStatistics = self.dataset.getNodeStatistics()
+        self.assertEqual(nodeStatistics['node count'], 11)
+        self.assertEqual(nodeStatistics['maximum latitude'], 30)
+
+    def test_migrate(self):
+        from np.lib import dataset_store
+        # Remove indexes as if the dataset came from an older version
+        connection = self.dataset.session.connection()
+        for indexName, tableName, columnNames in dataset_store.indexPacks:
+            connection.execute('DROP INDEX %s' % indexName)
+        self.dataset.session.commit()
+        self.assertTrue([x for x in self.dataset.getQueryPlan(self.dataset.getConnectionQuery(self.node)) if x.startswith('SCAN')])
+        # Migrate
+        self.dataset.session.close()
+        self.dataset = dataset_store.migrate(self.datasetPath)
+        indexNames = set(x[0] for x in self.dataset.session.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+        self.assertTrue(indexNames.issuperset(x[0] for x in dataset_store.indexPacks))
+        self.assertSearches(self.dataset.getConnectionQuery(self.node))
+
+
+class TestTransformPoints(unittest.TestCase):
+    'Make sure that transforming arrays of points matches transforming one point at a time'
+
+    def test_utm(self):
+        import numpy
+        from np.lib import geometry_store
+        proj4UTM = '+proj=utm +zone=37 +south +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
+        random = numpy.random.RandomState(2)
+        xs = random.uniform(200000, 800000, 20)
+        ys = random.uniform(9000000, 9900000, 20)
+        transform_point = geometry_store.get_transform_point(proj4UTM)
+        longitudes, latitudes = geometry_store.get_transform_points(proj4UTM)(xs, ys)
+        expectedLongitudes, expectedLatitudes = zip(*[transform_point(x, y) for x, y in zip(xs, ys)])
+        self.assertTrue(numpy.allclose(longitudes, expectedLongitudes))
+        self.assertTrue(numpy.allclose(latitudes, expectedLatitudes))
+        # Make sure that lists and empty arrays work too
+        self.assertTrue(numpy.allclose(geometry_store.get_transform_points(proj4UTM)(list(xs), list(ys))[0], expectedLongitudes))
+        self.assertEqual([len(x) for x in geometry_store.get_transform_points(proj4UTM)([], [])], [0, 0])
+
+
+class TestTiles(unittest.TestCase):
+    'Make sure that merging processed tiles gives one consistent network'
+
+    def setUp(self):
+        import tempfile
+        import numpy
+        from np.lib import dataset_store, geometry_store, metric, network
+        self.temporaryFolder = tempfile.mkdtemp()
+        self.metricModel = metric.getModel('mvMax5')
+        self.networkModel = network.getModel('modKruskal')
+        random = numpy.random.RandomState(1)
+        nodeCount = 40
+        self.dataset = dataset_store.Store(os.path.join(self.temporaryFolder, 'dataset'), geometry_store.proj4LL)
+        self.dataset.addNodes([{
+            'name': str(index),
+            'x': str(longitude),
+            'y': str(latitude),
+            'demographics > population count': str(population),
+        } for index, (longitude, latitude, population) in enumerate(zip(
+            random.uniform(0, 0.1, nodeCount),
+            random.uniform(0, 0.1, nodeCount),
+            random.randint(100, 3000, nodeCount)))])
+
+    def tearDown(self):
+        import shutil
+        from np.lib import dataset_store
+        self.dataset.close()
+        dataset_store.closeAll()
+        shutil.rmtree(self.temporaryFolder)
+
+    def test_merge(self):
+        from np.lib import tile_store
+        self.dataset.partition('kd', 4, bufferSize=0.02)
+        for tile in self.dataset.loadTiles():
+            tile.process(self.metricModel, {}, self.networkModel, {})
+            tile.close()
+        self.dataset.mergeTiles(self.metricModel, {})
+        # Make sure that we have one copy of each node
+        nodeIDs = [x.id for x in self.dataset.cycleNodes()]
+        self.assertEqual(len(nodeIDs), 40)
+        self.assertEqual(len(set(nodeIDs)), len(nodeIDs))
+        # Make sure that we have one copy of each segment and no cycles
+        segmentKeys = [tuple(sorted((x.node1_id, x.node2_id))) for x in self.dataset.cycleSegmentRows()]
+        self.assertEqual(len(set(segmentKeys)), len(segmentKeys))
+        components = tile_store.Components()
+        self.assertTrue(all(components.join(*x) for x in segmentKeys))
+        # Make sure that systems agree with connectivity
+        for node, (system,) in self.dataset.cycleNodeOutputValues([('metric', 'system')]):
+            if system != 'unelectrified':
+                self.assertEqual(system == 'grid', self.dataset.isNodeConnected(node), node.id)
+
+
+class TestCheckpoints(unittest.TestCase):
+    'Make sure that a job that stops midway resumes to the same result'
+
+    def setUp(self):
+        import tempfile
+        import numpy
+        from np.lib import metric, network
+        self.temporaryFolder = tempfile.mkdtemp()
+        self.metricModel = metric.getModel('mvMax5')
+        self.networkModel = network.getModel('modKruskal')
+        random = numpy.random.RandomState(0)
+        self.nodePacks = [{
+            'name': str(index),
+            'x': str(longitude),
+            'y': str(latitude),
+            'demographics > population count': str(population),
+        } for index, (longitude, latitude, population) in enumerate(zip(
+            random.uniform(0, 0.05, 30),
+            random.uniform(0, 0.05, 30),
+            random.randint(100, 3000, 30)))]
+
+    def tearDown(self):
+        import shutil
+        from np.lib import dataset_store
+        dataset_store.closeAll()
+        shutil.rmtree(self.temporaryFolder)
+
+    def makeDataset(self, name):
+        from np.lib import dataset_store, geometry_store
+        dataset = dataset_store.Store(os.path.join(self.temporaryFolder, name), geometry_store.proj4LL)
+        dataset.addNodes(self.nodePacks)
+        return dataset
+
+    def process(self, dataset):
+        return dataset.process(self.metricModel, {}, self.networkModel, {})
+
+    def summarizeResult(self, dataset):
+        'Return node metrics and systems with segments in an order that does not depend on ids'
+        nodePacks = [(node.id, node.metric, system) for node, (system,) in dataset.cycleNodeOutputValues([('metric', 'system')])]
+        segmentPacks = sorted((tuple(sorted([(x.x1, x.y1), (x.x2, x.y2)])), x.is_existing, x.weight) for x in dataset.cycleSegmentRows())
+        return nodePacks, segmentPacks
+
+    def test_resume(self):
+        import multiprocessing
+        import sqlalchemy as sa
+        from np.lib import dataset_store
+        # Run without stopping
+        dataset = self.makeDataset('reference')
+        expectedOutputs = self.process(dataset)
+        expectedResult = self.summarizeResult(dataset)
+        dataset.close()
+        # Stop the job right after the first network checkpoint
+        dataset = self.makeDataset('resumed')
+        datasetPath = dataset.getDatasetPath()
+        dataset.close()
+        dataset_store.closeAll()
+        saveProgress = dataset_store.NetworkCheckpoint.saveProgress
+        def stop(checkpoint, completedCount, addedIndices):
+            saveProgress(checkpoint, completedCount, addedIndices)
+            os._exit(1)
+        def run():
+            dataset_store.NetworkCheckpoint.interval = 20
+            dataset_store.NetworkCheckpoint.saveProgress = stop
+            self.process(dataset_store.load(datasetPath))
+        job = multiprocessing.Process(target=run)
+        job.start()
+        job.join()
+        self.assertNotEqual(job.exitcode, 0)
+        # Make sure that the job stopped during buildNetwork
+        dataset = dataset_store.load(datasetPath)
+        checkpointsTable = dataset_store.checkpoints_table
+        self.assertEqual(set(tuple(x) for x in dataset.session.execute(sa.select([checkpointsTable.c.phase, checkpointsTable.c.name]))), set([
+            ('applyMetric', 'complete'),
+            ('buildNetwork', 'candidates'),
+            ('buildNetwork', 'progress'),
+        ]))
+        self.assertEqual(dataset.countSegments(), 0)
+        # Resume
+        self.assertEqual(self.process(dataset), expectedOutputs)
+        self.assertEqual(self.summarizeResult(dataset), expectedResult)
+        dataset.close()
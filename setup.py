@@ -48,5 +48,6 @@ setup(name='np',
       main = np:main
       [console_scripts]
       initialize_np_db = np.scripts.initializedb:main
+      benchmark_np = np.scripts.benchmark:main
       """,
       )